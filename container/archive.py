@@ -14,18 +14,79 @@
 """Archive manipulation library for the Docker rules."""
 
 # pylint: disable=g-import-not-at-top
+import bz2
+import collections
+import concurrent.futures
+import errno
 import gzip
+import hashlib
 import io
+import mmap
 import os
+import struct
 import subprocess
+import sys
 import tarfile
 import posixpath
+import re
+import shutil
+import threading
+import zlib
+
+try:
+  import lzma
+  HAS_LZMA = True
+except ImportError:
+  HAS_LZMA = False
 
 # Use a deterministic mtime that doesn't confuse other programs.
 # See: https://github.com/bazelbuild/bazel/issues/1299
 PORTABLE_MTIME = 946684800  # 2000-01-01 00:00:00.000 UTC
 
 
+class _BoundedReader(io.RawIOBase):
+  """A read-only, seekable file object over a range of a buffer, e.g. an mmap.
+
+  Reads copy straight from the buffer into the caller's one.
+  """
+
+  def __init__(self, buf, offset, size):
+    super(_BoundedReader, self).__init__()
+    self._buf = buf
+    self._start = offset
+    self._end = min(offset + size, len(buf))
+    self._pos = offset
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, b):
+    n = max(0, min(len(b), self._end - self._pos))
+    # Release the view right away, an mmap cannot be closed while exported.
+    with memoryview(self._buf) as view:
+      b[:n] = view[self._pos:self._pos + n]
+    self._pos += n
+    return n
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      pos = self._start + offset
+    elif whence == io.SEEK_CUR:
+      pos = self._pos + offset
+    elif whence == io.SEEK_END:
+      pos = self._end + offset
+    else:
+      raise ValueError('invalid whence (%r)' % whence)
+    self._pos = max(self._start, pos)
+    return self._pos - self._start
+
+  def tell(self):
+    return self._pos - self._start
+
+
 class SimpleArFile(object):
   """A simple AR file reader.
   This enable to read AR file (System V variant) as described
@@ -36,6 +97,8 @@ class SimpleArFile(object):
     while nextFile:
       print(nextFile.filename)
       nextFile = ar.next()
+  The archive is memory mapped and the content of its entries is only read
+  when accessed, best through the file object returned by `entry.open()`.
   Upon error, this class will raise a ArError exception.
   """
 
@@ -53,10 +116,11 @@ class SimpleArFile(object):
       owner_id, group_id: numeric id of the user and group owning the file.
       mode: unix permission mode of the file
       size: size of the file
-      data: the content of the file.
+      offset: offset of the content of the file in the archive.
+      data: the content of the file, copied from the archive on access.
     """
 
-    def __init__(self, f):
+    def __init__(self, f, archive_map):
       self.filename = f.read(16).decode('utf-8').strip()
       if self.filename.endswith('/'):  # SysV variant
         self.filename = self.filename[:-1]
@@ -68,7 +132,21 @@ class SimpleArFile(object):
       pad = f.read(2)
       if pad != b'\x60\x0a':
         raise SimpleArFile.ArError('Invalid AR file header')
-      self.data = f.read(self.size)
+      self.offset = f.tell()
+      self._map = archive_map
+      f.seek(self.size, os.SEEK_CUR)
+
+    @property
+    def data(self):
+      return self._map[self.offset:self.offset + self.size]
+
+    def open(self):
+      """Returns a read-only, seekable file object over the content.
+
+      It is only valid until the archive is closed.
+      """
+      return io.BufferedReader(
+          _BoundedReader(self._map, self.offset, self.size))
 
   MAGIC_STRING = b'!<arch>\n'
 
@@ -78,10 +156,13 @@ class SimpleArFile(object):
   def __enter__(self):
     self.f = open(self.filename, 'rb')
     if self.f.read(len(self.MAGIC_STRING)) != self.MAGIC_STRING:
+      self.f.close()
       raise self.ArError('Not a ar file: ' + self.filename)
+    self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
     return self
 
   def __exit__(self, t, v, traceback):
+    self.map.close()
     self.f.close()
 
   def next(self):
@@ -91,9 +172,621 @@ class SimpleArFile(object):
       self.f.read(1)
     # An AR sections is at least 60 bytes. Some file might contains garbage
     # bytes at the end of the archive, ignore them.
-    if self.f.tell() > os.fstat(self.f.fileno()).st_size - 60:
+    if self.f.tell() > len(self.map) - 60:
+      return None
+    return self.SimpleArFileEntry(self.f, self.map)
+
+
+def _regular_file_fd(fileobj):
+  """Returns the descriptor of a plain, uncompressed file object, else None.
+
+  Only objects directly backed by an io.FileIO qualify: e.g. tarfile's members
+  or gzip files also have a fileno(), which is the one of another stream.
+  """
+  raw = fileobj
+  if isinstance(fileobj, (io.BufferedReader, io.BufferedWriter)):
+    raw = fileobj.raw
+  if type(raw) is not io.FileIO:  # pylint: disable=unidiomatic-typecheck
+    return None
+  return raw.fileno()
+
+
+def copy_fd(src, dst, size, offset=None):
+  """Copies `size` bytes of a descriptor to the current offset of another.
+
+  The copy is done in the kernel, with os.copy_file_range or else os.sendfile
+  on Linux (elsewhere, sendfile only writes to sockets), so that the data
+  never goes through Python buffers.
+
+  Args:
+    src: the file descriptor to read from.
+    dst: the file descriptor to write to.
+    size: the number of bytes to copy.
+    offset: the offset in `src` to copy from, or None to copy from its
+        current offset. An explicit offset leaves the one of `src` unchanged,
+        so that other threads may pread it meanwhile.
+  Returns:
+    the number of bytes copied, which is less than `size` if the platform or
+    the file systems do not support it, or if `src` is shorter than expected.
+  """
+  copied = 0
+  for method in ['copy_file_range', 'sendfile']:
+    if not hasattr(os, method):
+      continue
+    if method == 'sendfile' and not sys.platform.startswith('linux'):
+      continue
+    try:
+      while copied < size:
+        src_offset = None if offset is None else offset + copied
+        if method == 'sendfile':
+          n = os.sendfile(dst, src, src_offset, size - copied)
+        else:
+          n = os.copy_file_range(src, dst, size - copied, src_offset)
+        if not n:
+          return copied
+        copied += n
+      return copied
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSOCK):
+        raise
+  return copied
+
+
+def _copy_file_content(src, dst, size):
+  """Copies `size` bytes from the file object `src` to the plain file `dst`.
+
+  Raises:
+    IOError: if `src` is shorter than `size`.
+  """
+  dst.flush()
+  copied = copy_fd(src.fileno(), dst.fileno(), size)
+  # The kernel moved the descriptor offset under the buffered writer.
+  dst.seek(0, io.SEEK_END)
+  while copied < size:
+    buf = src.read(min(size - copied, 1024 * 1024))
+    if not buf:
+      raise IOError('unexpected end of data')
+    dst.write(buf)
+    copied += len(buf)
+
+
+class _CountingWriter(object):
+  """A write-only file object counting the bytes written through it.
+
+  This gives a tell() to file objects without one, e.g. pipes.
+  """
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.offset = 0
+
+  def write(self, data):
+    self.offset += len(data)
+    return self.fileobj.write(data)
+
+  def tell(self):
+    return self.offset
+
+  def flush(self):
+    self.fileobj.flush()
+
+  def close(self):
+    self.fileobj.close()
+
+
+class _HashingWriter(_CountingWriter):
+  """A write-only file object hashing everything written through it."""
+
+  def __init__(self, fileobj):
+    super(_HashingWriter, self).__init__(fileobj)
+    self.sha256 = hashlib.sha256()
+
+  def write(self, data):
+    self.sha256.update(data)
+    return super(_HashingWriter, self).write(data)
+
+  def hexdigest(self):
+    return self.sha256.hexdigest()
+
+
+def _deflate_block(block, dictionary, compresslevel, last):
+  """Deflates one block of a ParallelGzipWriter as a raw deflate fragment."""
+  if dictionary:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                  zlib.Z_DEFAULT_STRATEGY, dictionary)
+  else:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+  # A sync flush ends the fragment on a byte boundary without marking it as
+  # the final one, so fragments can simply be concatenated.
+  return compressor.compress(block) + compressor.flush(
+      zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+  """A write-only gzip file object compressing blocks in a thread pool.
+
+  The input is cut in fixed-size blocks which are deflated independently (each
+  primed with the last 32 KiB of the previous block, as pigz does) by a pool of
+  threads, zlib releasing the GIL while compressing. The fragments are written
+  in order, followed by the CRC-32 of the whole input computed as it is
+  written. Block boundaries do not depend on the number of threads, hence the
+  output is byte-identical whatever the number of threads is.
+  """
+
+  BLOCK_SIZE = 128 * 1024
+  _DICTIONARY_SIZE = 32 * 1024
+
+  def __init__(self,
+               filename=None,
+               mode='wb',
+               compresslevel=9,
+               fileobj=None,
+               mtime=None,
+               threads=1):
+    """Constructor, mirroring gzip.GzipFile.
+    Args:
+      filename: the file to write, unless `fileobj` is given.
+      mode: must be a write mode.
+      compresslevel: the compression level, from 1 to 9.
+      fileobj: file object to write to, left open by close().
+      mtime: the mtime of the gzip header, 0 if None.
+      threads: the number of compressing threads.
+    """
+    if not mode.startswith('w'):
+      raise ValueError('ParallelGzipWriter only supports writing')
+    self.own_fileobj = fileobj is None
+    self.fileobj = open(filename, 'wb') if fileobj is None else fileobj
+    self.compresslevel = compresslevel
+    self.crc = 0
+    self.size = 0
+    self.buffer = bytearray()
+    self.dictionary = b''
+    self.pending = collections.deque()
+    self.max_pending = 2 * threads
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    # Same header as gzip.GzipFile without a file name: deflate, no flags,
+    # the extra flags for the compression level and an unknown OS.
+    if compresslevel == 9:
+      xfl = b'\x02'
+    elif compresslevel == 1:
+      xfl = b'\x04'
+    else:
+      xfl = b'\x00'
+    self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<L', mtime or 0) +
+                       xfl + b'\xff')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, t, v, traceback):
+    self.close()
+
+  def _submit(self, block, last=False):
+    dictionary = self.dictionary
+    self.dictionary = block[-self._DICTIONARY_SIZE:]
+    self.pending.append(
+        self.executor.submit(_deflate_block, block, dictionary,
+                             self.compresslevel, last))
+    while len(self.pending) > self.max_pending:
+      self.fileobj.write(self.pending.popleft().result())
+
+  def write(self, data):
+    self.crc = zlib.crc32(data, self.crc)
+    self.size += len(data)
+    self.buffer += data
+    while len(self.buffer) >= self.BLOCK_SIZE:
+      self._submit(bytes(self.buffer[:self.BLOCK_SIZE]))
+      del self.buffer[:self.BLOCK_SIZE]
+    return len(data)
+
+  def tell(self):
+    return self.size
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if self.executor is None:
+      return
+    self._submit(bytes(self.buffer), last=True)
+    self.buffer = bytearray()
+    while self.pending:
+      self.fileobj.write(self.pending.popleft().result())
+    self.executor.shutdown()
+    self.executor = None
+    self.fileobj.write(
+        struct.pack('<LL', self.crc & 0xffffffff, self.size & 0xffffffff))
+    if self.own_fileobj:
+      self.fileobj.close()
+
+
+# Size of the slices of a memory mapped file hashed and compressed at once.
+_MMAP_SLICE_SIZE = 1024 * 1024
+
+
+def _gzip_writer(threads, **kwargs):
+  """Returns a gzip.GzipFile, or a ParallelGzipWriter if `threads` is set."""
+  if threads:
+    return ParallelGzipWriter(threads=threads, **kwargs)
+  return gzip.GzipFile(**kwargs)
+
+
+class LayerStream(object):
+  """Tees the byte stream of a layer to all of its outputs in a single pass.
+
+  Every block written is hashed (the diff_id), written to the layer output and,
+  when a compressed output is given, gzipped into it while the compressed bytes
+  are hashed as well (the blob sum). The layer is thus never re-read from disk
+  to compute its digests or its compressed form.
+  """
+
+  def __init__(self,
+               fileobj,
+               compressed_fileobj=None,
+               compresslevel=6,
+               compression_threads=0):
+    """Constructor.
+    Args:
+      fileobj: file object receiving the uncompressed layer.
+      compressed_fileobj: optional file object receiving the gzipped layer.
+      compresslevel: gzip compression level of the compressed output.
+      compression_threads: if set, gzip with a ParallelGzipWriter using that
+          many threads.
+    """
+    self.layer = _HashingWriter(fileobj)
+    self.compressed = None
+    self.gzip = None
+    if compressed_fileobj is not None:
+      self.compressed = _HashingWriter(compressed_fileobj)
+      # No file name and a zero mtime in the header keep the blob reproducible.
+      self.gzip = _gzip_writer(compression_threads,
+                               filename='',
+                               mode='wb',
+                               compresslevel=compresslevel,
+                               fileobj=self.compressed,
+                               mtime=0)
+
+  def write(self, data):
+    self.layer.write(data)
+    if self.gzip:
+      self.gzip.write(data)
+    return len(data)
+
+  def tell(self):
+    return self.layer.tell()
+
+  def flush(self):
+    self.layer.flush()
+
+  def can_copy_file(self):
+    """Whether copy_file can be used, i.e. the layer is a plain file."""
+    return _regular_file_fd(self.layer.fileobj) is not None
+
+  def copy_file(self, f, size):
+    """Writes the content of the regular file `f`, of `size` bytes.
+
+    The content is hashed and compressed from a memory map, a slice at a time
+    so that the compressor never buffers the whole file, and copied to the
+    layer by the kernel.
+    """
+    if size:
+      m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+      try:
+        with memoryview(m) as view:
+          for start in range(0, size, _MMAP_SLICE_SIZE):
+            with view[start:start + _MMAP_SLICE_SIZE] as chunk:
+              self.layer.sha256.update(chunk)
+              if self.gzip:
+                self.gzip.write(chunk)
+      finally:
+        m.close()
+      _copy_file_content(f, self.layer.fileobj, size)
+      self.layer.offset += size
+
+  def close(self):
+    if self.gzip:
+      # GzipFile does not close a file object it did not open.
+      self.gzip.close()
+      self.compressed.close()
+    self.layer.close()
+
+  @property
+  def diff_id(self):
+    """The hex SHA-256 of the uncompressed layer."""
+    return self.layer.hexdigest()
+
+  @property
+  def blob_sum(self):
+    """The hex SHA-256 of the compressed layer, None if not compressed."""
+    return self.compressed.hexdigest() if self.compressed else None
+
+
+# Size of the chunks the payload of members is copied in by RawTarReader.
+_RAW_COPY_SIZE = 1024 * 1024
+
+_PAX_RECORD = re.compile(br'(\d+) ([^=]+)=')
+
+
+def _read_exact(fileobj, size):
+  """Reads `size` bytes from a file object, which may be a pipe."""
+  buf = fileobj.read(size)
+  while len(buf) < size:
+    more = fileobj.read(size - len(buf))
+    if not more:
+      raise tarfile.ReadError('unexpected end of data')
+    buf += more
+  return buf
+
+
+def _padded(size):
+  """Returns `size` rounded up to a whole number of tar blocks."""
+  return size + (-size % tarfile.BLOCKSIZE)
+
+
+def _set_checksum(block):
+  """Updates the checksum of a header block in place, as tarfile writes it."""
+  block[148:155] = b'%06o\0' % tarfile.calc_chksums(block)[0]
+
+
+def _pax_records(payload):
+  """Returns the (keyword, value) records of a PAX extended header."""
+  records = []
+  pos = 0
+  while pos < len(payload) and payload[pos:pos + 1] != tarfile.NUL:
+    match = _PAX_RECORD.match(payload, pos)
+    if not match:
+      raise tarfile.ReadError('invalid PAX header')
+    length = int(match.group(1))
+    records.append((match.group(2), payload[match.end():pos + length - 1]))
+    pos += length
+  return records
+
+
+def _pax_record(keyword, value):
+  """Returns a PAX record, whose length includes its own digits."""
+  length = len(keyword) + len(value) + 3  # The space, '=' and '\n'.
+  digits = len(str(length))
+  while len(str(length + digits)) != digits:
+    digits += 1
+  return b'%d %s=%s\n' % (length + digits, keyword, value)
+
+
+class RawTarMember(object):
+  """A member of a tar read by a RawTarReader.
+
+  The member is kept as the raw blocks of its headers (including the extended
+  ones preceding it), which write() copies along with its payload. Headers can
+  be patched in place, so that members are rewritten without decoding and
+  re-encoding them through tarfile. Alternatively, the member is a file object
+  reading its content, and tarinfo() decodes its headers.
+  """
+
+  def __init__(self, reader, headers, name, type_, size):
+    self._reader = reader
+    self._headers = headers
+    self.name = name
+    self.type = type_
+    self.size = size
+    # Bytes of the payload (and its padding) not read yet.
+    self._remaining = _padded(size)
+
+  def isdir(self):
+    return self.type == tarfile.DIRTYPE
+
+  def _update_pax(self, update):
+    """Rewrites the records of the PAX headers of the member.
+
+    Args:
+      update: function from the list of (keyword, value) records of a PAX
+          header to its new records, or to None to leave it unchanged. Headers
+          left without records are dropped.
+    """
+    headers = []
+    for header in self._headers[:-1]:
+      if header[156:157] == tarfile.XHDTYPE:
+        size = tarfile.nti(header[124:136])
+        records = update(_pax_records(bytes(header[tarfile.BLOCKSIZE:][:size])))
+        if records is not None:
+          if not records:
+            continue
+          payload = b''.join(_pax_record(k, v) for k, v in records)
+          header = header[:tarfile.BLOCKSIZE]
+          header[124:136] = tarfile.itn(len(payload), 12, tarfile.GNU_FORMAT)
+          _set_checksum(header)
+          header += payload + tarfile.NUL * (-len(payload) % tarfile.BLOCKSIZE)
+      headers.append(header)
+    self._headers[:-1] = headers
+
+  def set_mtime(self, mtime):
+    """Sets the mtime of the member, in its header and any PAX record."""
+
+    def update(records):
+      if not any(keyword == b'mtime' for keyword, _ in records):
+        return None
+      return [(keyword, b'%d' % mtime if keyword == b'mtime' else value)
+              for keyword, value in records]
+
+    self._update_pax(update)
+    block = self._headers[-1]
+    block[136:148] = tarfile.itn(mtime, 12, tarfile.GNU_FORMAT)
+    _set_checksum(block)
+
+  def clear_owner_names(self):
+    """Strips the names of the owners of the member, keeping their ids."""
+
+    def update(records):
+      if not any(keyword in (b'uname', b'gname') for keyword, _ in records):
+        return None
+      return [(keyword, value) for keyword, value in records
+              if keyword not in (b'uname', b'gname')]
+
+    self._update_pax(update)
+    block = self._headers[-1]
+    if block[257:262] == b'ustar':
+      # Only ustar and GNU headers have owner names.
+      block[265:329] = tarfile.NUL * 64
+      _set_checksum(block)
+
+  def tarinfo(self):
+    """Returns the member decoded by tarfile, with any extended headers."""
+    with tarfile.open(fileobj=io.BytesIO(b''.join(self._headers)),
+                      mode='r:') as t:
+      return t.next()
+
+  def read(self, size=-1):
+    """Reads the content of the member."""
+    available = self._remaining - (-self.size % tarfile.BLOCKSIZE)
+    if size < 0 or size > available:
+      size = max(available, 0)
+    buf = _read_exact(self._reader.fileobj, size)
+    self._remaining -= len(buf)
+    return buf
+
+  def write(self, fileobj):
+    """Writes the member, headers and payload, to `fileobj`.
+
+    Returns:
+      the number of bytes written.
+    """
+    written = 0
+    for header in self._headers:
+      fileobj.write(header)
+      written += len(header)
+    while self._remaining:
+      buf = _read_exact(self._reader.fileobj,
+                        min(self._remaining, _RAW_COPY_SIZE))
+      fileobj.write(buf)
+      self._remaining -= len(buf)
+      written += len(buf)
+    return written
+
+  def skip(self):
+    """Skips the rest of the payload of the member."""
+    while self._remaining:
+      self._remaining -= len(
+          _read_exact(self._reader.fileobj,
+                      min(self._remaining, _RAW_COPY_SIZE)))
+
+
+class RawTarReader(object):
+  """Reads the members of a tar stream without decoding them.
+
+  Only the fields needed to walk the archive and identify members are parsed:
+  their type, size and name (from ustar, GNU long name or PAX headers). The
+  stream is read sequentially, so it may be a pipe or a decompressing file
+  object. Members must be used (written, read or skipped) before moving to the
+  next one, whatever is left of their payload is skipped otherwise.
+  """
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+
+  def __iter__(self):
+    while True:
+      member = self._next()
+      if member is None:
+        return
+      yield member
+      member.skip()
+
+  def _read_header(self):
+    """Returns the next header block, None at the end of the archive."""
+    block = self.fileobj.read(tarfile.BLOCKSIZE)
+    if not block or block == tarfile.NUL * tarfile.BLOCKSIZE:
       return None
-    return self.SimpleArFileEntry(self.f)
+    block = bytearray(block + _read_exact(self.fileobj,
+                                          tarfile.BLOCKSIZE - len(block)))
+    try:
+      chksum = tarfile.nti(block[148:156])
+    except tarfile.InvalidHeaderError:
+      raise tarfile.ReadError('invalid header')
+    if chksum not in tarfile.calc_chksums(block):
+      raise tarfile.ReadError('bad checksum')
+    return block
+
+  def _next(self):
+    headers = []
+    pax = {}
+    long_name = None
+    while True:
+      block = self._read_header()
+      if block is None:
+        if headers:
+          raise tarfile.ReadError('unexpected end of data')
+        return None
+      type_ = bytes(block[156:157])
+      size = tarfile.nti(block[124:136])
+      if type_ in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME,
+                   tarfile.GNUTYPE_LONGLINK):
+        payload = _read_exact(self.fileobj, _padded(size))
+        headers.append(block + payload)
+        if type_ == tarfile.XHDTYPE:
+          pax.update(_pax_records(payload[:size]))
+        elif type_ == tarfile.GNUTYPE_LONGNAME:
+          long_name = tarfile.nts(payload[:size], 'utf-8', 'surrogateescape')
+        continue
+      headers.append(block)
+      if type_ == tarfile.GNUTYPE_SPARSE and block[482]:
+        # Old GNU sparse files list more of their chunks in extension blocks.
+        while True:
+          extension = bytearray(_read_exact(self.fileobj, tarfile.BLOCKSIZE))
+          headers.append(extension)
+          if not extension[504]:
+            break
+      break
+
+    if b'path' in pax:
+      name = pax[b'path'].decode('utf-8', 'surrogateescape')
+    elif long_name is not None:
+      name = long_name
+    else:
+      name = tarfile.nts(block[0:100], 'utf-8', 'surrogateescape')
+      if block[257:265] == tarfile.POSIX_MAGIC:
+        prefix = tarfile.nts(block[345:500], 'utf-8', 'surrogateescape')
+        if prefix:
+          name = prefix + '/' + name
+    if b'size' in pax:
+      size = int(pax[b'size'])
+    if type_ == tarfile.AREGTYPE and name.endswith('/'):
+      # Old V7 tar format represents a directory as a regular file with a
+      # trailing slash.
+      type_ = tarfile.DIRTYPE
+    if (type_ not in tarfile.REGULAR_TYPES and
+        type_ in tarfile.SUPPORTED_TYPES):
+      # Like tarfile, only read the payload of regular files, whatever the
+      # size field of other members says.
+      size = 0
+    return RawTarMember(self, headers, name, type_, size)
+
+
+def rewrite_tar_mtimes(infile, outfile, mtime):
+  """Copies a tar stream, setting the mtime of all of its members.
+
+  Headers are patched in place and payloads copied verbatim in large chunks,
+  see RawTarReader. Unlike re-writing the tar with tarfile, the headers are
+  not otherwise normalized, e.g. GNU headers are kept as they are. The output
+  ends like the ones of tarfile.
+
+  Args:
+    infile: the file object to read the tar from.
+    outfile: the file object to write the tar to.
+    mtime: the mtime of the members of the output.
+
+  Returns:
+    the number of bytes written.
+  """
+  written = 0
+  for member in RawTarReader(infile):
+    member.set_mtime(mtime)
+    written += member.write(outfile)
+  # The end of archive marker, padded to a full record.
+  end = 2 * tarfile.BLOCKSIZE
+  end += -(written + end) % tarfile.RECORDSIZE
+  outfile.write(tarfile.NUL * end)
+  return written + end
 
 
 class TarFileWriter(object):
@@ -107,7 +800,16 @@ class TarFileWriter(object):
                compression='',
                root_directory='./',
                default_mtime=None,
-               preserve_tar_mtimes=True):
+               preserve_tar_mtimes=True,
+               compressed_name=None,
+               compute_digests=False,
+               compresslevel=6,
+               compression_threads=0,
+               xz_preset=6,
+               xz_threads=0,
+               xz_path=None,
+               zero_copy=True,
+               rewrite_headers=False):
     """TarFileWriter wraps tarfile.open().
     Args:
       name: the tar file name.
@@ -117,15 +819,40 @@ class TarFileWriter(object):
           May be an integer or the value 'portable' to use the date
           2000-01-01, which is compatible with non *nix OSes'.
       preserve_tar_mtimes: if true, keep file mtimes from input tar file.
+      compressed_name: if set, also write a gzipped copy of the tar to this
+          file, in the same pass as the tar itself.
+      compute_digests: if true, compute the SHA-256 of the uncompressed tar
+          (and of the compressed copy) while writing, see `diff_id` and
+          `blob_sum`.
+      compresslevel: gzip compression level of `compressed_name`.
+      compression_threads: if set, compress gzip outputs in parallel with that
+          many threads, see ParallelGzipWriter. The output then differs from
+          the single-threaded gzip.GzipFile one, but does not depend on the
+          number of threads.
+      xz_preset: xz compression preset, from 0 to 9.
+      xz_threads: if set, compress xz outputs with that many threads, through
+          the external xz encoder.
+      xz_path: path of the xz encoder, when it is used. Defaults to the one in
+          the PATH.
+      zero_copy: if true, copy the content of files added from disk to an
+          uncompressed output in the kernel, see _add_regular_file.
+      rewrite_headers: if true, add_tar copies the members it doesn't rename
+          as raw blocks, only patching their mtime and owner names, see
+          RawTarReader. Their headers are then kept as they are rather than
+          re-encoded by tarfile, e.g. in the GNU format.
+    Raises:
+      TarFileWriter.Error: if digests are requested for a bzip2 output, or
+          if xz is needed and not found.
     """
     if compression in ['bzip2', 'bz2']:
       mode = 'w:bz2'
     else:
       mode = 'w:'
     self.gz = compression in ['tgz', 'gz']
-    # Support xz compression through xz... until we can use Py3
     self.xz = compression in ['xz', 'lzma']
     self.name = name
+    self.zero_copy = zero_copy
+    self.rewrite_headers = rewrite_headers
     self.root_directory = root_directory.rstrip('/')
     self.preserve_mtime = preserve_tar_mtimes
     if default_mtime is None:
@@ -139,12 +866,48 @@ class TarFileWriter(object):
     if self.gz:
       # The Tarfile class doesn't allow us to specify gzip's mtime attribute.
       # Instead, we manually re-implement gzopen from tarfile.py and set mtime.
-      self.fileobj = gzip.GzipFile(
-          filename=name, mode='w', compresslevel=9, mtime=self.default_mtime)
+      self.fileobj = _gzip_writer(compression_threads,
+                                  filename=name,
+                                  mode='w',
+                                  compresslevel=9,
+                                  mtime=self.default_mtime)
+    self.xz_process = None
+    if self.xz:
+      if HAS_LZMA and not xz_threads:
+        self.fileobj = lzma.LZMAFile(name,
+                                     mode='w',
+                                     format=lzma.FORMAT_XZ,
+                                     preset=xz_preset)
+      else:
+        # Pipe the tar through xz, which is also how multi-threaded
+        # compression is done.
+        xz_path = xz_path or 'xz'
+        if subprocess.call(['which', xz_path], stdout=subprocess.PIPE):
+          raise self.Error('Cannot handle .xz and .lzma compression: '
+                           'xz not found.')
+        cmd = [xz_path, '--compress', '--stdout', '-%d' % xz_preset]
+        if xz_threads:
+          cmd.append('--threads=%d' % xz_threads)
+        with open(name, 'wb') as out:
+          self.xz_process = subprocess.Popen(cmd,
+                                             stdin=subprocess.PIPE,
+                                             stdout=out)
+        self.fileobj = _CountingWriter(self.xz_process.stdin)
+    self.stream = None
+    if compressed_name or compute_digests:
+      if mode != 'w:':
+        raise self.Error('Cannot compute digests of a bzip2 compressed tar.')
+      compressed_fileobj = None
+      if compressed_name:
+        compressed_fileobj = open(compressed_name, 'wb')
+      self.stream = LayerStream(self.fileobj or open(name, 'wb'),
+                                compressed_fileobj,
+                                compresslevel=compresslevel,
+                                compression_threads=compression_threads)
     self.tar = tarfile.open(
       name=name,
       mode=mode,
-      fileobj=self.fileobj,
+      fileobj=self.stream or self.fileobj,
       # https://github.com/bazelbuild/rules_docker/issues/1602
       format=tarfile.PAX_FORMAT)
     self.members = set([])
@@ -230,12 +993,47 @@ class TarFileWriter(object):
       # Enforce the ending / for directories so we correctly deduplicate.
       info.name += '/'
     if info.name not in self.members:
-      self.tar.addfile(info, fileobj)
+      if not (fileobj is not None and self._add_regular_file(info, fileobj)):
+        self.tar.addfile(info, fileobj)
       self.members.add(info.name)
     elif info.type != tarfile.DIRTYPE:
       print('Duplicate file in archive: %s, '
             'picking first occurrence' % info.name)
 
+  def _add_regular_file(self, info, fileobj):
+    """Add a file read from disk, without copying it through Python buffers.
+
+    This mirrors tarfile.TarFile.addfile: the header is written by tarfile,
+    then the content is moved from the source descriptor to the output one by
+    the kernel. This is only possible when the source is a regular file and
+    the tar is written to a plain file, possibly through a LayerStream.
+
+    Returns:
+      whether the file was added, else tarfile.TarFile.addfile must be used.
+    """
+    if not self.zero_copy or _regular_file_fd(fileobj) is None:
+      return False
+    tar = self.tar
+    if self.stream:
+      if not self.stream.can_copy_file():
+        return False
+    elif _regular_file_fd(tar.fileobj) is None:
+      return False
+    buf = info.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    if self.stream:
+      self.stream.copy_file(fileobj, info.size)
+    else:
+      _copy_file_content(fileobj, tar.fileobj, info.size)
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+      tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+      blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+    tar.members.append(info)
+    return True
+
   def add_file(self,
                name,
                kind=tarfile.REGTYPE,
@@ -247,7 +1045,9 @@ class TarFileWriter(object):
                uname='',
                gname='',
                mtime=None,
-               mode=None):
+               mode=None,
+               fileobj=None,
+               size=None):
     """Add a file to the current tar.
     Args:
       name: the name of the file to add.
@@ -255,13 +1055,15 @@ class TarFileWriter(object):
       content: a textual content to put in the file.
       link: if the file is a link, the destination of the link.
       file_content: file to read the content from. Provide either this
-          one or `content` to specifies a content for the file.
+          one, `content` or `fileobj` to specifies a content for the file.
       uid: owner user identifier.
       gid: owner group identifier.
       uname: owner user names.
       gname: owner group names.
       mtime: modification time to put in the archive.
       mode: unix permission mode of the file, default 0644 (0755).
+      fileobj: file object to read the content from.
+      size: the number of bytes to read from `fileobj`.
     """
     if file_content and posixpath.isdir(file_content):
       # Recurse into directory
@@ -277,9 +1079,14 @@ class TarFileWriter(object):
     if mtime is None:
       mtime = self.default_mtime
 
+    # Create the missing parent directories, topmost first. The walk up stops
+    # at the first one already created, so existing ancestors cost nothing.
+    missing_parents = []
     components = name.rsplit('/', 1)
-    if len(components) > 1:
-      d = components[0]
+    while len(components) > 1 and components[0] not in self.directories:
+      missing_parents.append(components[0])
+      components = components[0].rsplit('/', 1)
+    for d in reversed(missing_parents):
       self.add_file(d,
                     tarfile.DIRTYPE,
                     uid=uid,
@@ -309,21 +1116,123 @@ class TarFileWriter(object):
       with open(file_content, 'rb') as f:
         tarinfo.size = os.fstat(f.fileno()).st_size
         self._addfile(tarinfo, f)
+    elif fileobj is not None:
+      tarinfo.size = size
+      self._addfile(tarinfo, fileobj)
     else:
       if kind == tarfile.DIRTYPE:
         self.directories.add(name)
       self._addfile(tarinfo)
 
+  def add_fileobj(self, name, fileobj, size, **kwargs):
+    """Add a file whose content is read from a file object.
+    Args:
+      name: the name of the file to add.
+      fileobj: the file object to read the content from.
+      size: the number of bytes to read from `fileobj`.
+      **kwargs: the other attributes of the file, see add_file.
+    """
+    self.add_file(name, fileobj=fileobj, size=size, **kwargs)
+
+  def add_bytes(self, name, data, **kwargs):
+    """Add a file with the given content.
+    Args:
+      name: the name of the file to add.
+      data: the content of the file, as bytes.
+      **kwargs: the other attributes of the file, see add_file.
+    """
+    self.add_fileobj(name, io.BytesIO(data), len(data), **kwargs)
+
+  def _add_tar_member(self, tarinfo, fileobj, rootuid, rootgid, numeric,
+                      root):
+    """Adds a member read from another tar, see add_tar."""
+    if not self.preserve_mtime:
+      tarinfo.mtime = self.default_mtime
+    if rootuid is not None and tarinfo.uid == rootuid:
+      tarinfo.uid = 0
+      tarinfo.uname = 'root'
+    if rootgid is not None and tarinfo.gid == rootgid:
+      tarinfo.gid = 0
+      tarinfo.gname = 'root'
+    if numeric:
+      tarinfo.uname = ''
+      tarinfo.gname = ''
+
+    name = tarinfo.name
+    if (not name.startswith('/') and
+        not name.startswith(self.root_directory)):
+      name = posixpath.join(self.root_directory, name)
+    if root is not None:
+      if name.startswith('.'):
+        name = '.' + root + name.lstrip('.')
+        # Add root dir with same permissions if missing. Note that
+        # add_file deduplicates directories and is safe to call here.
+        self.add_file('.' + root,
+                      tarfile.DIRTYPE,
+                      uid=tarinfo.uid,
+                      gid=tarinfo.gid,
+                      uname=tarinfo.uname,
+                      gname=tarinfo.gname,
+                      mtime=tarinfo.mtime,
+                      mode=0o755)
+      # Relocate internal hardlinks as well to avoid breaking them.
+      link = tarinfo.linkname
+      if link.startswith('.') and tarinfo.type == tarfile.LNKTYPE:
+        tarinfo.linkname = '.' + root + link.lstrip('.')
+    tarinfo.name = name
+
+    if 'path' in tarinfo.pax_headers:
+      # Modify the TarInfo's PAX header for the path name. These headers are used to define "long" path names for
+      # files within a tar file. This header is defined within this spec:
+      #     https://en.wikipedia.org/wiki/Tar_(computing)#POSIX.1-2001/pax
+      # When we read a tar file with this path type the tarfile module sets both the TarInfo.name and
+      # pax_headers['path'] so we need to manually update both.
+      tarinfo.pax_headers['path'] = name
+
+    self._addfile(tarinfo, fileobj)
+
+  def _add_raw_tar(self, fileobj, numeric=False):
+    """Merges an uncompressed tar stream, copying its members as raw blocks.
+
+    Members whose name add_tar would change (e.g. to put them under the root
+    directory) are decoded and added by _add_tar_member instead.
+
+    Args:
+      fileobj: the uncompressed tar stream.
+      numeric: set to true to strip out name of owners, see add_tar.
+    """
+    for member in RawTarReader(fileobj):
+      name = member.name
+      if ((not name.startswith('/') and
+           not name.startswith(self.root_directory)) or
+          (member.isdir() and not name.endswith('/'))):
+        tarinfo = member.tarinfo()
+        self._add_tar_member(tarinfo, member if tarinfo.isfile() else None,
+                             None, None, numeric, None)
+      elif name not in self.members:
+        if not self.preserve_mtime:
+          member.set_mtime(self.default_mtime)
+        if numeric:
+          member.clear_owner_names()
+        self.tar.offset += member.write(self.tar.fileobj)
+        self.members.add(name)
+      elif not member.isdir():
+        print('Duplicate file in archive: %s, '
+              'picking first occurrence' % name)
+
   def add_tar(self,
               tar,
               rootuid=None,
               rootgid=None,
               numeric=False,
               name_filter=None,
-              root=None):
+              root=None,
+              fileobj=None):
     """Merge a tar content into the current tar, stripping timestamp.
     Args:
       tar: the name of tar to extract and put content into the current tar.
+          When `fileobj` is given, only used for its extension, which tells
+          the compression of the tar.
       rootuid: user id that we will pretend is root (replaced by uid 0).
       rootgid: group id that we will pretend is root (replaced by gid 0).
       numeric: set to true to strip out name of owners (and just use the
@@ -333,6 +1242,8 @@ class TarFileWriter(object):
           the file is to be added to the final tar and false otherwise.
       root: place all non-absolute content under given root directory, if not
           None.
+      fileobj: if set, the file object to read the tar from, e.g. a member
+          of another archive.
     Raises:
       TarFileWriter.Error: if an error happens when uncompressing the tar file.
     """
@@ -348,101 +1259,109 @@ class TarFileWriter(object):
       compression = 'xz'
     elif compression not in ['gz', 'bz2', 'xz']:
       compression = ''
-    if compression == 'xz':
-      # Python 2 does not support lzma, our py3 support is terrible so let's
-      # just hack around.
-      # Note that we buffer the file in memory and it can have an important
-      # memory footprint but it's probably fine as we don't use them for really
-      # large files.
-      # TODO(dmarting): once our py3 support gets better, compile this tools
-      # with py3 for proper lzma support.
+    xzcat = None
+    feeder = None
+    if compression == 'xz' and not HAS_LZMA:
+      # Without the lzma module, stream the output of xzcat instead: the
+      # tarball is never held in memory and merging starts right away.
       if subprocess.call('which xzcat', shell=True, stdout=subprocess.PIPE):
         raise self.Error('Cannot handle .xz and .lzma compression: '
                          'xzcat not found.')
-      p = subprocess.Popen('cat %s | xzcat' % tar,
-                           shell=True,
-                           stdout=subprocess.PIPE)
-      f = io.BytesIO(p.stdout.read())
-      p.wait()
-      intar = tarfile.open(fileobj=f, mode='r:')
+      if fileobj is None:
+        xzcat = subprocess.Popen(['xzcat', tar], stdout=subprocess.PIPE)
+      else:
+        xzcat = subprocess.Popen(['xzcat'],
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+
+        def feed():
+          try:
+            shutil.copyfileobj(fileobj, xzcat.stdin)
+          finally:
+            xzcat.stdin.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+    if (self.rewrite_headers and rootuid is None and rootgid is None and
+        name_filter is None and root is None):
+      # Read the uncompressed tar as raw blocks.
+      if xzcat:
+        instream = xzcat.stdout
+      elif compression == 'gz':
+        instream = gzip.GzipFile(filename=tar if fileobj is None else None,
+                                 fileobj=fileobj,
+                                 mode='rb')
+      elif compression == 'bz2':
+        instream = bz2.BZ2File(tar if fileobj is None else fileobj)
+      elif compression == 'xz':
+        instream = lzma.LZMAFile(tar if fileobj is None else fileobj)
+      elif fileobj is None:
+        instream = open(tar, 'rb')
+      else:
+        instream = fileobj
+      try:
+        self._add_raw_tar(instream, numeric)
+      finally:
+        if instream is not fileobj and not xzcat:
+          instream.close()
     else:
-      if compression in ['gz', 'bz2']:
-        # prevent performance issues due to accidentally-introduced seeks
-        # during intar traversal by opening in "streaming" mode. gz, bz2
-        # are supported natively by python 2.7 and 3.x
-        inmode = 'r|' + compression
+      if xzcat:
+        intar = tarfile.open(fileobj=xzcat.stdout, mode='r|')
       else:
-        inmode = 'r:' + compression
-      intar = tarfile.open(name=tar, mode=inmode)
-    for tarinfo in intar:
-      if name_filter is None or name_filter(tarinfo.name):
-        if not self.preserve_mtime:
-          tarinfo.mtime = self.default_mtime
-        if rootuid is not None and tarinfo.uid == rootuid:
-          tarinfo.uid = 0
-          tarinfo.uname = 'root'
-        if rootgid is not None and tarinfo.gid == rootgid:
-          tarinfo.gid = 0
-          tarinfo.gname = 'root'
-        if numeric:
-          tarinfo.uname = ''
-          tarinfo.gname = ''
-
-        name = tarinfo.name
-        if (not name.startswith('/') and
-            not name.startswith(self.root_directory)):
-          name = posixpath.join(self.root_directory, name)
-        if root is not None:
-          if name.startswith('.'):
-            name = '.' + root + name.lstrip('.')
-            # Add root dir with same permissions if missing. Note that
-            # add_file deduplicates directories and is safe to call here.
-            self.add_file('.' + root,
-                          tarfile.DIRTYPE,
-                          uid=tarinfo.uid,
-                          gid=tarinfo.gid,
-                          uname=tarinfo.uname,
-                          gname=tarinfo.gname,
-                          mtime=tarinfo.mtime,
-                          mode=0o755)
-          # Relocate internal hardlinks as well to avoid breaking them.
-          link = tarinfo.linkname
-          if link.startswith('.') and tarinfo.type == tarfile.LNKTYPE:
-            tarinfo.linkname = '.' + root + link.lstrip('.')
-        tarinfo.name = name
-
-        if 'path' in tarinfo.pax_headers:
-          # Modify the TarInfo's PAX header for the path name. These headers are used to define "long" path names for
-          # files within a tar file. This header is defined within this spec:
-          #     https://en.wikipedia.org/wiki/Tar_(computing)#POSIX.1-2001/pax
-          # When we read a tar file with this path type the tarfile module sets both the TarInfo.name and
-          # pax_headers['path'] so we need to manually update both.
-          tarinfo.pax_headers['path'] = name
-
-        if tarinfo.isfile():
+        if compression in ['gz', 'bz2', 'xz']:
+          # prevent performance issues due to accidentally-introduced seeks
+          # during intar traversal by opening in "streaming" mode. gz, bz2
+          # are supported natively by python 2.7 and 3.x, xz by python 3.
+          inmode = 'r|' + compression
+        else:
+          inmode = 'r:' + compression
+        if fileobj is None:
+          intar = tarfile.open(name=tar, mode=inmode)
+        else:
+          intar = tarfile.open(fileobj=fileobj, mode=inmode)
+      for tarinfo in intar:
+        if name_filter is None or name_filter(tarinfo.name):
           # use extractfile(tarinfo) instead of tarinfo.name to preserve
           # seek position in intar
-          self._addfile(tarinfo, intar.extractfile(tarinfo))
-        else:
-          self._addfile(tarinfo)
-    intar.close()
+          self._add_tar_member(
+              tarinfo,
+              intar.extractfile(tarinfo) if tarinfo.isfile() else None,
+              rootuid, rootgid, numeric, root)
+      intar.close()
+    if xzcat:
+      # Consume the end-of-archive padding so that xzcat exits cleanly.
+      while xzcat.stdout.read(io.DEFAULT_BUFFER_SIZE):
+        pass
+      xzcat.stdout.close()
+      if feeder:
+        feeder.join()
+      if xzcat.wait():
+        raise self.Error('Cannot uncompress %s: xzcat exited with status %d' %
+                         (tar, xzcat.returncode))
 
   def close(self):
     """Close the output tar file.
-    This class should not be used anymore after calling that method.
+    This class should not be used anymore after calling that method, except
+    to read `diff_id` and `blob_sum`.
     Raises:
       TarFileWriter.Error: if an error happens when compressing the output file.
     """
     self.tar.close()
-    # Close the gzip file object if necessary.
-    if self.fileobj:
+    # Close the output streams (and the compressed file object) if necessary.
+    if self.stream:
+      self.stream.close()
+    elif self.fileobj:
       self.fileobj.close()
-    if self.xz:
-      # Support xz compression through xz... until we can use Py3
-      if subprocess.call('which xz', shell=True, stdout=subprocess.PIPE):
-        raise self.Error('Cannot handle .xz and .lzma compression: '
-                         'xz not found.')
-      subprocess.call(
-          'mv {0} {0}.d && xz -z {0}.d && mv {0}.d.xz {0}'.format(self.name),
-          shell=True,
-          stdout=subprocess.PIPE)
+    if self.xz_process and self.xz_process.wait():
+      raise self.Error('Cannot compress %s: xz exited with status %d' %
+                       (self.name, self.xz_process.returncode))
+
+  @property
+  def diff_id(self):
+    """The hex SHA-256 of the uncompressed tar, None if not computed."""
+    return self.stream.diff_id if self.stream else None
+
+  @property
+  def blob_sum(self):
+    """The hex SHA-256 of the gzipped copy, None if not written."""
+    return self.stream.blob_sum if self.stream else None
@@ -13,15 +13,19 @@
 # limitations under the License.
 """This tool build tar files from a list of inputs."""
 
-from contextlib import contextmanager
 import argparse
+import bz2
+import collections
+import concurrent.futures
 import functools
 import gzip
 import io
+import itertools
 import json
 import os
 import os.path
 import posixpath
+import shutil
 import subprocess
 import sys
 import re
@@ -29,6 +33,7 @@ import tarfile
 import tempfile
 
 import archive
+import layer_cache
 
 class TarFile(object):
   """A class to generates a Docker layer."""
@@ -40,6 +45,8 @@ class TarFile(object):
   DPKG_STATUS_DIR = '/var/lib/dpkg/status.d'
   PKG_METADATA_FILE = 'control'
   PKG_MD5SUMS_FILE = 'md5sums'
+  # Decompressed deb members larger than that are spilled to temporary files.
+  DEB_SPOOL_SIZE = 64 * 1024 * 1024
 
   @staticmethod
   def parse_pkg_name(metadata, filename):
@@ -51,7 +58,10 @@ class TarFile(object):
 
   def __init__(self, output, directory, compression, root_directory,
                default_mtime, enable_mtime_preservation, xz_path,
-               force_posixpath):
+               force_posixpath, emit_compressed=None, emit_diff_id=None,
+               emit_blob_sum=None, emit_compression_level=6,
+               compression_threads=0, xz_preset=6, xz_threads=0,
+               rewrite_tar_headers=False):
     self.directory = directory
     self.output = output
     self.compression = compression
@@ -60,6 +70,16 @@ class TarFile(object):
     self.enable_mtime_preservation = enable_mtime_preservation
     self.xz_path = xz_path
     self.force_posixpath = force_posixpath
+    self.emit_compressed = emit_compressed
+    self.emit_diff_id = emit_diff_id
+    self.emit_blob_sum = emit_blob_sum
+    self.emit_compression_level = emit_compression_level
+    self.compression_threads = compression_threads
+    self.xz_preset = xz_preset
+    self.xz_threads = xz_threads
+    self.rewrite_tar_headers = rewrite_tar_headers
+    if emit_blob_sum and not emit_compressed:
+      raise ValueError('emit_blob_sum requires emit_compressed')
 
   def __enter__(self):
     self.tarfile = archive.TarFileWriter(
@@ -68,11 +88,33 @@ class TarFile(object):
         self.root_directory,
         self.default_mtime,
         self.enable_mtime_preservation,
+        compressed_name=self.emit_compressed,
+        compute_digests=bool(self.emit_diff_id or self.emit_blob_sum),
+        compresslevel=self.emit_compression_level,
+        compression_threads=self.compression_threads,
+        xz_preset=self.xz_preset,
+        xz_threads=self.xz_threads,
+        xz_path=self.xz_path,
+        rewrite_headers=self.rewrite_tar_headers,
     )
     return self
 
   def __exit__(self, t, v, traceback):
     self.tarfile.close()
+    if t is None:
+      self.write_digests()
+
+  def write_digests(self):
+    """Write the digests computed while writing the layer.
+
+    Both files hold the bare hex SHA-256, as the //skylib:hash.bzl actions do.
+    """
+    if self.emit_diff_id:
+      with open(self.emit_diff_id, 'w') as f:
+        f.write(self.tarfile.diff_id)
+    if self.emit_blob_sum:
+      with open(self.emit_blob_sum, 'w') as f:
+        f.write(self.tarfile.blob_sum)
 
   def add_file(self, f, destfile, mode=None, ids=None, names=None):
     """Add a file to the tar file.
@@ -109,6 +151,38 @@ class TarFile(object):
         uname=names[0],
         gname=names[1])
 
+  def add_bytes(self, data, destfile, mode=None, ids=None, names=None):
+    """Add a file with the given content to the tar file.
+
+    Args:
+       data: the content of the file, as bytes
+       destfile: the name of the file in the layer
+       mode: force to set the specified mode, defaults to 644
+       ids: (uid, gid) for the file to set ownership
+       names: (username, groupname) for the file to set ownership.
+    """
+    dest = destfile.lstrip('/')  # Remove leading slashes
+    if self.directory and self.directory != '/':
+      dest = self.directory.lstrip('/') + '/' + dest
+    if mode is None:
+      mode = 0o644
+    if ids is None:
+      ids = (0, 0)
+    if names is None:
+      names = ('', '')
+    if self.force_posixpath:
+        dest = posixpath.normpath(dest)
+    else:
+        dest = os.path.normpath(dest)
+    self.tarfile.add_bytes(
+        dest,
+        data,
+        mode=mode,
+        uid=ids[0],
+        gid=ids[1],
+        uname=names[0],
+        gname=names[1])
+
   def add_empty_file(self, destfile, mode=None, ids=None, names=None,
                      kind=tarfile.REGTYPE):
     """Add a file to the tar file.
@@ -175,7 +249,7 @@ class TarFile(object):
         destpath, mode=mode, ids=ids, names=names)
     self.tarfile.root_directory = original_root_directory
 
-  def add_tar(self, tar):
+  def add_tar(self, tar, fileobj=None):
     """Merge a tar file into the destination tar file.
 
     All files presents in that tar will be added to the output file
@@ -184,11 +258,13 @@ class TarFile(object):
 
     Args:
       tar: the tar file to add
+      fileobj: if set, the file object to read the tar from, `tar` then
+          only tells its compression through its extension.
     """
     root = None
     if self.directory and self.directory != '/':
       root = self.directory
-    self.tarfile.add_tar(tar, numeric=True, root=root)
+    self.tarfile.add_tar(tar, numeric=True, root=root, fileobj=fileobj)
 
   def add_link(self, symlink, destination):
     """Add a symbolic link pointing to `destination`.
@@ -203,33 +279,14 @@ class TarFile(object):
         symlink = os.path.normpath(symlink)
     self.tarfile.add_file(symlink, tarfile.SYMTYPE, link=destination)
 
-  @contextmanager
-  def write_temp_file(self, data, suffix='tar', mode='wb'):
-    # deb(5) states members may optionally be compressed with gzip or xz
-    if suffix.endswith('.gz'):
-      with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
-        data = f.read()
-      suffix = suffix[:-3]
-    elif suffix.endswith('.xz'):
-      data = self._xz_decompress(data)
-      suffix = suffix[:-3]
-
-    (_, tmpfile) = tempfile.mkstemp(suffix=suffix)
-    try:
-      with open(tmpfile, mode=mode) as f:
-        f.write(data)
-      yield tmpfile
-    finally:
-      os.remove(tmpfile)
-
-  def add_pkg_metadata(self, metadata_tar, deb):
+  def add_pkg_metadata(self, metadata_tar, deb, fileobj=None):
     """
     Extract the package ``control`` metadata file from a Debian `metadata_tar`
     tarball file to the status.d directory. Also extract the ``md5sums`` files
-    list file if present.
+    list file if present. If `fileobj` is set, the tarball is read from it.
     """
     try:
-      with tarfile.open(metadata_tar) as tar:
+      with tarfile.open(name=metadata_tar, fileobj=fileobj) as tar:
         tar_members = tar.getmembers()
         # Metadata is expected to be in a file.
         control_file_member = list(filter(lambda f: os.path.basename(f.name) == TarFile.PKG_METADATA_FILE, tar_members))
@@ -239,8 +296,7 @@ class TarFile(object):
         metadata = control_file.read()
         pkg_name = TarFile.parse_pkg_name(metadata.decode('utf-8'), deb)
         destination_file = os.path.join(TarFile.DPKG_STATUS_DIR, pkg_name)
-        with self.write_temp_file(data=metadata) as metadata_file:
-          self.add_file(metadata_file, destination_file)
+        self.add_bytes(metadata, destination_file)
 
         # Extract the md5sums file listing of package files if present
         md5sums_file_member = list(filter(lambda f: os.path.basename(f.name) == TarFile.PKG_MD5SUMS_FILE, tar_members))
@@ -248,8 +304,7 @@ class TarFile(object):
             md5sums_file = tar.extractfile(md5sums_file_member[0])
             md5sums = md5sums_file.read()
             destination_file = os.path.join(TarFile.DPKG_STATUS_DIR, '{0}.md5sums'.format(pkg_name))
-            with self.write_temp_file(data=md5sums) as files_list:
-              self.add_file(files_list, destination_file)
+            self.add_bytes(md5sums, destination_file)
 
     except (KeyError, TypeError) as e:
       raise self.DebError(deb + ' contains invalid Metadata! Exception {0}'.format(e))
@@ -270,29 +325,131 @@ class TarFile(object):
     Raises:
       DebError: if the format of the deb archive is incorrect.
     """
-    pkg_data_found = False
-    pkg_metadata_found = False
     with archive.SimpleArFile(deb) as arfile:
+      self._add_deb_members(deb, self._deb_members(arfile))
+
+  def add_debs(self, debs, jobs=1):
+    """Extract debian packages in the output tar, in order.
+
+    With more than one job, the packages are read and their members
+    decompressed ahead by a pool of threads (zlib and lzma release the GIL
+    while decompressing), while they are added to the output tar one at a
+    time, in order. The output is thus the same whatever the number of jobs.
+    Up to jobs + 1 decompressed packages are pending, each holding at most
+    DEB_SPOOL_SIZE bytes per member in memory, and the rest in temporary files.
+
+    Args:
+      debs: the debian packages to add
+      jobs: the number of packages to decompress concurrently
+
+    Raises:
+      DebError: if the format of a deb archive is incorrect.
+    """
+    if jobs <= 1:
+      for deb in debs:
+        self.add_deb(deb)
+      return
+    debs = iter(debs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      # Bound the number of decompressed packages held in memory.
+      pending = collections.deque(
+          (deb, executor.submit(self.decode_deb, deb))
+          for deb in itertools.islice(debs, jobs + 1))
+      while pending:
+        deb, members = pending.popleft()
+        for next_deb in itertools.islice(debs, 1):
+          pending.append((next_deb, executor.submit(self.decode_deb, next_deb)))
+        members = members.result()
+        try:
+          self._add_deb_members(deb, members)
+        finally:
+          for _, f in members:
+            f.close()
+
+  def decode_deb(self, deb):
+    """Read and decompress the members of a debian package.
+
+    Args:
+      deb: the debian package to read
+
+    Returns:
+      the list of (name, file object) of the data and control members,
+      uncompressed into spooled temporary files, see DEB_SPOOL_SIZE.
+    """
+    with archive.SimpleArFile(deb) as arfile:
+      return [self._decompress_member(name, f)
+              for name, f in self._deb_members(arfile)
+              if name.split('.')[0] in ['data', 'control']]
+
+  def _deb_members(self, arfile):
+    """Yields the (name, file object) of the members of a debian package."""
+    current = arfile.next()
+    while current:
+      parts = current.filename.split('.')
+      if parts[-1].lower() == 'xz' and not archive.HAS_LZMA:
+        # Without lzma, decompress the member with xz up front.
+        yield ('.'.join(parts[:-1]),
+               io.BytesIO(self._xz_decompress(current.data)))
+      else:
+        yield current.filename, current.open()
       current = arfile.next()
-      while current:
-        parts = current.filename.split(".")
-        name = parts[0]
-        if parts[-1].lower() == 'xz':
-          current.data = self._xz_decompress(current.data)
-          ext = '.'.join(parts[1:-1])
-        else:
-            ext = '.'.join(parts[1:])
-        if name == 'data':
-          pkg_data_found = True
-          # Add pkg_data to image tar
-          with self.write_temp_file(suffix=ext, data=current.data) as tmpfile:
-            self.add_tar(tmpfile)
-        elif name == 'control':
-          pkg_metadata_found = True
-          # Add metadata file to image tar
-          with self.write_temp_file(suffix=ext, data=current.data) as tmpfile:
-            self.add_pkg_metadata(metadata_tar=tmpfile, deb=deb)
-        current = arfile.next()
+
+  def _decompress_member(self, name, f):
+    """Decompresses a deb member, returns its uncompressed (name, file).
+
+    The member is decompressed in chunks, into a file which stays in memory
+    up to DEB_SPOOL_SIZE bytes.
+    """
+    # deb(5) states members may optionally be compressed with gzip or xz
+    parts = name.split('.')
+    compression = parts[-1].lower()
+    if compression == 'gz':
+      src = gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == 'xz' and archive.HAS_LZMA:
+      src = archive.lzma.LZMAFile(f)
+    elif compression == 'xz':
+      src = io.BytesIO(self._xz_decompress(f.read()))
+    elif compression == 'bz2':
+      src = bz2.BZ2File(f)
+    else:
+      src = f
+    if src is not f:
+      name = '.'.join(parts[:-1])
+    out = tempfile.SpooledTemporaryFile(max_size=self.DEB_SPOOL_SIZE)
+    try:
+      shutil.copyfileobj(src, out, 1024 * 1024)
+      out.seek(0)
+    except Exception:
+      out.close()
+      raise
+    finally:
+      if src is not f:
+        src.close()
+    return name, out
+
+  def _add_deb_members(self, deb, members):
+    """Add the data and control members of a debian package.
+
+    Args:
+      deb: the debian package, for error messages
+      members: iterable of (name, file object) of the package members
+
+    Raises:
+      DebError: if the package lacks a data or a control member.
+    """
+    pkg_data_found = False
+    pkg_metadata_found = False
+    for member_name, member in members:
+      name = member_name.split('.')[0]
+      if name == 'data':
+        pkg_data_found = True
+        # Stream pkg_data from the deb to the image tar
+        self.add_tar(member_name, fileobj=member)
+      elif name == 'control':
+        pkg_metadata_found = True
+        # Add metadata file to image tar
+        self.add_pkg_metadata(metadata_tar=member_name, deb=deb,
+                              fileobj=member)
 
     if not pkg_data_found:
       raise self.DebError(deb + ' does not contains a data file!')
@@ -325,7 +482,52 @@ class TarFile(object):
     return decompress(data)
 
 
+# Flags which do not change the content of the outputs.
+_UNCACHED_FLAGS = frozenset([
+    'output', 'emit_compressed', 'emit_diff_id', 'emit_blob_sum', 'jobs',
+    'xz_path', 'cache_dir', 'cache_max_size',
+])
+
+
+def cache_outputs(FLAGS):
+  """Returns the outputs of the build, as a dict from their flag name."""
+  outputs = {}
+  for flag in ['output', 'emit_compressed', 'emit_diff_id', 'emit_blob_sum']:
+    if getattr(FLAGS, flag):
+      outputs[flag] = getattr(FLAGS, flag)
+  return outputs
+
+
+def cache_key(FLAGS):
+  """Returns the layer cache key of the build, see layer_cache.compute_key."""
+  inputs = [f.split('=', 1)[0] for f in FLAGS.file] + FLAGS.tar + FLAGS.deb
+  manifest = None
+  if FLAGS.manifest:
+    with open(FLAGS.manifest, 'r') as f:
+      manifest = json.load(f)
+    inputs += [f['src'] for f in manifest.get('files', [])]
+    inputs += manifest.get('tars', []) + manifest.get('debs', [])
+  flags = dict((k, v) for (k, v) in vars(FLAGS).items()
+               if k not in _UNCACHED_FLAGS)
+  # The manifest content is part of the key, not its path.
+  flags['manifest'] = manifest
+  return layer_cache.compute_key(flags, inputs)
+
+
 def main(FLAGS):
+  if not FLAGS.cache_dir:
+    build(FLAGS)
+    return
+  cache = layer_cache.LayerCache(FLAGS.cache_dir, FLAGS.cache_max_size)
+  key = cache_key(FLAGS)
+  outputs = cache_outputs(FLAGS)
+  if cache.fetch(key, outputs):
+    return
+  build(FLAGS)
+  cache.publish(key, outputs)
+
+
+def build(FLAGS):
   # Parse modes arguments
   default_mode = None
   if FLAGS.mode:
@@ -367,7 +569,11 @@ def main(FLAGS):
   with TarFile(FLAGS.output, FLAGS.directory, FLAGS.compression,
                FLAGS.root_directory, FLAGS.mtime,
                FLAGS.enable_mtime_preservation, FLAGS.xz_path,
-               FLAGS.force_posixpath) as output:
+               FLAGS.force_posixpath, FLAGS.emit_compressed,
+               FLAGS.emit_diff_id, FLAGS.emit_blob_sum,
+               FLAGS.emit_compression_level,
+               FLAGS.compression_threads, FLAGS.xz_preset,
+               FLAGS.xz_threads, FLAGS.rewrite_tar_headers) as output:
     def file_attributes(filename):
       if filename.startswith('/'):
         filename = filename[1:]
@@ -392,8 +598,7 @@ def main(FLAGS):
           output.add_link(f['linkname'], f['target'])
         for tar in manifest.get('tars', []):
           output.add_tar(tar)
-        for deb in manifest.get('debs', []):
-          output.add_deb(deb)
+        output.add_debs(manifest.get('debs', []), FLAGS.jobs)
 
     for f in FLAGS.file:
       (inf, tof) = f.split('=', 1)
@@ -406,8 +611,7 @@ def main(FLAGS):
       output.add_empty_root_dir(f, **file_attributes(f))
     for tar in FLAGS.tar:
       output.add_tar(tar)
-    for deb in FLAGS.deb:
-      output.add_deb(deb)
+    output.add_debs(FLAGS.deb, FLAGS.jobs)
     for link in FLAGS.link:
       l = link.split(':', 1)
       output.add_link(l[0], l[1])
@@ -452,6 +656,11 @@ if __name__ == '__main__':
   parser.add_argument('--deb', type=str, default=[], action='append',
     help='A debian package to add to the layer')
 
+  parser.add_argument('--jobs', type=int, default=1,
+    help='Number of debian packages to decompress concurrently. The output'
+    ' does not depend on it. Each pending package keeps up to 64 MiB per'
+    ' decompressed member in memory, and the rest in temporary files.')
+
   def validate_link(l):
     if not all([value.find(':') > 0 for value in l]):
       raise argparse.ArgumentTypeError(msg)
@@ -464,7 +673,12 @@ if __name__ == '__main__':
     help='Directory in which to store the file inside the layer')
 
   parser.add_argument('--compression', type=str,
-    help='Compression (`gz` or `bz2`), default is none.')
+    help='Compression (`gz`, `bz2` or `xz`), default is none.')
+
+  parser.add_argument('--compression_threads', type=int, default=0,
+    help='Compress gzip outputs in parallel blocks with that many threads.'
+    ' The output is identical for any number of threads, but differs from'
+    ' the default single-threaded output.')
 
   parser.add_argument('--modes', type=str, default=None, action='append',
     help='Specific mode to apply to specific file (from the file argument),'
@@ -491,8 +705,45 @@ if __name__ == '__main__':
     help='Specify the path to xz as a fallback when the Python '
     'lzma module is unavailable.')
 
+  parser.add_argument('--xz_preset', type=int, default=6,
+    help='The xz compression preset, from 0 to 9.')
+
+  parser.add_argument('--xz_threads', type=int, default=0,
+    help='Compress xz outputs with that many threads, using the xz binary.'
+    ' By default xz outputs are compressed in-process, single-threaded.')
+
+  parser.add_argument('--rewrite_tar_headers', action='store_true',
+    help='Merge --tar inputs by patching the mtime and owner names of their'
+    ' raw headers rather than re-encoding them, which is much faster for'
+    ' large tars. Inputs put under --directory are still re-encoded.'
+    ' Their headers are otherwise kept as they are, e.g. in the GNU format.')
+
   parser.add_argument('--force_posixpath', type=bool, default=False,
     help='Force the use of posixpath when normalizing file paths. This is useful'
     'when building in a non-posix environment.')
 
+  parser.add_argument('--emit_compressed', type=str,
+    help='Also write a gzipped copy of the layer to this file, in the same'
+    ' pass as the layer itself.')
+
+  parser.add_argument('--emit_compression_level', type=int, default=6,
+    help='The gzip compression level of --emit_compressed.')
+
+  parser.add_argument('--emit_diff_id', type=str,
+    help='Write the sha256 of the uncompressed layer to this file.')
+
+  parser.add_argument('--emit_blob_sum', type=str,
+    help='Write the sha256 of --emit_compressed to this file.')
+
+  parser.add_argument('--cache_dir', type=str,
+    default=os.environ.get('BUILD_TAR_CACHE_DIR'),
+    help='A local directory caching the outputs by the digests of the'
+    ' manifest, flags and inputs. It may be shared by concurrent builds.'
+    ' Defaults to $BUILD_TAR_CACHE_DIR, which layer rules pass through with'
+    ' --action_env (sandboxed builds also need --sandbox_writable_path).')
+
+  parser.add_argument('--cache_max_size', type=int,
+    help='The maximum size of --cache_dir in bytes, least recently used'
+    ' outputs are evicted above it. Unbounded by default.')
+
   main(parser.parse_args())
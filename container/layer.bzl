@@ -46,6 +46,24 @@ _DOC = "A rule that assembles data into a tarball which can be use as in layers
 
 _DEFAULT_MTIME = -1
 
+# gzip command-line options understood by build_tar's single-pass compression.
+_GZIP_LEVEL_OPTIONS = {
+    "--best": 9,
+    "--fast": 1,
+    "-1": 1,
+    "-2": 2,
+    "-3": 3,
+    "-4": 4,
+    "-5": 5,
+    "-6": 6,
+    "-7": 7,
+    "-8": 8,
+    "-9": 9,
+}
+
+# The default compression level of gzip, used when no option is given.
+_GZIP_DEFAULT_LEVEL = 6
+
 def _magic_path(ctx, f, output_layer):
     # Right now the logic this uses is a bit crazy/buggy, so to support
     # bug-for-bug compatibility in the foo_image rules, expose the logic.
@@ -79,9 +97,14 @@ def build_layer(
         symlinks = None,
         debs = None,
         tars = None,
-        operating_system = None):
+        operating_system = None,
+        compression_level = None):
     """Build the current layer for appending it to the base layer
 
+    When `compression_level` is set, the layer is also gzipped at that level
+    and both digests are computed by build_tar, in the same pass that writes the
+    layer. Otherwise only the layer and its diff_id are produced.
+
     Args:
        ctx: The context
        name: The name of the layer
@@ -95,9 +118,12 @@ def build_layer(
        debs: List of debian package tar files
        tars: List of tar files
        operating_system: The OS (e.g., 'linux', 'windows')
+       compression_level: int, gzip level of the single-pass compressed layer
 
     Returns:
-       the layer tar and its sha256 digest
+       the layer tar and its sha256 digest, or when `compression_level` is
+       set, the layer tar, its sha256 digest, the gzipped layer and its
+       sha256 digest
 
     """
     toolchain_info = ctx.toolchains["@io_bazel_rules_docker//toolchains/docker:toolchain_type"].info
@@ -160,16 +186,57 @@ def build_layer(
     ctx.actions.write(manifest_file, json.encode(manifest))
     args.add(manifest_file, format = "--manifest=%s")
 
+    # The digest and compressed outputs are named like the ones of the
+    # standalone //skylib:hash.bzl and //skylib:zip.bzl actions.
+    diff_id = ctx.actions.declare_file(layer.basename + ".sha256")
+    args.add(diff_id, format = "--emit_diff_id=%s")
+    outputs = [layer, diff_id]
+    if compression_level != None:
+        zipped_layer = ctx.actions.declare_file(layer.basename + ".gz")
+        blob_sum = ctx.actions.declare_file(zipped_layer.basename + ".sha256")
+        args.add(zipped_layer, format = "--emit_compressed=%s")
+        args.add(compression_level, format = "--emit_compression_level=%s")
+        args.add(blob_sum, format = "--emit_blob_sum=%s")
+        outputs += [zipped_layer, blob_sum]
+
     ctx.actions.run(
         executable = build_layer_exec,
         arguments = [args],
         input_manifests = xz_input_manifests,
         tools = files + file_map.values() + tars + debs + [manifest_file] + xz_tools,
-        outputs = [layer],
+        outputs = outputs,
         use_default_shell_env = True,
         mnemonic = "ImageLayer",
     )
-    return layer, _sha256(ctx, layer)
+    if compression_level != None:
+        return layer, diff_id, zipped_layer, blob_sum
+    return layer, diff_id
+
+def _single_pass_compression_level(ctx, compression, compression_options):
+    """Returns the gzip level build_tar should compress the layer with.
+
+    Args:
+       ctx: The bazel rule context
+       compression: str, compression mode, eg "gzip"
+       compression_options: str list, command-line options for the compression tool
+
+    Returns:
+       the gzip level, or None when the layer must be compressed by zip_layer,
+       i.e. unless single_pass_compression is set, for other compression
+       methods, options build_tar does not understand, or a gzip tool
+       explicitly configured in the toolchain.
+    """
+    if not ctx.attr.single_pass_compression or compression != "gzip":
+        return None
+    toolchain_info = ctx.toolchains["@io_bazel_rules_docker//toolchains/docker:toolchain_type"].info
+    if toolchain_info.gzip_path or toolchain_info.gzip_target:
+        return None
+    level = _GZIP_DEFAULT_LEVEL
+    for option in compression_options or []:
+        if option not in _GZIP_LEVEL_OPTIONS:
+            return None
+        level = _GZIP_LEVEL_OPTIONS[option]
+    return level
 
 def zip_layer(ctx, layer, compression = "", compression_options = None):
     """Generate the zipped filesystem layer, and its sha256 (aka blob sum)
@@ -243,29 +310,49 @@ def _impl(
     tars = tars or ctx.files.tars
     output_layer = output_layer or ctx.outputs.layer
 
-    # Generate the unzipped filesystem layer, and its sha256 (aka diff_id)
-    unzipped_layer, diff_id = build_layer(
-        ctx,
-        name = name,
-        output_layer = output_layer,
-        files = files,
-        file_map = file_map,
-        empty_files = empty_files,
-        empty_dirs = empty_dirs,
-        directory = directory,
-        symlinks = symlinks,
-        debs = debs,
-        tars = tars,
-        operating_system = operating_system,
-    )
+    compression_level = _single_pass_compression_level(ctx, compression, compression_options)
+    if compression_level != None:
+        # Generate the unzipped filesystem layer, its sha256 (aka diff_id), the
+        # zipped filesystem layer and its sha256 (aka blob sum) in one pass.
+        unzipped_layer, diff_id, zipped_layer, blob_sum = build_layer(
+            ctx,
+            name = name,
+            output_layer = output_layer,
+            files = files,
+            file_map = file_map,
+            empty_files = empty_files,
+            empty_dirs = empty_dirs,
+            directory = directory,
+            symlinks = symlinks,
+            debs = debs,
+            tars = tars,
+            operating_system = operating_system,
+            compression_level = compression_level,
+        )
+    else:
+        # Generate the unzipped filesystem layer, and its sha256 (aka diff_id)
+        unzipped_layer, diff_id = build_layer(
+            ctx,
+            name = name,
+            output_layer = output_layer,
+            files = files,
+            file_map = file_map,
+            empty_files = empty_files,
+            empty_dirs = empty_dirs,
+            directory = directory,
+            symlinks = symlinks,
+            debs = debs,
+            tars = tars,
+            operating_system = operating_system,
+        )
 
-    # Generate the zipped filesystem layer, and its sha256 (aka blob sum)
-    zipped_layer, blob_sum = zip_layer(
-        ctx,
-        unzipped_layer,
-        compression = compression,
-        compression_options = compression_options,
-    )
+        # Generate the zipped filesystem layer, and its sha256 (aka blob sum)
+        zipped_layer, blob_sum = zip_layer(
+            ctx,
+            unzipped_layer,
+            compression = compression,
+            compression_options = compression_options,
+        )
 
     # Returns constituent parts of the Container layer as provider:
     # - in container_image rule, we need to use all the following information,
@@ -357,6 +444,20 @@ _layer_attrs = dicts.add({
         mandatory = False,
     ),
     "portable_mtime": attr.bool(default = False),
+    "single_pass_compression": attr.bool(
+        default = False,
+        doc = """Compress the layer with gzip as it is built, in build_tar.
+
+        The layer, its gzipped blob and both their digests are then written
+        in a single pass, rather than by separate zip and hash actions. Only
+        applies to `compression = "gzip"` with no gzip tool configured in the
+        toolchain, and with `compression_options` among `--fast`, `--best`
+        and `-1`..`-9` (the default level being 6).
+
+        The gzip stream differs from the one of the default compressor, so
+        the blob sums of the layers, and the digests of the image manifests,
+        change when this is enabled.""",
+    ),
     "symlinks": attr.string_dict(
         doc = """Symlinks to create in the Docker image.
 
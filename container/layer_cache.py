@@ -0,0 +1,236 @@
+# Copyright 2017 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local, content-addressed cache of the outputs of the build_tar tool.
+
+Entries are directories named after the key of the build, holding one file per
+output. They are published atomically by renaming a complete temporary
+directory (or, when the entry exists, by renaming each of the outputs it lacks
+into it), so concurrent builds sharing a cache directory (e.g. on a shared
+volume) never see partial outputs. Fetching an entry touches it, and the least
+recently used entries are evicted when the cache grows over its maximum size.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+_BUF_SIZE = 1024 * 1024
+
+# Bump when the layout of entries or the way keys are computed changes.
+_CACHE_VERSION = 2
+
+# The sources of build_tar, whose changes may change its outputs.
+_TOOL_SOURCES = ['archive.py', 'build_tar.py', 'layer_cache.py']
+
+# The digest of _TOOL_SOURCES, see _tool_digest.
+_TOOL_DIGEST = None
+
+
+def digest_path(path):
+  """Returns the hex SHA-256 of a file's content, or of a directory's tree.
+
+  Directories are hashed from the sorted names, executable bits and digests of
+  their content, which is what build_tar copies to the layer. Like
+  TarFileWriter.add_dir, symlinks to directories are followed; a directory
+  already walked through another link is only hashed by name.
+  """
+  h = hashlib.sha256()
+  if os.path.isdir(path):
+    walked = set()
+    for root, dirs, files in os.walk(path, followlinks=True):
+      walked.add(os.path.realpath(root))
+      names = sorted(dirs + files)
+      dirs[:] = sorted(
+          d for d in dirs
+          if os.path.realpath(os.path.join(root, d)) not in walked)
+      for name in names:
+        p = os.path.join(root, name)
+        h.update(os.path.relpath(p, path).encode('utf-8') + b'\0')
+        h.update(b'x' if os.access(p, os.X_OK) else b'-')
+        if not os.path.isdir(p):
+          h.update(digest_path(p).encode('utf-8'))
+  elif os.path.exists(path):
+    h.update(b'x' if os.access(path, os.X_OK) else b'-')
+    with open(path, 'rb') as f:
+      while True:
+        buf = f.read(_BUF_SIZE)
+        if not buf:
+          break
+        h.update(buf)
+  else:
+    h.update(b'missing')
+  return h.hexdigest()
+
+
+def _tool_digest():
+  """Returns the digest of the sources of build_tar, computed once."""
+  global _TOOL_DIGEST
+  if _TOOL_DIGEST is None:
+    directory = os.path.dirname(os.path.abspath(__file__))
+    _TOOL_DIGEST = hashlib.sha256(''.join(
+        digest_path(os.path.join(directory, source))
+        for source in _TOOL_SOURCES).encode('utf-8')).hexdigest()
+  return _TOOL_DIGEST
+
+
+def compute_key(config, inputs):
+  """Returns the cache key of a build.
+
+  The key covers the sources of build_tar too, so that entries written by
+  another version of the tool are not reused.
+
+  Args:
+    config: JSON-serializable description of the build, e.g. its flags and
+        manifest.
+    inputs: the paths of the files and directories the build reads.
+  """
+  key = {
+      'version': _CACHE_VERSION,
+      'tool': _tool_digest(),
+      'config': config,
+      'inputs': dict((p, digest_path(p)) for p in sorted(set(inputs))),
+  }
+  return hashlib.sha256(
+      json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dst):
+  """Hardlinks `src` to `dst`, copying it when hardlinks are not possible."""
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+
+def remove_outputs(outputs):
+  """Removes output files, which may be hardlinks to cache entries.
+
+  Outputs must be removed rather than truncated before being rewritten, not to
+  corrupt the entries they may be linked to.
+  """
+  for path in outputs.values():
+    try:
+      os.unlink(path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+
+class LayerCache(object):
+  """A local, content-addressed cache of build outputs."""
+
+  def __init__(self, directory, max_size=None):
+    """Constructor.
+
+    Args:
+      directory: the directory of the cache, created if needed.
+      max_size: the maximum size of the cache in bytes, unbounded if None.
+    """
+    self.directory = directory
+    self.max_size = max_size
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def _entry(self, key):
+    return os.path.join(self.directory, key)
+
+  def fetch(self, key, outputs):
+    """Writes the outputs of a build from the cache.
+
+    Args:
+      key: the key of the build, see compute_key.
+      outputs: dict from output names to the paths to write them to.
+
+    Returns:
+      whether the build was cached, in which case all the outputs were written.
+    """
+    entry = self._entry(key)
+    remove_outputs(outputs)
+    try:
+      for name, path in outputs.items():
+        _link_or_copy(os.path.join(entry, name), path)
+      # Mark the entry as recently used.
+      os.utime(entry, None)
+    except (IOError, OSError):
+      # Missing, or evicted while fetched.
+      remove_outputs(outputs)
+      return False
+    return True
+
+  def publish(self, key, outputs):
+    """Adds the outputs of a build to the cache.
+
+    Args:
+      key: the key of the build, see compute_key.
+      outputs: dict from output names to the paths of the built outputs.
+    """
+    entry = self._entry(key)
+    tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+    try:
+      for name, path in outputs.items():
+        _link_or_copy(path, os.path.join(tmp, name))
+      os.rename(tmp, entry)
+    except OSError as e:
+      if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+        raise
+      # Another build published the entry first, maybe with other outputs
+      # (e.g. without the compressed layer): add the ones it lacks, each one
+      # atomically.
+      self._merge(tmp, entry, outputs)
+    finally:
+      if os.path.isdir(tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+    self.evict()
+
+  def _merge(self, tmp, entry, outputs):
+    """Moves the outputs missing from an existing entry into it."""
+    try:
+      for name in outputs:
+        if not os.path.exists(os.path.join(entry, name)):
+          os.rename(os.path.join(tmp, name), os.path.join(entry, name))
+    except OSError as e:
+      # The entry was evicted meanwhile.
+      if e.errno != errno.ENOENT:
+        raise
+
+  def evict(self):
+    """Removes the least recently used entries over the maximum size."""
+    if self.max_size is None:
+      return
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      if name.startswith('.'):
+        continue
+      entry = self._entry(name)
+      try:
+        mtime = os.stat(entry).st_mtime
+        size = sum(os.lstat(os.path.join(entry, f)).st_size
+                   for f in os.listdir(entry))
+      except OSError:
+        continue
+      entries.append((mtime, size, entry))
+      total += size
+    for _, size, entry in sorted(entries):
+      if total <= self.max_size:
+        break
+      shutil.rmtree(entry, ignore_errors=True)
+      total -= size
@@ -13,43 +13,89 @@
 # limitations under the License.
 """Compares the ids of the given valid image tarballs.
 
-usage: compare_ids_test.py [-h] [--id ID] tars [tars ...]
+usage: compare_ids_test.py [-h] [--id ID] [--jobs JOBS] [--fail_fast]
+                           tars [tars ...]
 
 positional arguments:
   tars
 
 optional arguments:
-  -h, --help  show this help message and exit
+  -h, --help   show this help message and exit
   --id ID
+  --jobs JOBS  number of tarballs to read concurrently
+  --fail_fast  stop at the first mismatch rather than reporting all of them
 
 Used in compare_ids_test.bzl
   More info can be found there
 
 """
 import argparse
+import collections
+import concurrent.futures
 
 from extract_image_id import get_id
 
 
-def compare_ids(tars, id_=None):
+def _mismatch_report(tars, ids, id_, skipped):
+  """Returns the report of mismatching ids, grouped by id.
+
+  Args:
+    tars: list of str paths to the image tarballs, in the order to report them
+    ids: dict from the paths of the compared tarballs to their id
+    id_: the expected id, or None if the tarballs should all have the same one
+    skipped: the number of tarballs which were not compared
+  """
+  groups = collections.OrderedDict()
+  for tar in tars:
+    if tar in ids:
+      groups.setdefault(ids[tar], []).append(tar)
+  lines = ["Digest mismatch: {} distinct ids among {} tarballs{}".format(
+      len(groups), len(ids),
+      ", expected {}".format(id_) if id_ is not None else "")]
+  for current_id, group in groups.items():
+    lines.append("  {}{}: {}".format(
+        current_id, " (expected)" if current_id == id_ else "",
+        ", ".join(group)))
+  if skipped:
+    lines.append("Stopped at the first mismatch, {} tarballs were not "
+                 "compared".format(skipped))
+  return "\n".join(lines)
+
+
+def compare_ids(tars, id_=None, jobs=None, fail_fast=False):
   """Compares the ids of the given valid image tarballs.
 
+  Tarballs are read concurrently, and only their manifest is read.
+
   Args:
     tars: list of str paths to the image tarballs
     id_: (optional) the id we want the images to have
           if None, just makes sure they are all the same
+    jobs: (optional) the number of tarballs to read concurrently, see
+          concurrent.futures.ThreadPoolExecutor for the default
+    fail_fast: whether to stop at the first mismatch, rather than reading all
+          the tarballs to report all mismatches
   Raises:
     RuntimeError: Expected digest did not match actual image digest
   """
-  for image in tars:
-    current_id = get_id(image)
-    if id_ is None:
-      id_ = current_id
-    elif current_id != id_:
-      raise RuntimeError("Digest mismatch: actual {} vs expected {}".format(
-          current_id,
-          id_
-          ))
+  ids = {}
+  mismatch = False
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = dict((executor.submit(get_id, tar), tar) for tar in tars)
+    for future in concurrent.futures.as_completed(futures):
+      current_id = future.result()
+      ids[futures[future]] = current_id
+      if id_ is not None:
+        mismatch = mismatch or current_id != id_
+      else:
+        mismatch = len(set(ids.values())) > 1
+      if mismatch and fail_fast:
+        for f in futures:
+          f.cancel()
+        break
+  if mismatch:
+    raise RuntimeError(_mismatch_report(tars, ids, id_,
+                                        len(set(tars) - set(ids))))
 
 
 if __name__ == "__main__":
@@ -57,7 +103,12 @@ if __name__ == "__main__":
 
   parser.add_argument("tars", nargs="+", type=str, default=[])
   parser.add_argument("--id", type=str, default=None)
+  parser.add_argument("--jobs", type=int, default=None,
+                      help="number of tarballs to read concurrently")
+  parser.add_argument("--fail_fast", action="store_true",
+                      help="stop at the first mismatch rather than reporting "
+                      "all of them")
 
   args = parser.parse_args()
 
-  compare_ids(args.tars, args.id)
+  compare_ids(args.tars, args.id, jobs=args.jobs, fail_fast=args.fail_fast)
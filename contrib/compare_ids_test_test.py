@@ -0,0 +1,96 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for compare_ids_test."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import compare_ids_test
+from image_tarball_testutil import layer_tar
+from image_tarball_testutil import write_image_tarball
+
+
+class FakeIds(object):
+  """Serves the ids of tarballs from a map, recording the ones read."""
+
+  def __init__(self, ids, delay=0):
+    self.ids = ids
+    self.delay = delay
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def get_id(self, tar):
+    with self.lock:
+      first = not self.calls
+      self.calls.append(tar)
+    if not first:
+      # Leaves time to cancel the tarballs not read yet.
+      time.sleep(self.delay)
+    return self.ids[tar]
+
+
+class CompareIdsTest(unittest.TestCase):
+
+  def test_same_ids(self):
+    tmp = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR"))
+    tars = [os.path.join(tmp, "{}.tar".format(i)) for i in range(3)]
+    for tar in tars:
+      (image_id, _) = write_image_tarball(tar, [layer_tar([("a", b"a")])])
+    compare_ids_test.compare_ids(tars)
+    compare_ids_test.compare_ids(tars, image_id, jobs=2)
+    with self.assertRaises(RuntimeError):
+      compare_ids_test.compare_ids(tars, "0" * 64)
+
+  def test_mismatch_report(self):
+    fake = FakeIds({"a1": "A", "b1": "B", "a2": "A", "c1": "C"})
+    with mock.patch.object(compare_ids_test, "get_id", fake.get_id):
+      with self.assertRaises(RuntimeError) as e:
+        compare_ids_test.compare_ids(["a1", "b1", "a2", "c1"])
+      self.assertEqual(
+          "Digest mismatch: 3 distinct ids among 4 tarballs\n"
+          "  A: a1, a2\n"
+          "  B: b1\n"
+          "  C: c1", str(e.exception))
+
+      with self.assertRaises(RuntimeError) as e:
+        compare_ids_test.compare_ids(["a1", "b1", "a2"], "B")
+      self.assertEqual(
+          "Digest mismatch: 2 distinct ids among 3 tarballs, expected B\n"
+          "  A: a1, a2\n"
+          "  B (expected): b1", str(e.exception))
+
+  def test_fail_fast(self):
+    tars = ["a", "b"] + ["c{}".format(i) for i in range(8)]
+    ids = dict((tar, "A") for tar in tars)
+    ids["b"] = "B"
+    fake = FakeIds(ids, delay=0.2)
+    with mock.patch.object(compare_ids_test, "get_id", fake.get_id):
+      with self.assertRaises(RuntimeError) as e:
+        compare_ids_test.compare_ids(tars, "A", jobs=1, fail_fast=True)
+    # The tarballs after the mismatch were cancelled, but the one being read.
+    self.assertLessEqual(len(fake.calls), 3)
+    self.assertEqual(
+        "Digest mismatch: 2 distinct ids among 2 tarballs, expected A\n"
+        "  A (expected): a\n"
+        "  B: b\n"
+        "Stopped at the first mismatch, 8 tarballs were not compared",
+        str(e.exception))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -18,9 +18,9 @@ Takes one argument, the path to the tarball.
 
 
 from __future__ import print_function
-from json import JSONDecoder
 import sys
-import tarfile
+
+from image_tarball import ImageTarball
 
 
 def get_id(tar_path):
@@ -34,12 +34,9 @@ def get_id(tar_path):
     str id of the image
 
   """
-  tar = tarfile.open(tar_path, mode="r")
-
-  decoder = JSONDecoder()
   try:
-    # Extracts it as a file object (not to the disk)
-    manifest = tar.extractfile("manifest.json").read().decode("utf-8")
+    with ImageTarball(tar_path) as tar:
+      manifest = tar.manifest()[0]
   except Exception as e:
     print((
         "Unable to extract manifest.json, make sure {} "
@@ -48,9 +45,6 @@ def get_id(tar_path):
           file=sys.stderr)
     exit(1)
 
-  # Get the manifest dictionary from JSON
-  manifest = decoder.decode(manifest)[0]
-
   # The name of the config file is of the form <image_id>.json
   config_file = manifest["Config"]
 
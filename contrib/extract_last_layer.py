@@ -14,35 +14,104 @@
 """Extracts the last layer of a docker image out of an image tarball
 
 Takes three arguments: the path to the image tarball, the output file for the layer, and the output file for the layer diffID
+
+With --layer_index, extracts another layer than the last one (negative indexes
+count from the end). With --all_layers, the two outputs are directories, and
+each layer i is extracted to <layer output>/<i>.tar with its diffID in
+<diffID output>/<i>.
 """
 
 
 from __future__ import print_function
-from json import JSONDecoder
+import argparse
 import hashlib
+import os
 import sys
-import tarfile
+import threading
 
+from archive import copy_fd
+from image_tarball import ImageTarball
+
+# The size of the buffer layers are hashed and copied through. Large buffers
+# keep the hashing and writing at disk bandwidth.
+_BUF_SIZE = 8 * 1024 * 1024
+
+
+def _copy_buffered(src, dst, sha):
+  """Copies the file object `src` to `dst` (if not None), hashing it in `sha`.
+
+  The copy goes through a single buffer, which is reused.
+  """
+  buf = bytearray(_BUF_SIZE)
+  view = memoryview(buf)
+  while True:
+    n = src.readinto(buf)
+    if not n:
+      break
+    # hashlib releases the GIL on large buffers.
+    sha.update(view[:n])
+    if dst is not None:
+      dst.write(view[:n])
 
-def extract_last_layer(tar_path, layer_path, diffid_path):
-  """Extracts the last layer from a docker image from an image tarball
+
+def copy_layer(tar, layer, layer_path, hash_layer=True):
+  """Extracts a layer of an image tarball.
+
+  When the tarball is not compressed, the layer is copied by the kernel while
+  a thread hashes it from the page cache.
 
   Args:
-    tar_path: str path to the tarball
+    tar: the ImageTarball
+    layer: the name of the layer in the tarball
     layer_path: str path for the output layer
-    diffid_path: str path for the layer diff ID
-
+    hash_layer: whether to compute the diff ID of the layer
 
   Returns:
-    str the diff ID of the layer
-
+    str the diff ID of the layer, or None if not hash_layer
   """
-  tar = tarfile.open(tar_path, mode="r")
+  diff_id = hashlib.sha256()
+  with open(layer_path, "wb") as f:
+    try:
+      (offset, size) = tar.member_range(layer)
+    except ValueError:
+      # Compressed, the layer can't be copied from its offset.
+      with tar.open(layer) as src:
+        _copy_buffered(src, f, diff_id)
+      return diff_id.hexdigest() if hash_layer else None
+
+    errors = []
+    def hash_range():
+      try:
+        with tar.open(layer) as src:
+          _copy_buffered(src, None, diff_id)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+    hasher = threading.Thread(target=hash_range)
+    if hash_layer:
+      hasher.start()
+    try:
+      copied = copy_fd(tar.fileno(), f.fileno(), size, offset)
+    finally:
+      if hash_layer:
+        hasher.join()
+    if errors:
+      raise errors[0]
+    if copied < size:
+      f.seek(copied)
+      with tar.open(layer) as src:
+        src.seek(copied)
+        while True:
+          buf = src.read(_BUF_SIZE)
+          if not buf:
+            break
+          f.write(buf)
+  return diff_id.hexdigest() if hash_layer else None
 
-  decoder = JSONDecoder()
+
+def _open(tar_path):
   try:
-    # Extracts it as a file object (not to the disk)
-    manifest = tar.extractfile("manifest.json").read().decode("utf-8")
+    tar = ImageTarball(tar_path)
+    layers = tar.layers()
   except Exception as e:
     print((
         "Unable to extract manifest.json, make sure {} "
@@ -50,42 +119,25 @@ def extract_last_layer(tar_path, layer_path, diffid_path):
           e,
           file=sys.stderr)
     exit(1)
+  return (tar, layers)
 
-  # Get the manifest dictionary from JSON
-  manifest = decoder.decode(manifest)[0]
-
-  # Get the last layer tar path
-  layers = manifest["Layers"]
-
-  last_layer_path = layers[-1]
-
-  layer_id = last_layer_path.split("/")[0]
 
-  # Hash the layer as we extract it
-  diff_id = hashlib.sha256()
+def _extract_layer(tar, tar_path, layer, layer_path, diffid_path):
+  """Extracts a layer and writes its diff ID, see extract_layer."""
+  layer_id = layer.split("/")[0]
 
   try:
     # Extract the layer from the image to the output path
-    last_layer = tar.extractfile(last_layer_path)
-    with open(layer_path, "wb") as f:
-      # Extract in blocks, to avoid loading the entire layer in memory
-      while True:
-        buf = last_layer.read(4096)
-        if buf:
-          diff_id.update(buf)
-          f.write(buf)
-        else:
-          break
+    diff_id_digest = copy_layer(tar, layer, layer_path)
   except Exception as e:
     print((
-        "Unable to extract last layer {} to {}, make sure {} "
+        "Unable to extract layer {} to {}, make sure {} "
         "is a valid docker image and that the layer path is writable\n").format(layer_id, layer_path, tar_path),
           e,
           file=sys.stderr)
     exit(1)
 
   # Output the diff ID hash
-  diff_id_digest = diff_id.hexdigest()
   try:
     with open(diffid_path, "w") as f:
       f.write(diff_id_digest)
@@ -96,5 +148,89 @@ def extract_last_layer(tar_path, layer_path, diffid_path):
   return layer_id
 
 
+def extract_layer(tar_path, layer_path, diffid_path, index=-1):
+  """Extracts a layer from a docker image from an image tarball
+
+  Args:
+    tar_path: str path to the tarball
+    layer_path: str path for the output layer
+    diffid_path: str path for the layer diff ID
+    index: int index of the layer in the manifest, negative indexes count
+        from the last layer
+
+
+  Returns:
+    str the id of the layer
+
+  """
+  (tar, layers) = _open(tar_path)
+  try:
+    layer = layers[index]
+  except IndexError:
+    print("Layer {} is out of range, {} has {} layers\n".format(
+        index, tar_path, len(layers)), file=sys.stderr)
+    exit(1)
+  layer_id = _extract_layer(tar, tar_path, layer, layer_path, diffid_path)
+  tar.close()
+  return layer_id
+
+
+def extract_last_layer(tar_path, layer_path, diffid_path):
+  """Extracts the last layer from a docker image from an image tarball
+
+  Args:
+    tar_path: str path to the tarball
+    layer_path: str path for the output layer
+    diffid_path: str path for the layer diff ID
+
+
+  Returns:
+    str the id of the layer
+
+  """
+  return extract_layer(tar_path, layer_path, diffid_path)
+
+
+def extract_all_layers(tar_path, layer_dir, diffid_dir):
+  """Extracts all the layers from a docker image from an image tarball
+
+  Args:
+    tar_path: str path to the tarball
+    layer_dir: str path of the directory for the output layers, <i>.tar
+    diffid_dir: str path of the directory for the layer diff IDs, <i>
+
+
+  Returns:
+    list of str ids of the layers
+
+  """
+  (tar, layers) = _open(tar_path)
+  for d in [layer_dir, diffid_dir]:
+    if not os.path.isdir(d):
+      os.makedirs(d)
+  layer_ids = [
+      _extract_layer(tar, tar_path, layer,
+                     os.path.join(layer_dir, "{}.tar".format(i)),
+                     os.path.join(diffid_dir, str(i)))
+      for i, layer in enumerate(layers)]
+  tar.close()
+  return layer_ids
+
+
 if __name__ == "__main__":
-  print(extract_last_layer(sys.argv[1], sys.argv[2], sys.argv[3]))
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument("tar_path", type=str)
+  parser.add_argument("layer_path", type=str)
+  parser.add_argument("diffid_path", type=str)
+  parser.add_argument("--layer_index", type=int, default=-1)
+  parser.add_argument("--all_layers", action="store_true")
+
+  args = parser.parse_args()
+
+  if args.all_layers:
+    print("\n".join(extract_all_layers(args.tar_path, args.layer_path,
+                                       args.diffid_path)))
+  else:
+    print(extract_layer(args.tar_path, args.layer_path, args.diffid_path,
+                        args.layer_index))
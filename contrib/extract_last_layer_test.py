@@ -0,0 +1,120 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for extract_last_layer."""
+
+import hashlib
+import io
+import os
+import runpy
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import extract_last_layer
+from image_tarball import ImageTarball
+from image_tarball_testutil import layer_tar
+from image_tarball_testutil import write_image_tarball
+
+_LAYERS = [
+    layer_tar([("a", b"a" * 1000)]),
+    layer_tar([("b", os.urandom(3 * 1024 * 1024))]),
+    layer_tar([]),
+]
+
+
+def _sha256(data):
+  return hashlib.sha256(data).hexdigest()
+
+
+class ExtractLastLayerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR"))
+    self.tar_path = os.path.join(self.tmp, "image.tar")
+    write_image_tarball(self.tar_path, _LAYERS)
+
+  def _read(self, name):
+    with open(os.path.join(self.tmp, name), "rb") as f:
+      return f.read()
+
+  def _run(self, *args):
+    """Runs extract_last_layer as a script, returns what it prints."""
+    out = io.StringIO()
+    argv = ["extract_last_layer.py", self.tar_path] + list(args)
+    with mock.patch.object(sys, "argv", argv), mock.patch.object(
+        sys, "stdout", out):
+      runpy.run_path(extract_last_layer.__file__, run_name="__main__")
+    return out.getvalue().split()
+
+  def test_copy_layer(self):
+    layer_path = os.path.join(self.tmp, "layer.tar")
+    for mode in ["w", "w:gz"]:
+      tar_path = os.path.join(self.tmp, "image-{}.tar".format(len(mode)))
+      write_image_tarball(tar_path, _LAYERS, mode=mode)
+      with ImageTarball(tar_path) as tar:
+        for i, layer in enumerate(_LAYERS):
+          name = "{}/layer.tar".format(i)
+          self.assertEqual(_sha256(layer),
+                           extract_last_layer.copy_layer(tar, name, layer_path))
+          self.assertEqual(layer, self._read("layer.tar"))
+          self.assertIsNone(extract_last_layer.copy_layer(
+              tar, name, layer_path, hash_layer=False))
+          self.assertEqual(layer, self._read("layer.tar"))
+
+  def test_copy_layer_without_kernel_copy(self):
+    # E.g. across file systems without copy_file_range, the kernel copies
+    # part of the layer or none of it, the rest is copied by reads.
+    layer_path = os.path.join(self.tmp, "layer.tar")
+    for copied in [0, 12345]:
+      def copy_fd(src, dst, unused_size, offset, n=copied):
+        return os.write(dst, os.pread(src, n, offset))
+      with mock.patch.object(extract_last_layer, "copy_fd", copy_fd):
+        with ImageTarball(self.tar_path) as tar:
+          self.assertEqual(
+              _sha256(_LAYERS[1]),
+              extract_last_layer.copy_layer(tar, "1/layer.tar", layer_path))
+      self.assertEqual(_LAYERS[1], self._read("layer.tar"))
+
+  def test_last_layer(self):
+    self.assertEqual(["2"], self._run(os.path.join(self.tmp, "layer.tar"),
+                                      os.path.join(self.tmp, "diff_id")))
+    self.assertEqual(_LAYERS[2], self._read("layer.tar"))
+    self.assertEqual(_sha256(_LAYERS[2]), self._read("diff_id").decode("ascii"))
+
+  def test_layer_index(self):
+    for index in ["1", "-2"]:
+      self.assertEqual(["1"], self._run(os.path.join(self.tmp, "layer.tar"),
+                                        os.path.join(self.tmp, "diff_id"),
+                                        "--layer_index", index))
+      self.assertEqual(_LAYERS[1], self._read("layer.tar"))
+      self.assertEqual(_sha256(_LAYERS[1]),
+                       self._read("diff_id").decode("ascii"))
+    with self.assertRaises(SystemExit):
+      self._run(os.path.join(self.tmp, "layer.tar"),
+                os.path.join(self.tmp, "diff_id"), "--layer_index", "3")
+
+  def test_all_layers(self):
+    self.assertEqual(["0", "1", "2"],
+                     self._run(os.path.join(self.tmp, "layers"),
+                               os.path.join(self.tmp, "diff_ids"),
+                               "--all_layers"))
+    for i, layer in enumerate(_LAYERS):
+      self.assertEqual(layer, self._read("layers/{}.tar".format(i)))
+      self.assertEqual(_sha256(layer),
+                       self._read("diff_ids/{}".format(i)).decode("ascii"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,159 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Extracts the layers of a docker image which are not in a base image
+
+Takes four arguments: the path to the image tarball, the path to the base image
+tarball, the output directory for the layers and the output directory for the
+layer diffIDs. The i-th new layer is extracted to <layer output>/<i>.tar, with
+its diffID in <diffID output>/<i>, and the ids of the new layers are printed.
+
+Layers are compared by the rootfs.diff_ids of the configs of both images: the
+base image must be a prefix of the image, whose remaining layers are the new
+ones, even if some of them (e.g. empty layers) are also in the base. The
+diffIDs of the config of the image are reused rather than computed again when
+the config is trustworthy, i.e. when it is named after its own digest as
+docker save names them, unless --verify_diff_ids is given.
+"""
+
+
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from extract_last_layer import copy_layer
+from image_tarball import ImageTarball
+
+
+def _read_config(tar_path):
+  """Returns the ImageTarball, its first image and its config, as bytes."""
+  try:
+    tar = ImageTarball(tar_path)
+    image = tar.manifest()[0]
+    config = tar.read(image["Config"])
+  except Exception as e:
+    print((
+        "Unable to extract the config, make sure {} "
+        "is a valid docker image.\n").format(tar_path),
+          e,
+          file=sys.stderr)
+    exit(1)
+  return (tar, image, config)
+
+
+def _is_trustworthy(name, config):
+  """Whether a config is named after its digest, e.g. <digest>.json."""
+  digest = hashlib.sha256(config).hexdigest()
+  base = os.path.basename(name)
+  return base.split(".")[0] in (digest, "sha256:" + digest)
+
+
+def extract_new_layers(tar_path, base_tar_path, layer_dir, diffid_dir,
+                       verify_diff_ids=False):
+  """Extracts the layers of a docker image which are not in a base image
+
+  Args:
+    tar_path: str path to the image tarball
+    base_tar_path: str path to the base image tarball
+    layer_dir: str path of the directory for the output layers, <i>.tar
+    diffid_dir: str path of the directory for the layer diff IDs, <i>
+    verify_diff_ids: bool whether to always hash the new layers, rather than
+        reuse the diff IDs of a trustworthy config
+
+
+  Returns:
+    list of str ids of the new layers
+
+  """
+  (base_tar, _, base_config) = _read_config(base_tar_path)
+  base_tar.close()
+  (tar, image, config) = _read_config(tar_path)
+  try:
+    base_diff_ids = json.loads(base_config.decode("utf-8"))["rootfs"]["diff_ids"]
+    diff_ids = json.loads(config.decode("utf-8"))["rootfs"]["diff_ids"]
+  except Exception as e:
+    print("Unable to read the rootfs.diff_ids of {} and {}\n".format(
+        tar_path, base_tar_path), e, file=sys.stderr)
+    exit(1)
+  layers = image["Layers"]
+  if len(diff_ids) != len(layers):
+    print("The config of {} has {} diff IDs for {} layers\n".format(
+        tar_path, len(diff_ids), len(layers)), file=sys.stderr)
+    exit(1)
+  if diff_ids[:len(base_diff_ids)] != base_diff_ids:
+    print("{} is not based on {}, its layers don't start with the ones of the "
+          "base image\n".format(tar_path, base_tar_path), file=sys.stderr)
+    exit(1)
+  trusted = not verify_diff_ids and _is_trustworthy(image["Config"], config)
+
+  new_layers = list(zip(layers, diff_ids))[len(base_diff_ids):]
+  for d in [layer_dir, diffid_dir]:
+    if not os.path.isdir(d):
+      os.makedirs(d)
+
+  # Read the layers in the order of the tarball, in a single pass.
+  def offset(i):
+    try:
+      return tar.member_range(new_layers[i][0])[0]
+    except ValueError:
+      # Compressed, in the order of the manifest.
+      return i
+
+  layer_ids = [None] * len(new_layers)
+  for i in sorted(range(len(new_layers)), key=offset):
+    (layer, diff_id) = new_layers[i]
+    layer_id = layer.split("/")[0]
+    layer_path = os.path.join(layer_dir, "{}.tar".format(i))
+    try:
+      digest = copy_layer(tar, layer, layer_path, hash_layer=not trusted)
+    except Exception as e:
+      print((
+          "Unable to extract layer {} to {}, make sure {} "
+          "is a valid docker image and that the layer path is writable\n").format(layer_id, layer_path, tar_path),
+            e,
+            file=sys.stderr)
+      exit(1)
+    if digest is None:
+      digest = diff_id.split(":")[-1]
+    elif "sha256:" + digest != diff_id:
+      print("Layer {} of {} has diff ID sha256:{}, but its config says {}\n".format(
+          layer_id, tar_path, digest, diff_id), file=sys.stderr)
+      exit(1)
+    try:
+      with open(os.path.join(diffid_dir, str(i)), "w") as f:
+        f.write(digest)
+    except Exception as e:
+      print("Unable to write layer Diff ID {} to {}, make sure the path is writeable\n".format(digest, diffid_dir), e, file=sys.stderr)
+      exit(1)
+    layer_ids[i] = layer_id
+  tar.close()
+  return layer_ids
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument("tar_path", type=str)
+  parser.add_argument("base_tar_path", type=str)
+  parser.add_argument("layer_dir", type=str)
+  parser.add_argument("diffid_dir", type=str)
+  parser.add_argument("--verify_diff_ids", action="store_true")
+
+  args = parser.parse_args()
+
+  print("\n".join(extract_new_layers(args.tar_path, args.base_tar_path,
+                                     args.layer_dir, args.diffid_dir,
+                                     args.verify_diff_ids)))
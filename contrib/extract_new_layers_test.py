@@ -0,0 +1,78 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for extract_new_layers."""
+
+import os
+import tempfile
+import unittest
+
+from extract_new_layers import extract_new_layers
+from image_tarball_testutil import layer_tar
+from image_tarball_testutil import write_image_tarball
+
+_A = layer_tar([("a", b"a")])
+_B = layer_tar([("b", b"b")])
+_EMPTY = layer_tar([])
+
+
+class ExtractNewLayersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR"))
+
+  def _extract(self, layers, base_layers, verify_diff_ids=False):
+    tar_path = os.path.join(self.tmp, "image.tar")
+    base_tar_path = os.path.join(self.tmp, "base.tar")
+    (_, diff_ids) = write_image_tarball(tar_path, layers)
+    write_image_tarball(base_tar_path, base_layers)
+    layer_dir = os.path.join(self.tmp, "layers")
+    diffid_dir = os.path.join(self.tmp, "diff_ids")
+    layer_ids = extract_new_layers(tar_path, base_tar_path, layer_dir,
+                                   diffid_dir, verify_diff_ids)
+    new_layers = []
+    for i in range(len(layer_ids)):
+      with open(os.path.join(layer_dir, "{}.tar".format(i)), "rb") as f:
+        layer = f.read()
+      with open(os.path.join(diffid_dir, str(i))) as f:
+        self.assertEqual(diff_ids[len(base_layers) + i], "sha256:" + f.read())
+      new_layers.append(layer)
+    self.assertEqual(len(layer_ids), len(os.listdir(layer_dir)))
+    return (layer_ids, new_layers)
+
+  def test_new_layers(self):
+    for verify_diff_ids in [False, True]:
+      self.assertEqual((["2", "3"], [_B, _A]),
+                       self._extract([_EMPTY, _A, _B, _A], [_EMPTY, _A],
+                                     verify_diff_ids))
+
+  def test_empty_layer_in_base(self):
+    # The empty layer is new, even though the base has one too.
+    self.assertEqual((["1", "2"], [_B, _EMPTY]),
+                     self._extract([_EMPTY, _B, _EMPTY], [_EMPTY]))
+
+  def test_duplicate_layer(self):
+    self.assertEqual((["1"], [_A]), self._extract([_A, _A], [_A]))
+
+  def test_no_new_layers(self):
+    self.assertEqual(([], []), self._extract([_A, _B], [_A, _B]))
+
+  def test_not_based_on_base(self):
+    with self.assertRaises(SystemExit):
+      self._extract([_A, _B], [_B])
+    with self.assertRaises(SystemExit):
+      self._extract([_A], [_A, _B])
+
+
+if __name__ == "__main__":
+  unittest.main()
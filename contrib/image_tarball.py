@@ -0,0 +1,262 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reads the members of docker image tarballs by direct seeks.
+
+The headers of a tarball are read once, to index the offset and size of each
+member. manifest.json, configs and layers are then read straight from their
+offset, without scanning the tarball again. The index can be persisted in a
+sidecar <tarball>.idx file, which is reused as long as the tarball is not
+modified.
+
+Takes the paths of image tarballs, and writes their sidecar index.
+"""
+
+
+from __future__ import print_function
+import io
+import json
+import os
+import sys
+import tarfile
+
+INDEX_SUFFIX = ".idx"
+
+# Bump when the format of sidecar indexes changes.
+_INDEX_VERSION = 1
+
+# Link types are resolved to the member they point to.
+_SYMLINK = tarfile.SYMTYPE.decode("ascii")
+_HARDLINK = tarfile.LNKTYPE.decode("ascii")
+
+
+class _MemberFile(io.RawIOBase):
+  """A read-only file object over a byte range of a file descriptor.
+
+  Reads use pread, so the same descriptor can be read concurrently.
+  """
+
+  def __init__(self, fd, offset, size):
+    super(_MemberFile, self).__init__()
+    self._fd = fd
+    self._offset = offset
+    self._size = size
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def seek(self, pos, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      pos += self._pos
+    elif whence == io.SEEK_END:
+      pos += self._size
+    self._pos = max(0, min(pos, self._size))
+    return self._pos
+
+  def tell(self):
+    return self._pos
+
+  def readinto(self, b):
+    n = min(len(b), self._size - self._pos)
+    if n <= 0:
+      return 0
+    if hasattr(os, "preadv"):
+      # Straight into the buffer of the caller.
+      n = os.preadv(self._fd, [memoryview(b)[:n]], self._offset + self._pos)
+    else:
+      buf = os.pread(self._fd, n, self._offset + self._pos)
+      n = len(buf)
+      b[:n] = buf
+    if not n:
+      raise IOError("Unexpected end of tarball")
+    self._pos += n
+    return n
+
+
+class ImageTarball(object):
+  """An indexed docker image tarball, as written by docker save."""
+
+  def __init__(self, path, write_index=False):
+    """Constructor.
+
+    Args:
+      path: str path to the tarball.
+      write_index: whether to write the sidecar index of the tarball when it
+          is missing or stale. Failing to write it is not an error.
+
+    Raises:
+      tarfile.ReadError: the tarball is not a valid tarball.
+    """
+    self.path = path
+    self._manifest = None
+    # Compressed tarballs can't be read by seeks, they are read with tarfile.
+    self._tar = None
+    self._fd = os.open(path, os.O_RDONLY)
+    try:
+      self._members = self._load_index()
+      if self._members is None:
+        self._members = self._build_index()
+        if self._members is not None and write_index:
+          self._write_index()
+      if self._members is None:
+        self._tar = tarfile.open(path, mode="r")
+    except Exception:
+      self.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+  def close(self):
+    if self._tar is not None:
+      self._tar.close()
+      self._tar = None
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def fileno(self):
+    """Returns the file descriptor of the tarball."""
+    return self._fd
+
+  def _stat(self):
+    st = os.fstat(self._fd)
+    return [st.st_size, st.st_mtime_ns]
+
+  def _load_index(self):
+    """Returns the members of a fresh sidecar index, or None."""
+    try:
+      with open(self.path + INDEX_SUFFIX, "r") as f:
+        index = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    if (index.get("version") != _INDEX_VERSION or
+        index.get("stat") != self._stat()):
+      return None
+    return index["members"]
+
+  def _write_index(self):
+    index = {
+        "version": _INDEX_VERSION,
+        "stat": self._stat(),
+        "members": self._members,
+    }
+    tmp = "%s%s.%d" % (self.path, INDEX_SUFFIX, os.getpid())
+    try:
+      with open(tmp, "w") as f:
+        json.dump(index, f, sort_keys=True)
+      os.rename(tmp, self.path + INDEX_SUFFIX)
+    except (IOError, OSError):
+      # E.g. the directory of the tarball is read-only.
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def _build_index(self):
+    """Reads the headers of an uncompressed tarball.
+
+    Returns:
+      dict from member names to [offset, size, type, linkname], or None if the
+      tarball is compressed.
+    """
+    members = {}
+    with os.fdopen(os.dup(self._fd), "rb") as f:
+      try:
+        tar = tarfile.open(fileobj=f, mode="r:")
+      except tarfile.ReadError:
+        return None
+      # Headers only: the content of members is skipped by seeking over it.
+      for member in tar:
+        members[member.name] = [member.offset_data, member.size,
+                                member.type.decode("ascii"), member.linkname]
+      tar.close()
+    return members
+
+  def _resolve(self, name):
+    """Returns the name of the member `name` is a link to, or `name`."""
+    seen = set()
+    while name not in seen:
+      seen.add(name)
+      if self._tar is not None:
+        member = self._tar.getmember(name)
+        (type_, linkname) = (member.type.decode("ascii"), member.linkname)
+      else:
+        (_, _, type_, linkname) = self._members[name]
+      if type_ == _SYMLINK:
+        name = os.path.normpath(
+            os.path.join(os.path.dirname(name), linkname))
+      elif type_ == _HARDLINK:
+        name = linkname
+      else:
+        return name
+    raise KeyError("Link loop at {}".format(name))
+
+  def names(self):
+    """Returns the names of the members of the tarball."""
+    if self._tar is not None:
+      return self._tar.getnames()
+    return list(self._members)
+
+  def member_range(self, name):
+    """Returns the offset and size of the content of a member, following links.
+
+    Raises:
+      KeyError: the member is not in the tarball.
+      ValueError: the tarball is compressed.
+    """
+    if self._tar is not None:
+      raise ValueError("{} is compressed".format(self.path))
+    (offset, size, _, _) = self._members[self._resolve(name)]
+    return (offset, size)
+
+  def open(self, name):
+    """Returns a file object reading a member, following links.
+
+    Raises:
+      KeyError: the member is not in the tarball.
+    """
+    if self._tar is not None:
+      return self._tar.extractfile(self._resolve(name))
+    (offset, size) = self.member_range(name)
+    return _MemberFile(self._fd, offset, size)
+
+  def read(self, name):
+    """Returns the content of a member, following links."""
+    with self.open(name) as f:
+      return f.read()
+
+  def manifest(self):
+    """Returns the parsed manifest.json of the tarball."""
+    if self._manifest is None:
+      self._manifest = json.loads(self.read("manifest.json").decode("utf-8"))
+    return self._manifest
+
+  def config(self, image=0):
+    """Returns the parsed config of an image of the manifest."""
+    return json.loads(
+        self.read(self.manifest()[image]["Config"]).decode("utf-8"))
+
+  def layers(self, image=0):
+    """Returns the names of the layers of an image of the manifest."""
+    return self.manifest()[image]["Layers"]
+
+
+if __name__ == "__main__":
+  for tar_path in sys.argv[1:]:
+    ImageTarball(tar_path, write_index=True).close()
@@ -0,0 +1,148 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for image_tarball."""
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import image_tarball
+from image_tarball import ImageTarball
+from image_tarball_testutil import layer_tar
+from image_tarball_testutil import write_image_tarball
+
+_LAYERS = [layer_tar([("a", b"a")]), layer_tar([("b", b"b" * 1000)])]
+
+
+class ImageTarballTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(dir=os.environ.get("TEST_TMPDIR"))
+    self.tar_path = os.path.join(self.tmp, "image.tar")
+
+  def _check_image(self, tar, image_id, diff_ids):
+    self.assertEqual(image_id + ".json", tar.manifest()[0]["Config"])
+    self.assertEqual(diff_ids, tar.config()["rootfs"]["diff_ids"])
+    self.assertEqual(["0/layer.tar", "1/layer.tar"], tar.layers())
+    for name, layer in zip(tar.layers(), _LAYERS):
+      self.assertEqual(layer, tar.read(name))
+
+  def test_read(self):
+    (image_id, diff_ids) = write_image_tarball(self.tar_path, _LAYERS)
+    with ImageTarball(self.tar_path) as tar:
+      self._check_image(tar, image_id, diff_ids)
+      (offset, size) = tar.member_range("1/layer.tar")
+      self.assertEqual(len(_LAYERS[1]), size)
+      with open(self.tar_path, "rb") as f:
+        f.seek(offset)
+        self.assertEqual(_LAYERS[1], f.read(size))
+      with tar.open("1/layer.tar") as f:
+        f.seek(-3, io.SEEK_END)
+        self.assertEqual(_LAYERS[1][-3:], f.read())
+      with self.assertRaises(KeyError):
+        tar.read("missing")
+    self.assertFalse(os.path.exists(self.tar_path + image_tarball.INDEX_SUFFIX))
+
+  def test_compressed(self):
+    (image_id, diff_ids) = write_image_tarball(
+        self.tar_path, _LAYERS + [_LAYERS[0]], mode="w:gz")
+    with ImageTarball(self.tar_path, write_index=True) as tar:
+      self.assertEqual(["0/layer.tar", "1/layer.tar", "2/layer.tar"],
+                       tar.layers())
+      # The repeated layer is a symlink to the first one.
+      self.assertEqual(_LAYERS[0], tar.read("2/layer.tar"))
+      self.assertEqual(diff_ids, tar.config()["rootfs"]["diff_ids"])
+      self.assertEqual(image_id + ".json", tar.manifest()[0]["Config"])
+      with self.assertRaises(ValueError):
+        tar.member_range("0/layer.tar")
+    # Compressed tarballs are not indexed.
+    self.assertFalse(os.path.exists(self.tar_path + image_tarball.INDEX_SUFFIX))
+
+  def test_links(self):
+    with tarfile.open(self.tar_path, "w") as tar:
+      for name, type_, linkname, data in [
+          ("0/layer.tar", tarfile.REGTYPE, "", _LAYERS[0]),
+          ("1/layer.tar", tarfile.SYMTYPE, "../0/layer.tar", b""),
+          ("2/layer.tar", tarfile.LNKTYPE, "0/layer.tar", b""),
+          ("3/layer.tar", tarfile.SYMTYPE, "../2/layer.tar", b""),
+          ("loop", tarfile.SYMTYPE, "loop", b""),
+      ]:
+        info = tarfile.TarInfo(name)
+        info.type = type_
+        info.linkname = linkname
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    with ImageTarball(self.tar_path) as tar:
+      range_ = tar.member_range("0/layer.tar")
+      for name in ["1/layer.tar", "2/layer.tar", "3/layer.tar"]:
+        self.assertEqual(_LAYERS[0], tar.read(name))
+        self.assertEqual(range_, tar.member_range(name))
+      with self.assertRaises(KeyError):
+        tar.read("loop")
+
+  def test_index(self):
+    (image_id, diff_ids) = write_image_tarball(self.tar_path, _LAYERS)
+    index_path = self.tar_path + image_tarball.INDEX_SUFFIX
+    ImageTarball(self.tar_path, write_index=True).close()
+    with open(index_path) as f:
+      index = json.load(f)
+    st = os.stat(self.tar_path)
+    self.assertEqual([st.st_size, st.st_mtime_ns], index["stat"])
+    self.assertIn("manifest.json", index["members"])
+
+    # A fresh index is used instead of reading the headers again.
+    with mock.patch.object(ImageTarball, "_build_index") as build_index:
+      with ImageTarball(self.tar_path, write_index=True) as tar:
+        self._check_image(tar, image_id, diff_ids)
+      build_index.assert_not_called()
+
+  def test_stale_index(self):
+    index_path = self.tar_path + image_tarball.INDEX_SUFFIX
+    write_image_tarball(self.tar_path, _LAYERS)
+    ImageTarball(self.tar_path, write_index=True).close()
+    st = os.stat(self.tar_path)
+
+    # Another image, of the same size, with a different mtime.
+    other_layers = [layer_tar([("c", b"c")]), _LAYERS[1]]
+    (image_id, diff_ids) = write_image_tarball(self.tar_path, other_layers)
+    self.assertEqual(st.st_size, os.stat(self.tar_path).st_size)
+    os.utime(self.tar_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    with ImageTarball(self.tar_path, write_index=True) as tar:
+      self.assertEqual(image_id + ".json", tar.manifest()[0]["Config"])
+      self.assertEqual(other_layers[0], tar.read("0/layer.tar"))
+    with open(index_path) as f:
+      self.assertEqual(os.stat(self.tar_path).st_mtime_ns,
+                       json.load(f)["stat"][1])
+
+    # A different size with the same mtime.
+    st = os.stat(self.tar_path)
+    write_image_tarball(self.tar_path, other_layers + [_LAYERS[0]])
+    os.utime(self.tar_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    with ImageTarball(self.tar_path) as tar:
+      self.assertEqual(3, len(tar.layers()))
+
+  def test_corrupt_index(self):
+    write_image_tarball(self.tar_path, _LAYERS)
+    with open(self.tar_path + image_tarball.INDEX_SUFFIX, "w") as f:
+      f.write("{")
+    with ImageTarball(self.tar_path) as tar:
+      self.assertEqual(_LAYERS[0], tar.read("0/layer.tar"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+# Copyright 2020 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Writes docker image tarballs for the tests of the contrib tools."""
+
+import hashlib
+import io
+import json
+import tarfile
+
+
+def _add(tar, name, data):
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  tar.addfile(info, io.BytesIO(data))
+
+
+def layer_tar(files):
+  """Returns an uncompressed layer of the (name, bytes) files."""
+  out = io.BytesIO()
+  with tarfile.open(fileobj=out, mode="w") as tar:
+    for name, data in files:
+      _add(tar, name, data)
+  return out.getvalue()
+
+
+def write_image_tarball(path, layers, mode="w", config=None):
+  """Writes a tarball of an image, as docker save does.
+
+  Each layer i is stored as <i>/layer.tar, except that a layer equal to a
+  previous one is a symlink to it, as in the tarballs of recent dockers. The
+  config is named after its digest.
+
+  Args:
+    path: str path of the tarball
+    layers: list of the bytes of the (uncompressed) layers
+    mode: the mode to open the tarball with, e.g. "w:gz" to compress it
+    config: dict of other fields of the config
+
+  Returns:
+    (the id of the image, the diff IDs of its layers)
+  """
+  diff_ids = ["sha256:" + hashlib.sha256(layer).hexdigest() for layer in layers]
+  config = dict(config or {}, rootfs={"type": "layers", "diff_ids": diff_ids})
+  config_data = json.dumps(config, sort_keys=True).encode("utf-8")
+  image_id = hashlib.sha256(config_data).hexdigest()
+  names = ["{}/layer.tar".format(i) for i in range(len(layers))]
+  manifest = [{
+      "Config": image_id + ".json",
+      "RepoTags": ["bazel/image:latest"],
+      "Layers": names,
+  }]
+  with tarfile.open(path, mode=mode) as tar:
+    _add(tar, image_id + ".json", config_data)
+    first = {}
+    for name, diff_id, layer in zip(names, diff_ids, layers):
+      if diff_id in first:
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.SYMTYPE
+        info.linkname = "../" + first[diff_id]
+        tar.addfile(info)
+      else:
+        first[diff_id] = name
+        _add(tar, name, layer)
+    _add(tar, "manifest.json", json.dumps(manifest).encode("utf-8"))
+  return (image_id, diff_ids)
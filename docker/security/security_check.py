@@ -15,9 +15,15 @@
 """Checks the specified image for security vulnerabilities."""
 
 import argparse
+import concurrent.futures
+import hashlib
 import json
+import os
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import logging
 
 import distutils.version as ver
@@ -49,6 +55,9 @@ REPOSITORIES_TO_IGNORE = {
     'us-mirror.gcr.io/library'
 }
 
+# How long cached gcloud results are used, in seconds.
+_DEFAULT_CACHE_TTL = 60 * 60
+
 
 def gcloud_path():
   """Returns the path to the gcloud command. Requires gcloud to be on system PATH"""
@@ -74,17 +83,91 @@ def _run_gcloud(cmd):
   return json.loads(output.decode('utf-8'))
 
 
-def _find_base_image(image):
+class Gcloud(object):
+  """Runs `gcloud alpha container images` commands.
+
+  Checks only call run, so that tests can serve them from a fake instead.
+  """
+
+  def run(self, cmd):
+    """Runs a command and returns its parsed JSON output.
+
+    Args:
+      cmd: the arguments of the command, e.g. ['describe', image].
+    """
+    return _run_gcloud(cmd)
+
+
+class CachedGcloud(object):
+  """Caches the results of gcloud commands about images given by digest.
+
+  Only the commands with an argument containing '@sha256:' are cached, the
+  others (e.g. about images given by tag, since tags can be moved) are always
+  run. Results are stored in a local directory, which concurrent checks may
+  share, and are used for `ttl` seconds.
+  """
+
+  def __init__(self, gcloud, directory, ttl=_DEFAULT_CACHE_TTL):
+    """Constructor.
+
+    Args:
+      gcloud: the Gcloud to run the commands which are not cached.
+      directory: the directory of the cache, created if needed.
+      ttl: how long results are used, in seconds.
+    """
+    self.gcloud = gcloud
+    self.directory = directory
+    self.ttl = ttl
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Created concurrently.
+        if not os.path.isdir(directory):
+          raise
+
+  def _path(self, cmd):
+    key = hashlib.sha256(json.dumps(cmd).encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, key + '.json')
+
+  def run(self, cmd):
+    """Runs a command, or returns its cached result, see Gcloud.run."""
+    if not any('@sha256:' in arg for arg in cmd):
+      return self.gcloud.run(cmd)
+    path = self._path(cmd)
+    try:
+      if time.time() - os.stat(path).st_mtime < self.ttl:
+        with open(path, 'r') as f:
+          return json.load(f)
+    except (IOError, OSError, ValueError):
+      # Missing, or being replaced.
+      pass
+    parsed = self.gcloud.run(cmd)
+    # Replaced atomically, not to serve partial results to concurrent checks.
+    fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(parsed, f)
+      os.rename(tmp, path)
+    except (IOError, OSError):
+      logging.info('Could not cache the result of %s', cmd)
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    return parsed
+
+
+def _find_base_image(image, gcloud):
   """Finds the base image of the given image.
 
   Args:
     image: The name of the image to find the base of.
+    gcloud: the Gcloud to look the image up with.
 
   Returns:
     The name of the base image if it exists, otherwise None.
   """
 
-  parsed = _run_gcloud(['describe', '--show-image-basis', image])
+  parsed = gcloud.run(['describe', '--show-image-basis', image])
   img = parsed['image_basis_summary'].get('base_images')
 
   if not img:
@@ -95,28 +178,77 @@ def _find_base_image(image):
   return _sub_image(base_img)
 
 
-def _check_for_vulnz(image, severity, whitelist):
+def _check_base_image(image, severity, whitelist, gcloud, cancelled):
+  """Checks drydock for the vulnerabilities of the base of an image.
+
+  Args:
+    cancelled: threading.Event set when the result is not needed anymore, so
+        that the base image is not looked up once found.
+
+  Returns:
+    The name of the base image, or None if it has none, and its map of
+    vulnerabilities.
+  """
+  base_image = _find_base_image(image, gcloud)
+  if not base_image or cancelled.is_set():
+    return (base_image, {})
+  return (base_image, _check_image(base_image, severity, whitelist, gcloud))
+
+
+def _run_in_background(fn, *args):
+  """Calls fn(*args) on a daemon thread.
+
+  Unlike the workers of concurrent.futures, which are joined when the
+  interpreter exits, the thread is abandoned if its result is not needed.
+
+  Returns:
+    The concurrent.futures.Future of the result.
+  """
+  future = concurrent.futures.Future()
+  future.set_running_or_notify_cancel()
+
+  def run():
+    try:
+      future.set_result(fn(*args))
+    except BaseException as e:  # pylint: disable=broad-except
+      future.set_exception(e)
+
+  thread = threading.Thread(target=run)
+  thread.daemon = True
+  thread.start()
+  return future
+
+
+def _check_for_vulnz(image, severity, whitelist, gcloud):
   """Checks drydock for image vulnerabilities.
 
   Args:
     image: full name of the docker image
     severity: the severity of vulnerability to trigger failure
     whitelist: list of CVEs to ignore for this test
+    gcloud: the Gcloud to look the images up with
 
   Returns:
     Map of vulnerabilities, if present.
   """
 
   logging.info('CHECKING %s', image)
-  unpatched = _check_image(image, severity, whitelist)
+  # The base image is looked up and checked while the image is checked,
+  # although its vulnerabilities are only needed if the image has some:
+  # otherwise the lookup is cancelled, and exiting does not wait for it.
+  cancelled = threading.Event()
+  base = _run_in_background(_check_base_image, image, severity, whitelist,
+                            gcloud, cancelled)
+  unpatched = None
+  try:
+    unpatched = _check_image(image, severity, whitelist, gcloud)
+  finally:
+    if not unpatched:
+      cancelled.set()
   if not unpatched:
     return unpatched
-
-  base_image = _find_base_image(image)
-  base_unpatched = {}
-  if base_image:
-    base_unpatched = _check_image(base_image, severity, whitelist)
-  else:
+  (base_image, base_unpatched) = base.result()
+  if not base_image:
     logging.info('Could not find base image for %s', image)
 
   count = 0
@@ -171,19 +303,20 @@ FIXED PACKAGES: {3}
       fixed_packages)
 
 
-def _check_image(image, severity, whitelist):
+def _check_image(image, severity, whitelist, gcloud):
   """Checks drydock for image vulnerabilities.
 
   Args:
     image: full name of the docker image
     severity: the severity of vulnerability to trigger failure
     whitelist: list of CVEs to ignore for this test
+    gcloud: the Gcloud to look the image up with
 
   Returns:
     Map of vulnerabilities, if present.
   """
 
-  parsed = _run_gcloud(['describe', image, '--show-all-metadata'])
+  parsed = gcloud.run(['describe', image, '--show-all-metadata'])
   unpatched = {}
 
   vuln_analysis = parsed.get('package_vulnerability_summary', {})
@@ -288,7 +421,7 @@ def _generate_json_output(output_json, vulnerabilities):
     json.dump(result, ofp)
 
 def security_check(image, severity=_MEDIUM, whitelist_file='whitelist.json',
-                   output_json=None):
+                   output_json=None, gcloud=None):
   """Main security check function.
 
   Args:
@@ -297,6 +430,7 @@ def security_check(image, severity=_MEDIUM, whitelist_file='whitelist.json',
     whitelist_file: file with list of whitelisted CVE
     output_json: Output file which will be populated with a list of types of
                  vulnerability that exist for the given image.
+    gcloud: the Gcloud to look the images up with, which runs gcloud if None.
 
   Returns:
     Map of vulnerabilities, if present.
@@ -309,7 +443,8 @@ def security_check(image, severity=_MEDIUM, whitelist_file='whitelist.json',
     whitelist = []
   logging.info('whitelist=%s', whitelist)
 
-  result = _check_for_vulnz(_sub_image(image), severity, whitelist)
+  result = _check_for_vulnz(_sub_image(image), severity, whitelist,
+                            gcloud or Gcloud())
 
   if output_json:
     logging.info("Creating JSON output {}".format(output_json))
@@ -333,9 +468,21 @@ def _main():
                       help='The path to the output JSON file to'+\
                       ' generate with a list of tags indicating the types of'+\
                       ' vulnerability fixes available for the given image.')
+  parser.add_argument('--cache-dir', dest='cache_dir',
+                      default=os.environ.get('SECURITY_CHECK_CACHE_DIR'),
+                      help='A local directory caching the vulnerabilities of'+\
+                      ' images given by digest, e.g. base images shared by'+\
+                      ' many checks. Defaults to $SECURITY_CHECK_CACHE_DIR.')
+  parser.add_argument('--cache-ttl', dest='cache_ttl', type=int,
+                      default=_DEFAULT_CACHE_TTL,
+                      help='How long cached vulnerabilities are used, in'+\
+                      ' seconds.')
   args = parser.parse_args()
+  gcloud = Gcloud()
+  if args.cache_dir:
+    gcloud = CachedGcloud(gcloud, args.cache_dir, args.cache_ttl)
   security_check(args.image, args.severity, args.whitelist,
-                            args.output_json)
+                 args.output_json, gcloud=gcloud)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+# Copyright 2017 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for security_check, served by a local fake of gcloud."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import security_check
+
+_IMAGE = 'gcr.io/project/image@sha256:' + 'a' * 64
+_BASE = 'gcr.io/project/base@sha256:' + 'b' * 64
+
+
+class FakeGcloud(object):
+  """Serves gcloud commands from a map of their arguments to their output."""
+
+  def __init__(self, responses):
+    self.responses = responses
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def run(self, cmd):
+    with self.lock:
+      self.calls.append(cmd)
+    return self.responses[tuple(cmd)]
+
+
+def _vuln(name):
+  return {
+      'noteName': name,
+      'vulnerabilityDetails': {
+          'severity': 'HIGH',
+          'packageIssue': [{
+              'affectedLocation': {'package': 'p', 'version': {'name': '1.0'}},
+              'fixedLocation': {'package': 'p', 'version': {'name': '1.1'}},
+          }],
+      },
+  }
+
+
+def _metadata(names):
+  return {
+      'package_vulnerability_summary': {
+          'total_vulnerability_found': len(names),
+          'not_fixed_vulnerability_count': 0,
+          'vulnerabilities': {'HIGH': [_vuln(name) for name in names]},
+      },
+  }
+
+
+def _responses(image_vulnz, base_vulnz):
+  return {
+      ('describe', _IMAGE, '--show-all-metadata'): _metadata(image_vulnz),
+      ('describe', '--show-image-basis', _IMAGE): {
+          'image_basis_summary': {'base_images': [{
+              'derivedImage': {'baseResourceUrl': 'https://' + _BASE},
+          }]},
+      },
+      ('describe', _BASE, '--show-all-metadata'): _metadata(base_vulnz),
+  }
+
+
+class SecurityCheckTest(unittest.TestCase):
+
+  def test_vulnerabilities(self):
+    gcloud = FakeGcloud(_responses(['CVE-1', 'CVE-2'], ['CVE-1']))
+    result = security_check.security_check(_IMAGE, gcloud=gcloud)
+    self.assertEqual(['CVE-1', 'CVE-2'], sorted(result))
+    self.assertEqual(3, len(gcloud.calls))
+
+  def test_vulnerabilities_of_base_image(self):
+    gcloud = FakeGcloud(_responses(['CVE-1'], ['CVE-1']))
+    self.assertIsNone(security_check.security_check(_IMAGE, gcloud=gcloud))
+
+  def test_no_vulnerabilities(self):
+    gcloud = FakeGcloud(_responses([], []))
+    self.assertEqual({}, security_check.security_check(_IMAGE, gcloud=gcloud))
+
+  def test_base_lookup_is_cancelled(self):
+    # The base image is being looked up when the image is found to have no
+    # vulnerabilities: the check returns without waiting for it.
+    looking_up = threading.Event()
+    release = threading.Event()
+
+    class BlockingGcloud(FakeGcloud):
+
+      def run(self, cmd):
+        if '--show-image-basis' in cmd:
+          looking_up.set()
+          release.wait()
+        return super(BlockingGcloud, self).run(cmd)
+
+    gcloud = BlockingGcloud(_responses([], ['CVE-1']))
+    check = threading.Thread(
+        target=security_check.security_check, args=(_IMAGE,),
+        kwargs={'gcloud': gcloud})
+    check.start()
+    self.assertTrue(looking_up.wait(10))
+    check.join(10)
+    self.assertFalse(check.is_alive())
+    release.set()
+    # The metadata of the base image, found once cancelled, is not looked up.
+    for _ in range(100):
+      if len(gcloud.calls) > 1:
+        break
+      time.sleep(0.01)
+    time.sleep(0.1)
+    self.assertEqual(
+        [('describe', '--show-image-basis', _IMAGE),
+         ('describe', _IMAGE, '--show-all-metadata')],
+        sorted(tuple(cmd) for cmd in gcloud.calls))
+
+  def test_cache(self):
+    gcloud = FakeGcloud(_responses(['CVE-1', 'CVE-2'], ['CVE-1']))
+    cache_dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+    for _ in range(2):
+      cached = security_check.CachedGcloud(gcloud, cache_dir)
+      result = security_check.security_check(_IMAGE, gcloud=cached)
+      self.assertEqual(['CVE-1', 'CVE-2'], sorted(result))
+    # The second check is served from the cache.
+    self.assertEqual(3, len(gcloud.calls))
+
+  def test_cache_expiry(self):
+    cmd = ['describe', _BASE, '--show-all-metadata']
+    gcloud = FakeGcloud(_responses([], []))
+    cache_dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+    cached = security_check.CachedGcloud(gcloud, cache_dir, ttl=60)
+    cached.run(cmd)
+    cached.run(cmd)
+    self.assertEqual(1, len(gcloud.calls))
+    # Expire the result.
+    (path,) = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)]
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    cached.run(cmd)
+    self.assertEqual(2, len(gcloud.calls))
+
+  def test_tags_are_not_cached(self):
+    cmd = ['describe', 'gcr.io/project/image:latest', '--show-all-metadata']
+    gcloud = FakeGcloud({tuple(cmd): _metadata([])})
+    cache_dir = tempfile.mkdtemp(dir=os.environ.get('TEST_TMPDIR'))
+    cached = security_check.CachedGcloud(gcloud, cache_dir)
+    cached.run(cmd)
+    cached.run(cmd)
+    self.assertEqual(2, len(gcloud.calls))
+
+
+if __name__ == '__main__':
+  unittest.main()
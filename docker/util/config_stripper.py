@@ -15,39 +15,270 @@
 # limitations under the License.
 
 import argparse
+import collections
+import concurrent.futures
+import copy
+import functools
+import grp
+import gzip
 import io
 import hashlib
 import json
+import multiprocessing
 import os
+import pwd
 import shutil
+import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
 import threading
 
+from container.archive import ParallelGzipWriter
+from container.archive import rewrite_tar_mtimes
+from container.layer_cache import LayerCache
+from container.layer_cache import compute_key
+from container.layer_cache import digest_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 _TIMESTAMP = '1970-01-01T00:00:00Z'
 
 WHITELISTED_PREFIXES = ['sha256:', 'manifest', 'repositories']
 
 _BUF_SIZE = 4096
 
+# Layers are hashed and copied in larger chunks, they aren't piped to another
+# process.
+_HASH_BUF_SIZE = 1024 * 1024
+
+COMPRESSIONS = ['gzip', 'zlib', 'pgzip', 'zstd']
+
+# The mtime of the members of stripped layers. Use a deterministic mtime that
+# doesn't confuse other programs, e.g. Python. Also see
+# https://github.com/bazelbuild/bazel/issues/1299
+_LAYER_MTIME = 946684800 # 2000-01-01 00:00:00.000 UTC
+
+# The media types of the OCI image layout written by strip_tar_streaming.
+_OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+_OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+_OCI_CONFIG = 'application/vnd.oci.image.config.v1+json'
+_OCI_LAYERS = {
+    'gzip': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'zlib': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'pgzip': 'application/vnd.oci.image.layer.v1.tar+gzip',
+    'zstd': 'application/vnd.oci.image.layer.v1.tar+zstd',
+}
+
+# The mtime strip_tar sets to the files it archives. It is a float, as read by
+# os.stat, which tarfile records in a PAX header.
+_MTIME = 0.0
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--in_tar_path', type=str,
                         help='Path to docker save tarball',
                         required=True)
     parser.add_argument('--out_tar_path', type=str,
-                        help='Path to output stripped tarball',
-                        required=True)
+                        help='Path to output stripped tarball')
+    parser.add_argument('--out_oci_layout', type=str,
+                        help='Path to a directory to output the stripped '
+                        'image to as an OCI image layout, rather than as a '
+                        'tarball. The input is read without being extracted, '
+                        'as with --streaming.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of layers to strip concurrently.')
+    parser.add_argument('--compression', choices=COMPRESSIONS,
+                        default='gzip',
+                        help='How to compress the stripped layers: with the '
+                        'gzip tool (the default), in-process with zlib, in '
+                        'parallel blocks with zlib, or with zstd if the '
+                        'zstandard module is available. Each produces '
+                        'different layer digests.')
+    parser.add_argument('--compression_level', type=int, default=None,
+                        help='The compression level, the default one of the '
+                        'compression if unset.')
+    parser.add_argument('--compression_threads', type=int, default=0,
+                        help='Number of compressing threads of pgzip and zstd, '
+                        'all cores for pgzip if 0.')
+    parser.add_argument('--rewrite_headers', action='store_true',
+                        help='Strip layers by patching the mtime of their raw '
+                        'headers and copying their content as is, rather than '
+                        're-encoding them with tarfile. This is much faster '
+                        'for large layers, but their headers are otherwise '
+                        'kept as they are, which may change their digests.')
+    parser.add_argument('--cache_dir', type=str,
+                        default=os.environ.get('CONFIG_STRIPPER_CACHE_DIR'),
+                        help='A local directory caching stripped layers by '
+                        'the digest of the original ones. It may be shared by '
+                        'concurrent builds. Defaults to '
+                        '$CONFIG_STRIPPER_CACHE_DIR.')
+    parser.add_argument('--cache_max_size', type=int,
+                        help='The maximum size of --cache_dir in bytes, least '
+                        'recently used layers are evicted above it. Unbounded '
+                        'by default.')
+    parser.add_argument('--summary_path', type=str,
+                        help='Write the digests and sizes of the manifest, '
+                        'configs and layers of the output tarball to this '
+                        'JSON file.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the input tarball once and write the '
+                        'output directly, without extracting the image to '
+                        'disk. The output is the same.')
     args = parser.parse_args()
+    if bool(args.out_tar_path) == bool(args.out_oci_layout):
+        parser.error('Exactly one of --out_tar_path and --out_oci_layout is '
+                     'required')
 
     os.environ["PYTHONIOENCODING"] = "utf-8"
 
-    return strip_tar(args.in_tar_path, args.out_tar_path)
+    compressor = make_compressor(args.compression,
+                                 level=args.compression_level,
+                                 threads=args.compression_threads)
+    cache = None
+    if args.cache_dir:
+        # Everything that changes the stripped layers.
+        cache = LayerStripCache(args.cache_dir, args.cache_max_size, {
+            'compression': args.compression,
+            'compression_level': args.compression_level,
+            'compression_threads': args.compression_threads,
+            'rewrite_headers': args.rewrite_headers,
+        })
+    if args.out_oci_layout:
+        return strip_tar_streaming(args.in_tar_path, args.out_oci_layout,
+                                   jobs=args.jobs, compressor=compressor,
+                                   rewrite_headers=args.rewrite_headers,
+                                   cache=cache, summary=args.summary_path,
+                                   oci_layout=True,
+                                   layer_media_type=_OCI_LAYERS[
+                                       args.compression])
+    if args.streaming:
+        return strip_tar_streaming(args.in_tar_path, args.out_tar_path,
+                                   jobs=args.jobs, compressor=compressor,
+                                   rewrite_headers=args.rewrite_headers,
+                                   cache=cache, summary=args.summary_path)
+    return strip_tar(args.in_tar_path, args.out_tar_path, jobs=args.jobs,
+                     compressor=compressor,
+                     rewrite_headers=args.rewrite_headers, cache=cache,
+                     summary=args.summary_path)
+
+
+class LayerStripCache(object):
+    """A persistent cache of stripped layers.
+
+    Entries map the digest of an original layer to its stripped blob, along
+    with the diff_id and name of the blob, see layer_cache.LayerCache.
+    """
+
+    def __init__(self, directory, max_size=None, config=None):
+        """Constructor.
+
+        Args:
+          directory: the directory of the cache, created if needed.
+          max_size: the maximum size of the cache in bytes, unbounded if None.
+          config: JSON-serializable description of how layers are stripped,
+              e.g. their compression.
+        """
+        self.cache = LayerCache(directory, max_size)
+        self.config = config
+        # Like the ones of build_tar, the keys cover the tool's source.
+        self.source = digest_path(os.path.abspath(__file__))
+
+    def key(self, f):
+        """Returns the key of the layer read by the file object `f`."""
+        sha = hashlib.sha256()
+        while True:
+            buf = f.read(_HASH_BUF_SIZE)
+            if not buf: break
+            sha.update(buf)
+        return compute_key({
+            'tool': 'config_stripper',
+            'source': self.source,
+            'config': self.config,
+            'layer': sha.hexdigest(),
+        }, [])
+
+    def _outputs(self, directory):
+        outputs = {}
+        for name in ['blob', 'digests.json']:
+            with tempfile.NamedTemporaryFile(dir=directory,
+                                             delete=False) as f:
+                outputs[name] = f.name
+        return outputs
+
+    def fetch(self, key, directory):
+        """Writes a stripped blob from the cache to `directory`.
+
+        Returns:
+          the path of the blob, its name and the diff_id of the stripped
+          layer, or None if the layer is not in the cache.
+        """
+        outputs = self._outputs(directory)
+        if not self.cache.fetch(key, outputs):
+            return None
+        with open(outputs['digests.json'], 'r') as f:
+            digests = json.load(f)
+        os.unlink(outputs['digests.json'])
+        # The same permissions as the blobs stripped to a temporary file.
+        os.chmod(outputs['blob'], 0o600)
+        return (outputs['blob'], digests['name'], digests['diff_id'])
+
+    def publish(self, key, blob, name, diffid):
+        """Adds a stripped blob to the cache."""
+        outputs = self._outputs(os.path.dirname(blob))
+        try:
+            with open(outputs['digests.json'], 'w') as f:
+                json.dump({'name': name, 'diff_id': diffid}, f)
+            os.unlink(outputs['blob'])
+            outputs['blob'] = blob
+            self.cache.publish(key, outputs)
+        finally:
+            os.unlink(outputs['digests.json'])
+
 
+def make_compressor(compression, level=None, threads=0):
+    """Returns a function creating the compressors of stripped layers.
 
-def strip_tar(input, output):
+    Args:
+      compression: one of COMPRESSIONS.
+      level: the compression level, the default one of the compression if None.
+      threads: the number of compressing threads of pgzip (all cores if 0) and
+          zstd.
+
+    Returns:
+      a function taking the file object to write a compressed layer to.
+    """
+    if compression == 'gzip':
+        return functools.partial(_GzipPipe, level=level)
+    if compression == 'zlib':
+        # No file name and a zero mtime, for reproducible headers.
+        make_writer = functools.partial(
+            gzip.GzipFile, filename='', mode='wb', mtime=0,
+            compresslevel=6 if level is None else level)
+    elif compression == 'pgzip':
+        make_writer = functools.partial(
+            ParallelGzipWriter, mtime=0,
+            compresslevel=6 if level is None else level,
+            threads=threads or multiprocessing.cpu_count())
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard module')
+        def make_writer(fileobj):
+            # Compressors can't be shared by layers stripped concurrently.
+            cctx = zstandard.ZstdCompressor(
+                level=3 if level is None else level, threads=threads)
+            return cctx.stream_writer(fileobj, closefd=False)
+    else:
+        raise ValueError('Unknown compression: %s' % compression)
+    return functools.partial(_InProcessCompressor, make_writer=make_writer)
+
+
+def strip_tar(input, output, jobs=1, compressor=None, rewrite_headers=False,
+              cache=None, summary=None):
     # Unpack the tarball, modify configs in place, and rearchive.
     # We need to take care to keep the files sorted.
 
@@ -58,41 +289,71 @@ def strip_tar(input, output):
     mf_path = os.path.join(tempdir, 'manifest.json')
     with open(mf_path, 'r') as mf:
         manifest = json.load(mf)
-    for image in manifest:
-        # Scrape each layer for any timestamps
-        new_layers = []
-        new_diff_ids = []
-        # Process the layers in reverse to fix https://github.com/bazelbuild/rules_docker/issues/1104.
-        # Image tarballs generated by "docker save" can include layer tarballs
-        # that are just symlinks to the previous layer. In the Docker manifest,
-        # the layers are ordered from top to bottom. Thus, as the stripper goes
-        # through these layers in top to bottom order, it may encounter a layer
-        # that symlinks to a lower layer that hasn't been extracted yet. Just
-        # reversing the iteration order avoids this problem.
-        for layer in reversed(image['Layers']):
-          (new_layer_name, new_diff_id) = strip_layer(os.path.join(tempdir, layer))
-
-          new_layers.append(new_layer_name)
-          new_diff_ids.append(new_diff_id)
-        # Reverse the layer order to go back to the topmost layer to bottom as
-        # required by the Docker manifest format.
-        new_layers = [l for l in reversed(new_layers)]
-        new_diff_ids = [d for d in reversed(new_diff_ids)]
-
-        # Change the manifest to reflect the new layer name
-        image['Layers'] = new_layers
-
-        config = image['Config']
-        cfg_path = os.path.join(tempdir, config)
-        new_cfg_path = strip_config(cfg_path, new_diff_ids)
-
-        # Update the name of the config in the metadata object
-        # to match it's new digest.
-        image['Config'] = new_cfg_path
+
+    layers = [os.path.join(tempdir, layer)
+              for image in manifest for layer in image['Layers']]
+    # Image tarballs generated by "docker save" can include layer tarballs
+    # that are just symlinks to another layer, see
+    # https://github.com/bazelbuild/rules_docker/issues/1104, or copies of
+    # another layer. Strip each distinct layer once, and only remove the
+    # original layers once all of them are stripped.
+    unique_layers = _unique_layers(
+        layers,
+        identity=lambda path: (os.stat(path).st_dev, os.stat(path).st_ino),
+        size=lambda path: os.stat(path).st_size,
+        open_layer=lambda path: open(path, 'rb'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        stripped = {}
+        summary_images = []
+        for path in layers:
+            unique_layer = unique_layers[path]
+            if unique_layer not in stripped:
+                stripped[unique_layer] = executor.submit(
+                    _strip_layer_file, unique_layer, compressor,
+                    rewrite_headers, cache)
+
+        for image in manifest:
+            # Scrape each layer for any timestamps
+            new_layers = []
+            new_diff_ids = []
+            layer_sizes = []
+            for layer in image['Layers']:
+                path = os.path.join(tempdir, layer)
+                (new_layer_name, new_diff_id) = (
+                    stripped[unique_layers[path]].result())
+                _place_stripped_layer(path, unique_layers[path],
+                                      new_layer_name)
+
+                new_layers.append(new_layer_name)
+                new_diff_ids.append(new_diff_id)
+                layer_sizes.append(os.path.getsize(os.path.join(
+                    _original_dir(path), new_layer_name)))
+
+            # Change the manifest to reflect the new layer name
+            image['Layers'] = new_layers
+
+            config = image['Config']
+            cfg_path = os.path.join(tempdir, config)
+            (new_cfg_path, config_size) = _strip_config(cfg_path,
+                                                        new_diff_ids)
+
+            # Update the name of the config in the metadata object
+            # to match it's new digest.
+            image['Config'] = new_cfg_path
+            summary_images.append(_image_summary(
+                new_cfg_path, config_size, new_layers, new_diff_ids,
+                layer_sizes))
+
+    for path in layers:
+        if os.path.isdir(os.path.dirname(path)):
+            shutil.rmtree(os.path.dirname(path))
 
     # Rewrite the manifest with the new config names.
-    with open(mf_path, 'w') as f:
-        json.dump(manifest, f, sort_keys=True)
+    manifest_data = _json_bytes(manifest)
+    with open(mf_path, 'wb') as f:
+        f.write(manifest_data)
+    if summary:
+        _write_summary(summary, manifest_data, summary_images)
 
     # Collect the files before adding, so we can sort them.
     files_to_add = []
@@ -112,110 +373,663 @@ def strip_tar(input, output):
     shutil.rmtree(tempdir)
     return 0
 
-def strip_layer(path):
-    # The original layer tar is of the form <random string>/layer.tar, the
-    # working directory is one level up from where layer.tar is.
-    original_dir = os.path.normpath(os.path.join(os.path.dirname(path), '..'))
 
-    # Write compressed tar to a temporary name. We'll rename it to the correct
-    # name after we compute the hash.
-    gz_out = tempfile.NamedTemporaryFile(dir=original_dir, delete=False)
+def strip_tar_streaming(input, output, jobs=1, compressor=None,
+                        rewrite_headers=False, cache=None, summary=None,
+                        oci_layout=False, layer_media_type=_OCI_LAYERS['gzip']):
+    # Same as strip_tar, but reading the input tarball once without extracting
+    # it. Only the manifest and configs are held in memory, and the stripped
+    # layers are compressed straight into the blobs of the output tarball,
+    # which has to wait for all of them since it is sorted by their digests.
+    #
+    # With oci_layout, `output` is a directory the image is written to as an
+    # OCI image layout instead, see _write_oci_layout. Blobs are stripped in
+    # it, so that they are moved rather than copied to their final path.
 
-    # Keep track of sha hash for both the compressed and uncompressed tar
-    uncompressed_sha = hashlib.sha256()
-    compressed_sha = hashlib.sha256()
+    if oci_layout:
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        tempdir = tempfile.mkdtemp(dir=output, prefix='.tmp-')
+    else:
+        tempdir = tempfile.mkdtemp()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    # Layers that are links to, or copies of, the same layer are only
+    # stripped once.
+    stripped_layers = {}
+    try:
+        with tarfile.open(name=input, mode='r') as it:
+            # Only the headers are read here, the content is read on demand.
+            members = dict((m.name, m) for m in it.getmembers())
+            manifest = json.load(it.extractfile(members['manifest.json']))
 
-    # Start a gzip process that we'll use to compress tar output.
-    # Shelling out to bash gzip is noticeably faster than using python's gzip
-    #
-    # This function takes special care to never store the full tar file or
-    # gzip'd tar file in memory. Images can be quite large.
-    gzip_process = subprocess.Popen(
-        ['gzip', '-nf'],
-        stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-
-    # Read the gzip'd output and accumulate the sha hash, and save the
-    # compressed copy under the new name.
-    gzip_stdout_exc = []
-    def do_gzip_stdout():
+            # Map of output names to the paths of the blobs to write them from.
+            blobs = {}
+            # Map of output names to their content, and the member they
+            # replace (to which ownership and permissions are kept).
+            contents = {'manifest.json': (None, members['manifest.json'])}
+            removed = set(['manifest.json'])
+            summary_images = []
+            # Map of layer digests to the paths of their blobs.
+            layer_blobs = {}
+            layers = [layer for image in manifest for layer in image['Layers']]
+            unique_layers = _unique_layers(
+                layers,
+                identity=lambda layer: _resolve_links(members, layer),
+                size=lambda layer: members[_resolve_links(members, layer)].size,
+                open_layer=lambda layer: it.extractfile(members[layer]))
+            for layer in layers:
+                unique_layer = _resolve_links(members, unique_layers[layer])
+                if unique_layer not in stripped_layers:
+                    stripped_layers[unique_layer] = executor.submit(
+                        _strip_layer_stream, input, members[unique_layer],
+                        tempdir, compressor, rewrite_headers, cache)
+
+            for image in manifest:
+                new_layers = []
+                new_diff_ids = []
+                layer_sizes = []
+                for layer in image['Layers']:
+                    (blob, new_layer_name, new_diff_id) = stripped_layers[
+                        _resolve_links(members, unique_layers[layer])].result()
+                    # Mirror where strip_layer puts the stripped layer.
+                    original_dir = os.path.normpath(
+                        os.path.join(os.path.dirname(layer), '..'))
+                    blobs[os.path.normpath(
+                        os.path.join(original_dir, new_layer_name))] = blob
+                    removed.add(os.path.dirname(layer))
+
+                    new_layers.append(new_layer_name)
+                    new_diff_ids.append(new_diff_id)
+                    layer_sizes.append(os.path.getsize(blob))
+                    layer_blobs[new_layer_name] = blob
+                image['Layers'] = new_layers
+
+                config = image['Config']
+                with it.extractfile(members[config]) as f:
+                    config_data = _strip_config_json(json.load(f),
+                                                     new_diff_ids)
+                new_cfg_path = 'sha256:%s' % hashlib.sha256(
+                    config_data).hexdigest()
+                contents[os.path.join(os.path.dirname(config), new_cfg_path)] = (
+                    config_data, members[config])
+                removed.add(config)
+                image['Config'] = new_cfg_path
+                summary_images.append(_image_summary(
+                    new_cfg_path, len(config_data), new_layers, new_diff_ids,
+                    layer_sizes))
+
+            manifest_data = _json_bytes(manifest)
+            contents['manifest.json'] = (manifest_data,
+                                         members['manifest.json'])
+            if summary:
+                _write_summary(summary, manifest_data, summary_images)
+            if oci_layout:
+                _write_oci_layout(output, manifest, summary_images,
+                                  layer_blobs, contents, layer_media_type)
+                return 0
+
+            # Pass through the other files strip_tar would keep.
+            passthrough = {}
+            for name, member in members.items():
+                if (member.isfile() and
+                    os.path.basename(name).startswith(
+                        tuple(WHITELISTED_PREFIXES)) and
+                    not any(name == r or name.startswith(r + '/')
+                            for r in removed)):
+                    passthrough[name] = member
+
+            with tarfile.open(name=output, mode='w') as ot:
+                for name in sorted(set(blobs) | set(contents) |
+                                   set(passthrough)):
+                    if name in blobs:
+                        tarinfo = ot.gettarinfo(blobs[name], name)
+                        tarinfo.mtime = _MTIME
+                        with open(blobs[name], 'rb') as f:
+                            ot.addfile(tarinfo, f)
+                    elif name in contents:
+                        (data, member) = contents[name]
+                        ot.addfile(_extracted_tarinfo(member, name, len(data)),
+                                   io.BytesIO(data))
+                    else:
+                        member = passthrough[name]
+                        ot.addfile(
+                            _extracted_tarinfo(member, name, member.size),
+                            it.extractfile(member))
+    finally:
+        # Don't start stripping more layers after a failure.
+        for future in stripped_layers.values():
+            future.cancel()
+        executor.shutdown()
+        shutil.rmtree(tempdir)
+    return 0
+
+
+def _resolve_links(members, name):
+    """Returns the name of the member a member links to, if it does.
+
+    Raises:
+      KeyError: when a link loops or its target is not in the archive.
+    """
+    seen = set()
+    while name not in seen:
+        seen.add(name)
+        if name not in members:
+            raise KeyError('Link to a missing member: %s' % name)
+        member = members[name]
+        if member.issym():
+            name = os.path.normpath(os.path.join(os.path.dirname(name),
+                                                 member.linkname))
+        elif member.islnk():
+            # Hard links are relative to the root of the archive.
+            name = os.path.normpath(member.linkname)
+        else:
+            return name
+    raise KeyError('Link loop at %s' % name)
+
+
+def _unique_layers(layers, identity, size, open_layer):
+    """Maps each layer to the first layer with the same content.
+
+    Layers with the same identity, e.g. links to the same file, have the same
+    content. The content of the others is only hashed when they have the same
+    size as another one, since layers of different sizes differ.
+
+    Args:
+      layers: the layers, in order.
+      identity: function returning what identifies the file of a layer.
+      size: function returning the size of a layer.
+      open_layer: function returning a file object reading a layer.
+
+    Returns:
+      a dict from each layer to the first one with the same content.
+    """
+    by_identity = collections.OrderedDict()
+    for layer in layers:
+        by_identity.setdefault(identity(layer), layer)
+
+    by_size = collections.OrderedDict()
+    for layer in by_identity.values():
+        by_size.setdefault(size(layer), []).append(layer)
+    unique = {}
+    by_digest = {}
+    for same_size in by_size.values():
+        for layer in same_size:
+            if len(same_size) == 1:
+                unique[layer] = layer
+                continue
+            sha = hashlib.sha256()
+            with open_layer(layer) as f:
+                while True:
+                    buf = f.read(_HASH_BUF_SIZE)
+                    if not buf: break
+                    sha.update(buf)
+            unique[layer] = by_digest.setdefault(sha.digest(), layer)
+
+    return dict((layer, unique[by_identity[identity(layer)]])
+                for layer in layers)
+
+
+def _extracted_tarinfo(member, arcname, size):
+    """Returns the header strip_tar writes for a file it extracted.
+
+    The permissions of extracted files are the ones of their member. When run
+    as root, their ownership is too (by name if it exists, like tarfile does),
+    otherwise they belong to the current user.
+    """
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(member.mode)
+    tarinfo.uid = os.geteuid()
+    tarinfo.gid = os.getegid()
+    if tarinfo.uid == 0:
+        tarinfo.uid = member.uid
+        tarinfo.gid = member.gid
+        try:
+            if member.uname:
+                tarinfo.uid = pwd.getpwnam(member.uname)[2]
+        except KeyError:
+            pass
+        try:
+            if member.gname:
+                tarinfo.gid = grp.getgrnam(member.gname)[2]
+        except KeyError:
+            pass
+    try:
+        tarinfo.uname = pwd.getpwuid(tarinfo.uid)[0]
+    except KeyError:
+        pass
+    try:
+        tarinfo.gname = grp.getgrgid(tarinfo.gid)[0]
+    except KeyError:
+        pass
+    tarinfo.size = size
+    tarinfo.mtime = _MTIME
+    return tarinfo
+
+
+class _Compressor(object):
+    """A write-only file object compressing its input into a file.
+
+    Both the uncompressed and the compressed bytes are hashed as they stream
+    through, so that neither the full tar nor the compressed tar is ever held
+    in memory nor re-read. Images can be quite large.
+
+    Subclasses define _compress(buf), which compresses the input and writes
+    the compressed bytes with _write_compressed, and close(path), which
+    completes the compression, `path` being used for error messages.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+
+        # Keep track of sha hash for both the compressed and uncompressed tar
+        self.uncompressed_sha = hashlib.sha256()
+        self.compressed_sha = hashlib.sha256()
+
+    def write(self, buf):
+        self.uncompressed_sha.update(buf)
+        self._compress(buf)
+        self.offset += len(buf)
+        return len(buf)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def _write_compressed(self, buf):
+        self.compressed_sha.update(buf)
+        self.out.write(buf)
+        return len(buf)
+
+
+class _GzipPipe(_Compressor):
+    """Compresses with the gzip tool."""
+
+    def __init__(self, out, level=None):
+        super(_GzipPipe, self).__init__(out)
+
+        # Start a gzip process that we'll use to compress tar output.
+        # Shelling out to bash gzip is noticeably faster than using python's
+        # gzip.
+        args = ['gzip', '-nf']
+        if level is not None:
+            args.append('-%d' % level)
+        self.process = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+        # Read the gzip'd output and accumulate the sha hash, and save the
+        # compressed copy under the new name.
+        self.stdout_exc = []
+        # Read the gzip stderr for error reporting.
+        self.stderr_buf = io.BytesIO()
+
+        # Start all of the threads to prepare for producing the tar file.
+        self.stdout_thread = threading.Thread(target=self._do_stdout)
+        self.stdout_thread.start()
+        self.stderr_thread = threading.Thread(target=self._do_stderr)
+        self.stderr_thread.start()
+
+    def _do_stdout(self):
         try:
             while True:
-                buf = gzip_process.stdout.read(_BUF_SIZE)
+                buf = self.process.stdout.read(_BUF_SIZE)
                 if not buf: break
-                compressed_sha.update(buf)
-                gz_out.write(buf)
+                self._write_compressed(buf)
         except Exception as e:
-            gzip_stdout_exc.append(e)
+            self.stdout_exc.append(e)
 
-    # Read the gzip stderr for error reporting.
-    gzip_stderr_buf = io.BytesIO()
-    def do_gzip_stderr():
+    def _do_stderr(self):
         # Don't bother incrementally reading stderr.
-        gzip_stderr_buf.write(gzip_process.stderr.read())
+        self.stderr_buf.write(self.process.stderr.read())
+
+    def _compress(self, buf):
+        self.process.stdin.write(buf)
+
+    def close(self, path):
+        self.process.stdin.close() # Causes gzip to terminate.
+        self.stdout_thread.join() # Terminates after gzip closes stdout.
+        self.stderr_thread.join() # Terminates after gzip closes stderr.
+        self.process.wait() # gzip terminated by now.
+
+        # Check if any of our threads or processes failed.
+        if self.stdout_exc:
+            raise self.stdout_exc[0]
+        if self.process.returncode != 0:
+            raise RuntimeError(
+                    'Failed to gzip stripped layer %s. '
+                    'gzip exited with status %d: %s',
+                    path, self.process.returncode, self.stderr_buf.getvalue())
+
+
+class _CompressedSink(object):
+    """The file object the writer of an _InProcessCompressor writes to."""
+
+    def __init__(self, compressor):
+        self.write = compressor._write_compressed
+
+    def flush(self):
+        pass
+
+
+class _InProcessCompressor(_Compressor):
+    """Compresses through a compressing file object, e.g. a gzip.GzipFile."""
 
-    # Start all of the threads to prepare for producing the tar file.
-    gzip_stdout = threading.Thread(target=do_gzip_stdout)
-    gzip_stdout.start()
-    gzip_stderr = threading.Thread(target=do_gzip_stderr)
-    gzip_stderr.start()
+    def __init__(self, out, make_writer):
+        """Constructor.
+
+        Args:
+          out: the file object to write the compressed bytes to.
+          make_writer: function returning the compressing file object writing
+              to its `fileobj` argument.
+        """
+        super(_InProcessCompressor, self).__init__(out)
+        self.writer = make_writer(fileobj=_CompressedSink(self))
+
+    def _compress(self, buf):
+        self.writer.write(buf)
+
+    def close(self, path):
+        self.writer.close()
+
+
+def _strip_layer_tar(it, ot):
+    """Copies the members of tar `it` to tar `ot`, stripping their mtime."""
+    # Go through each file/dir in the layer
+    # Set its mtime to 0
+    # If it's a file, add its content to the running buffer
+    # Add it to the new gzip'd tar.
+    for tarinfo in it:
+        tarinfo.mtime = _LAYER_MTIME
+        if tarinfo.isfile():
+            f = it.extractfile(tarinfo)
+            ot.addfile(tarinfo, f)
+        else:
+            ot.addfile(tarinfo)
+
+
+def _is_stripped_layer(f):
+    """Returns whether stripping the layer tar `f` would leave it unchanged.
+
+    That is the case when the layer is laid out the way tarfile writes it, and
+    re-encoding its headers with the stripped mtime gives back their bytes,
+    e.g. for layers built by container_layer. Only the headers and the padding
+    of the layer are read.
+
+    Args:
+      f: a seekable file object of the layer, left at an unspecified position.
+    """
     try:
-        # Go through each file/dir in the layer
-        # Set its mtime to 0
-        # If it's a file, add its content to the running buffer
-        # Add it to the new gzip'd tar.
-        with tempfile.TemporaryFile() as t:
-            with tarfile.open(name=path, mode='r') as it:
-                with tarfile.open(fileobj=t, encoding='utf-8', mode='w') as ot:
-                    for tarinfo in it:
-                        # Use a deterministic mtime that doesn't confuse other
-                        # programs,  e.g. Python.  Also see
-                        # https://github.com/bazelbuild/bazel/issues/1299
-                        tarinfo.mtime = 946684800 # 2000-01-01 00:00:00.000 UTC
-                        if tarinfo.isfile():
-                            f = it.extractfile(tarinfo)
-                            ot.addfile(tarinfo, f)
-                        else:
-                            ot.addfile(tarinfo)
+        members = tarfile.open(fileobj=f, mode='r:').getmembers()
+    except tarfile.TarError:
+        return False
 
-            # Read the stripped tarfile. Accumulate a hash of the uncompressed
-            # file and send data on to the gzip process for compression.
-            t.seek(0)
-            while True:
-                buf = t.read(_BUF_SIZE)
-                if not buf: break
-                uncompressed_sha.update(buf)
-                gzip_process.stdin.write(buf)
+    offset = 0
+    for member in members:
+        tarinfo = copy.copy(member)
+        tarinfo.mtime = _LAYER_MTIME
+        header = tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        if (member.offset != offset or
+            member.offset_data != offset + len(header)):
+            return False
+        f.seek(offset)
+        if f.read(len(header)) != header:
+            return False
+        offset = member.offset_data
+        if member.isfile():
+            # The content is kept as is, but its padding must be zeros.
+            f.seek(offset + member.size)
+            padding = -member.size % tarfile.BLOCKSIZE
+            if f.read(padding) != tarfile.NUL * padding:
+                return False
+            offset += member.size + padding
+
+    # The end of archive marker, padded to a full record, and nothing else.
+    end = offset + 2 * tarfile.BLOCKSIZE
+    end += -end % tarfile.RECORDSIZE
+    f.seek(offset)
+    return f.read(end - offset + 1) == tarfile.NUL * (end - offset)
+
+
+def _copy_to(f, out):
+    """Copies the file object `f` from its start to `out`."""
+    f.seek(0)
+    shutil.copyfileobj(f, out, _HASH_BUF_SIZE)
+
+
+def _strip_layer_file(path, compressor=None, rewrite_headers=False,
+                      cache=None):
+    """Strips a layer into a blob next to its directory, see strip_layer."""
+    original_dir = _original_dir(path)
+
+    if cache:
+        with open(path, 'rb') as f:
+            key = cache.key(f)
+        fetched = cache.fetch(key, original_dir)
+        if fetched:
+            (blob, new_name, diffid) = fetched
+            os.rename(blob, os.path.join(original_dir, new_name))
+            return (new_name, diffid)
+
+    # Write compressed tar to a temporary name. We'll rename it to the correct
+    # name after we compute the hash.
+    gz_out = tempfile.NamedTemporaryFile(dir=original_dir, delete=False)
+
+    compressed = (compressor or _GzipPipe)(gz_out)
+    try:
+        with open(path, 'rb') as f:
+            if _is_stripped_layer(f):
+                # Only compress and hash the layer.
+                _copy_to(f, compressed)
+            elif rewrite_headers:
+                f.seek(0)
+                rewrite_tar_mtimes(f, compressed, _LAYER_MTIME)
+            else:
+                with tempfile.TemporaryFile() as t:
+                    f.seek(0)
+                    with tarfile.open(fileobj=f, mode='r') as it:
+                        with tarfile.open(fileobj=t, encoding='utf-8',
+                                          mode='w') as ot:
+                            _strip_layer_tar(it, ot)
+
+                    # Read the stripped tarfile. Accumulate a hash of the
+                    # uncompressed file and send data on to the compressor.
+                    _copy_to(t, compressed)
     finally:
-        gzip_process.stdin.close() # Causes gzip to terminate.
-        gzip_stdout.join() # Terminates after gzip closes stdout.
-        gzip_stderr.join() # Terminates after gzip closes stderr.
-        gzip_process.wait() # gzip terminated by now.
-
-    # Check if any of our threads or processes failed.
-    if gzip_stdout_exc:
-        raise gzip_stdout_exc[0]
-    if gzip_process.returncode != 0:
-        raise RuntimeError(
-                'Failed to gzip stripped layer %s. '
-                'gzip exited with status %d: %s',
-                path, gzip_process.returncode, gzip_stderr_buf.getvalue())
+        compressed.close(path)
+        gz_out.close()
 
     # Create the new diff_id for the config
-    diffid = 'sha256:%s' % uncompressed_sha.hexdigest()
+    diffid = 'sha256:%s' % compressed.uncompressed_sha.hexdigest()
 
     # Rename into correct location now that we know the hash.
-    new_name = 'sha256:%s' % compressed_sha.hexdigest()
+    new_name = 'sha256:%s' % compressed.compressed_sha.hexdigest()
     os.rename(gz_out.name, os.path.join(original_dir, new_name))
+    if cache:
+        cache.publish(key, os.path.join(original_dir, new_name), new_name,
+                      diffid)
+    return (new_name, diffid)
+
+
+def _original_dir(path):
+    # The original layer tar is of the form <random string>/layer.tar, the
+    # working directory is one level up from where layer.tar is.
+    return os.path.normpath(os.path.join(os.path.dirname(path), '..'))
 
+
+def _place_stripped_layer(path, unique_layer, new_name):
+    """Copies a layer stripped as `unique_layer` next to the layer `path`."""
+    blob = os.path.join(_original_dir(path), new_name)
+    if not os.path.exists(blob):
+        shutil.copy(os.path.join(_original_dir(unique_layer), new_name), blob)
+
+
+def strip_layer(path, compressor=None, rewrite_headers=False, cache=None):
+    (new_name, diffid) = _strip_layer_file(path, compressor, rewrite_headers,
+                                           cache)
     shutil.rmtree(os.path.dirname(path))
     return (new_name, diffid)
 
 
-def strip_config(path, new_diff_ids):
-    with open(path, 'r') as f:
-        config = json.load(f)
+def _strip_layer_stream(input, member, directory, compressor=None,
+                        rewrite_headers=False, cache=None):
+    """Strips a layer of the tarball `input` into a new blob in `directory`.
+
+    The layer is read from the input tarball and the stripped layer written to
+    gzip as they stream, without intermediate copies. The input tarball is
+    opened again, reading from its own file allows stripping layers
+    concurrently. Its members are not scanned again, the one of the layer
+    is enough to read it.
+
+    Returns:
+      the path of the blob, its name and the diff_id of the stripped layer.
+    """
+    if cache:
+        with tarfile.open(name=input, mode='r') as it:
+            key = cache.key(it.extractfile(member))
+        fetched = cache.fetch(key, directory)
+        if fetched:
+            return fetched
+
+    gz_out = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    compressed = (compressor or _GzipPipe)(gz_out)
+    try:
+        with tarfile.open(name=input, mode='r') as it:
+            f = it.extractfile(member)
+            if _is_stripped_layer(f):
+                # Only compress and hash the layer.
+                _copy_to(f, compressed)
+            elif rewrite_headers:
+                f.seek(0)
+                rewrite_tar_mtimes(f, compressed, _LAYER_MTIME)
+            else:
+                f.seek(0)
+                with tarfile.open(fileobj=f, mode='r|*') as lt:
+                    with tarfile.open(fileobj=compressed, encoding='utf-8',
+                                      mode='w') as ot:
+                        _strip_layer_tar(lt, ot)
+    finally:
+        compressed.close(member.name)
+        gz_out.close()
+
+    diffid = 'sha256:%s' % compressed.uncompressed_sha.hexdigest()
+    new_name = 'sha256:%s' % compressed.compressed_sha.hexdigest()
+    if cache:
+        cache.publish(key, gz_out.name, new_name, diffid)
+    return (gz_out.name, new_name, diffid)
+
+
+def _write_oci_layout(directory, manifest, images, layer_blobs, contents,
+                      layer_media_type):
+    """Writes stripped images to an OCI image layout.
+
+    See https://github.com/opencontainers/image-spec/blob/main/image-layout.md.
+    Blobs are moved to blobs/sha256/<digest>, and index.json is written last,
+    with one manifest per image annotated with each of its RepoTags.
+
+    Args:
+      directory: the directory of the layout.
+      manifest: the stripped docker save manifest.
+      images: the summary of each image of the manifest, see _image_summary.
+      layer_blobs: map of layer digests to the paths of their blobs.
+      contents: map of the names of the configs in the output tarball to
+          their content, and the member they replace.
+      layer_media_type: the media type of the stripped layers.
+    """
+    blobs_dir = os.path.join(directory, 'blobs', 'sha256')
+    if not os.path.isdir(blobs_dir):
+        os.makedirs(blobs_dir)
+
+    def blob_path(digest):
+        return os.path.join(blobs_dir, digest[len('sha256:'):])
+
+    def write_blob(data):
+        digest = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+        with open(blob_path(digest), 'wb') as f:
+            f.write(data)
+        return {'digest': digest, 'size': len(data)}
+
+    for digest, blob in layer_blobs.items():
+        os.chmod(blob, 0o644)
+        os.rename(blob, blob_path(digest))
+    configs = dict((os.path.basename(name), data)
+                   for name, (data, _) in contents.items())
+
+    index = []
+    for image, summary in zip(manifest, images):
+        write_blob(configs[image['Config']])
+        descriptor = write_blob(_json_bytes({
+            'schemaVersion': 2,
+            'mediaType': _OCI_MANIFEST,
+            'config': dict(summary['config'], mediaType=_OCI_CONFIG),
+            'layers': [{'mediaType': layer_media_type,
+                        'digest': layer['digest'],
+                        'size': layer['size']}
+                       for layer in summary['layers']],
+        }))
+        descriptor['mediaType'] = _OCI_MANIFEST
+        for tag in image.get('RepoTags') or [None]:
+            entry = dict(descriptor)
+            if tag:
+                entry['annotations'] = {
+                    'io.containerd.image.name': tag,
+                    'org.opencontainers.image.ref.name': tag.rsplit(':', 1)[-1],
+                }
+            index.append(entry)
+
+    with open(os.path.join(directory, 'oci-layout'), 'wb') as f:
+        f.write(_json_bytes({'imageLayoutVersion': '1.0.0'}))
+    with open(os.path.join(directory, 'index.json'), 'wb') as f:
+        f.write(_json_bytes({
+            'schemaVersion': 2,
+            'mediaType': _OCI_INDEX,
+            'manifests': index,
+        }))
+
+
+def _json_bytes(obj):
+    """Returns the serialization of `obj` in the tarballs, as UTF-8 bytes.
+
+    The bytes are encoded once, then both hashed and written, rather than
+    encoded again for each.
+    """
+    return json.dumps(obj, sort_keys=True).encode('utf-8')
+
+
+def _image_summary(config, config_size, layers, diff_ids, layer_sizes):
+    return {
+        'config': {'digest': config, 'size': config_size},
+        'layers': [{'digest': layer, 'diff_id': diff_id, 'size': size}
+                   for layer, diff_id, size in zip(layers, diff_ids,
+                                                   layer_sizes)],
+    }
+
+
+def _write_summary(path, manifest_data, images):
+    """Writes the digests of the output tarball to the JSON file `path`.
+
+    Args:
+      path: the path of the summary.
+      manifest_data: the bytes of the output manifest.json.
+      images: the summary of each image of the manifest, see _image_summary.
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'manifest': {
+                'digest': 'sha256:%s' % hashlib.sha256(
+                    manifest_data).hexdigest(),
+                'size': len(manifest_data),
+            },
+            'images': images,
+        }, f, indent=2, sort_keys=True)
+
+
+def _strip_config_json(config, new_diff_ids):
+    """Strips a parsed config in place, and returns its serialization."""
     config['created'] = _TIMESTAMP
     config['rootfs']['diff_ids'] = new_diff_ids
 
@@ -233,15 +1047,30 @@ def strip_config(path, new_diff_ids):
     for entry in config['history']:
         entry['created'] = _TIMESTAMP
 
-    config_str = json.dumps(config, sort_keys=True)
-    with open(path, 'w') as f:
-        f.write(config_str)
+    return _json_bytes(config)
+
+
+def _strip_config(path, new_diff_ids):
+    """Strips a config file, see strip_config.
+
+    Returns:
+      the new name of the config, and its size.
+    """
+    with open(path, 'rb') as f:
+        config = json.load(f)
+    config_data = _strip_config_json(config, new_diff_ids)
+    with open(path, 'wb') as f:
+        f.write(config_data)
 
     # Calculate the new file path
-    sha = hashlib.sha256(config_str.encode("utf-8")).hexdigest()
+    sha = hashlib.sha256(config_data).hexdigest()
     new_path = 'sha256:%s' % sha
     os.rename(path, os.path.join(os.path.dirname(path), new_path))
-    return new_path
+    return (new_path, len(config_data))
+
+
+def strip_config(path, new_diff_ids):
+    return _strip_config(path, new_diff_ids)[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,392 @@
+# Copyright 2017 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the config_stripper tool.
+
+Generates a synthetic `docker save` tarball and strips it with each variant of
+the tool, reporting the wall time, the peak RSS, the bytes read and written and
+the high-water mark of the temporary directory:
+
+  bazel run //docker/util:config_stripper_benchmark -- \\
+      --layers=8 --files=20000 --file_size=65536 --symlinked_layers=2
+
+Each variant runs in its own process, so that their peak RSS are not mixed up.
+Images are generated from a fixed seed, and --output_json and --baseline_json
+save and compare the results across commits:
+
+  bazel run //docker/util:config_stripper_benchmark -- \\
+      --output_json=/tmp/before.json
+  bazel run //docker/util:config_stripper_benchmark -- \\
+      --baseline_json=/tmp/before.json
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from container.archive import _HashingWriter
+from docker.util import config_stripper
+
+VARIANTS = ['strip_tar', 'jobs', 'streaming', 'rewrite_headers']
+
+DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+# The sigma of the lognormal distribution of file sizes. Most files are small,
+# and a few are orders of magnitude larger than the mean.
+_LOGNORMAL_SIGMA = 1.5
+
+# Generated content is sliced from a pool of blocks, each either random or
+# repeated text, so that layers compress about as much as real ones do.
+_POOL_BLOCKS = 256
+_BLOCK_SIZE = 4096
+
+
+class _PoolReader(object):
+    """A file object reading `size` bytes from a pool of content."""
+
+    def __init__(self, pool, offset, size):
+        self.pool = pool
+        self.offset = offset % len(pool)
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        self.remaining -= n
+        chunks = []
+        while n:
+            chunk = self.pool[self.offset:self.offset + n]
+            self.offset = (self.offset + len(chunk)) % len(self.pool)
+            n -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+def _make_pool(rng, redundancy):
+    blocks = []
+    for _ in range(_POOL_BLOCKS):
+        if rng.random() < redundancy:
+            line = ('%x lorem ipsum dolor sit amet\n' %
+                    rng.getrandbits(32)).encode('ascii')
+            blocks.append((line * (_BLOCK_SIZE // len(line) + 1))[:_BLOCK_SIZE])
+        else:
+            blocks.append(rng.getrandbits(8 * _BLOCK_SIZE).to_bytes(
+                _BLOCK_SIZE, 'little'))
+    return b''.join(blocks)
+
+
+def _file_size(rng, distribution, mean):
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * mean)
+    if distribution == 'lognormal':
+        mu = math.log(max(mean, 1)) - _LOGNORMAL_SIGMA ** 2 / 2
+        return int(rng.lognormvariate(mu, _LOGNORMAL_SIGMA))
+    return mean
+
+
+def _write_layer(f, rng, pool, files, file_size, distribution):
+    """Writes a layer of `files` files to `f` and returns its diff_id."""
+    out = _HashingWriter(f)
+    with tarfile.open(fileobj=out, mode='w|', format=tarfile.GNU_FORMAT) as t:
+        for i in range(files):
+            if i % 100 == 0:
+                directory = 'usr/lib/d%d' % (i // 100)
+                tarinfo = tarfile.TarInfo(directory)
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = 0o755
+                tarinfo.mtime = rng.randint(1, 2 ** 31)
+                t.addfile(tarinfo)
+            tarinfo = tarfile.TarInfo('%s/f%d' % (directory, i))
+            tarinfo.size = _file_size(rng, distribution, file_size)
+            tarinfo.mode = 0o644
+            tarinfo.mtime = rng.randint(1, 2 ** 31)
+            t.addfile(tarinfo, _PoolReader(pool, rng.randrange(len(pool)),
+                                           tarinfo.size))
+    return 'sha256:%s' % out.hexdigest()
+
+
+def generate_image(path, layers, files, file_size, distribution='fixed',
+                   symlinked_layers=0, redundancy=0.5, seed=0):
+    """Writes a synthetic `docker save` tarball to `path`.
+
+    Args:
+      path: the path of the tarball.
+      layers: the number of distinct layers.
+      files: the number of files in each layer.
+      file_size: the mean size of the files, in bytes.
+      distribution: how file sizes are distributed around their mean, one of
+          DISTRIBUTIONS.
+      symlinked_layers: the number of additional layers which are symlinks to
+          distinct ones, as `docker save` writes layers shared by images.
+      redundancy: the fraction of the content which is repeated text rather
+          than random bytes.
+      seed: the seed of the generated content.
+    """
+    rng = random.Random(seed)
+    pool = _make_pool(rng, redundancy)
+    layer_paths = []
+    diff_ids = []
+
+    def add(name, data):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = rng.randint(1, 2 ** 31)
+        image.addfile(tarinfo, _PoolReader(data, 0, len(data)))
+
+    with tarfile.open(path, mode='w') as image:
+        for _ in range(layers):
+            directory = '%064x' % rng.getrandbits(256)
+            with tempfile.TemporaryFile() as f:
+                diff_ids.append(_write_layer(f, rng, pool, files, file_size,
+                                             distribution))
+                f.seek(0)
+                image.addfile(image.gettarinfo(arcname=directory + '/layer.tar',
+                                               fileobj=f), f)
+            add(directory + '/VERSION', b'1.0')
+            add(directory + '/json', json.dumps({'id': directory}).encode())
+            layer_paths.append(directory + '/layer.tar')
+        for i in range(symlinked_layers):
+            directory = '%064x' % rng.getrandbits(256)
+            target = layer_paths[i % layers]
+            tarinfo = tarfile.TarInfo(directory + '/layer.tar')
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = '../' + target
+            image.addfile(tarinfo)
+            layer_paths.append(directory + '/layer.tar')
+            diff_ids.append(diff_ids[i % layers])
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'created': '2017-01-01T00:00:00Z',
+            'config': {'Env': ['PATH=/usr/bin']},
+            'history': [{'created': '2017-01-01T00:00:00Z'}
+                        for _ in layer_paths],
+            'rootfs': {'type': 'layers', 'diff_ids': diff_ids},
+        }).encode()
+        config_name = '%s.json' % hashlib.sha256(config).hexdigest()
+        add(config_name, config)
+        add('manifest.json', json.dumps([{
+            'Config': config_name,
+            'RepoTags': ['bazel/benchmark:latest'],
+            'Layers': layer_paths,
+        }]).encode())
+
+
+def _disk_usage(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                # Removed while walking.
+                pass
+    return total
+
+
+def _proc_io():
+    """Returns the I/O counters of this process, or {} if not available."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return dict((k, int(v)) for k, v in
+                        (line.split(':') for line in f))
+    except (IOError, OSError):
+        return {}
+
+
+def run_variant(args):
+    """Strips an image in this process and prints its metrics as JSON."""
+    kwargs = {}
+    strip = config_stripper.strip_tar
+    if args.variant == 'jobs':
+        kwargs['jobs'] = args.jobs
+    elif args.variant == 'streaming':
+        strip = config_stripper.strip_tar_streaming
+        kwargs['jobs'] = args.jobs
+    elif args.variant == 'rewrite_headers':
+        kwargs['rewrite_headers'] = True
+    start = time.time()
+    strip(args.image, args.output, **kwargs)
+    elapsed = time.time() - start
+    io = _proc_io()
+    print(json.dumps({
+        'wall_time': elapsed,
+        # In KiB on Linux, in bytes on macOS.
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss *
+                    (1 if sys.platform == 'darwin' else 1024),
+        'bytes_read': io.get('rchar'),
+        'bytes_written': io.get('wchar'),
+    }))
+
+
+def measure_variant(variant, image, workdir, args):
+    """Runs a variant in a child process and returns its metrics.
+
+    The high-water mark of the temporary directory is polled by this process,
+    which points the child to a fresh TMPDIR.
+    """
+    tmpdir = tempfile.mkdtemp(dir=workdir)
+    output = os.path.join(workdir, 'output.tar')
+    env = dict(os.environ)
+    env['TMPDIR'] = tmpdir
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--variant', variant,
+         '--image', image, '--output', output, '--jobs', str(args.jobs)],
+        env=env, stdout=subprocess.PIPE)
+    high_water = [0]
+    done = threading.Event()
+
+    def poll():
+        while not done.wait(args.poll_interval):
+            high_water[0] = max(high_water[0], _disk_usage(tmpdir))
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    try:
+        stdout, _ = child.communicate()
+    finally:
+        done.set()
+        poller.join()
+    if child.returncode != 0:
+        raise Exception('Variant %s failed with %d' % (variant,
+                                                       child.returncode))
+    metrics = json.loads(stdout.decode('utf-8'))
+    metrics['temp_disk'] = high_water[0]
+    metrics['output_size'] = os.path.getsize(output)
+    shutil.rmtree(tmpdir)
+    os.remove(output)
+    return metrics
+
+
+def _mib(n):
+    return '-' if n is None else '%.1f MiB' % (n / (1024.0 * 1024.0))
+
+
+def _print_results(results, baseline):
+    print('%-16s %10s %12s %12s %12s %12s' % (
+        'variant', 'wall', 'peak rss', 'read', 'written', 'temp disk'))
+    for variant, m in results.items():
+        line = '%-16s %8.3f s %12s %12s %12s %12s' % (
+            variant, m['wall_time'], _mib(m['peak_rss']),
+            _mib(m['bytes_read']), _mib(m['bytes_written']),
+            _mib(m['temp_disk']))
+        if variant in baseline:
+            line += '  (%+.1f%% wall time)' % (
+                100.0 * (m['wall_time'] / baseline[variant]['wall_time'] - 1))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the config_stripper tool.')
+    parser.add_argument('--variants', default=','.join(VARIANTS),
+                        help='Comma-separated variants of the tool to run, '
+                        'among %s.' % ', '.join(VARIANTS))
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='The number of jobs of the jobs and streaming '
+                        'variants.')
+    parser.add_argument('--layers', type=int, default=4,
+                        help='Number of distinct layers in the image.')
+    parser.add_argument('--symlinked_layers', type=int, default=1,
+                        help='Number of additional layers symlinked to '
+                        'distinct ones.')
+    parser.add_argument('--files', type=int, default=5000,
+                        help='Number of files in each layer.')
+    parser.add_argument('--file_size', type=int, default=64 * 1024,
+                        help='Mean size of each file, in bytes.')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        default='lognormal',
+                        help='The distribution of the file sizes.')
+    parser.add_argument('--redundancy', type=float, default=0.5,
+                        help='Fraction of the content that compresses well.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the generated image.')
+    parser.add_argument('--image_path',
+                        help='Where to keep the generated image. It is reused '
+                        'if it exists, and removed after the run if unset.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Number of runs of each variant, the fastest is '
+                        'kept.')
+    parser.add_argument('--poll_interval', type=float, default=0.05,
+                        help='Seconds between two measures of the temporary '
+                        'directory.')
+    parser.add_argument('--output_json',
+                        help='Write the results to this JSON file.')
+    parser.add_argument('--baseline_json',
+                        help='Compare the results to the ones of a previous '
+                        '--output_json.')
+    # Arguments of the child processes running each variant.
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--image', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        return run_variant(args)
+
+    variants = args.variants.split(',')
+    for variant in variants:
+        if variant not in VARIANTS:
+            parser.error('Unknown variant: %s' % variant)
+    params = dict((k, getattr(args, k)) for k in [
+        'layers', 'symlinked_layers', 'files', 'file_size', 'distribution',
+        'redundancy', 'seed', 'jobs'])
+
+    workdir = tempfile.mkdtemp()
+    try:
+        image = args.image_path or os.path.join(workdir, 'image.tar')
+        if not os.path.exists(image):
+            start = time.time()
+            generate_image(image, args.layers, args.files, args.file_size,
+                           distribution=args.distribution,
+                           symlinked_layers=args.symlinked_layers,
+                           redundancy=args.redundancy, seed=args.seed)
+            print('Generated %s in %.1f s' % (_mib(os.path.getsize(image)),
+                                              time.time() - start))
+        results = {}
+        for variant in variants:
+            runs = [measure_variant(variant, image, workdir, args)
+                    for _ in range(args.runs)]
+            results[variant] = min(runs, key=lambda m: m['wall_time'])
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = {}
+    if args.baseline_json:
+        with open(args.baseline_json, 'r') as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print('The baseline was run with different parameters: %s' %
+                  baseline['params'])
+        baseline = baseline['results']
+    _print_results(results, baseline)
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,50 @@
 # Lint as: python3
 """Tests for config_stripper."""
 
+import filecmp
+import gzip
+import hashlib
+import io
+import json
 import os
+import tarfile
 import unittest
 
+from docker.util.config_stripper import LayerStripCache
+from docker.util.config_stripper import _is_stripped_layer
+from docker.util.config_stripper import _resolve_links
+from docker.util.config_stripper import _strip_layer_tar
+from docker.util.config_stripper import _unique_layers
+from docker.util.config_stripper import make_compressor
 from docker.util.config_stripper import strip_tar
+from docker.util.config_stripper import strip_tar_streaming
+
+
+def _tar_bytes(files, mtime):
+    """Returns a tar of files, a list of (name, content) pairs."""
+    b = io.BytesIO()
+    with tarfile.open(fileobj=b, mode='w') as t:
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = mtime
+            t.addfile(info, io.BytesIO(content))
+    return b.getvalue()
+
+
+def _image_tar(path, layers, config=None, repo_tags=None):
+    """Writes a docker save tarball of layers, a list of (name, tar) pairs."""
+    if config is None:
+        config = {'rootfs': {'diff_ids': []}, 'history': []}
+    manifest = {'Config': 'config.json', 'Layers': [l for l, _ in layers]}
+    if repo_tags:
+        manifest['RepoTags'] = repo_tags
+    with open(path, 'wb') as f:
+        f.write(_tar_bytes(list(layers) + [
+            ('config.json', json.dumps(config).encode()),
+            ('manifest.json', json.dumps([manifest]).encode()),
+        ], 0))
+
 
 class ConfigStripperTest(unittest.TestCase):
     def test_image_with_symlinked_layers(self):
@@ -36,5 +76,251 @@ class ConfigStripperTest(unittest.TestCase):
                 "Config stripper did not produce stripped tarball {}".format(
                     out_tar))
 
+    def test_streaming_matches_strip_tar(self):
+        img_tar = os.path.join(
+            os.environ['TEST_SRCDIR'],
+            'io_bazel_rules_docker',
+            'docker/util/testdata/image_with_symlinked_layer.tar')
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_streaming_out.tar")
+        streaming_out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_streaming_streaming_out.tar")
+        strip_tar(img_tar, out_tar)
+        strip_tar_streaming(img_tar, streaming_out_tar)
+        self.assertTrue(
+            filecmp.cmp(out_tar, streaming_out_tar, shallow=False))
+
+    def test_jobs_do_not_change_output(self):
+        img_tar = os.path.join(
+            os.environ['TEST_SRCDIR'],
+            'io_bazel_rules_docker',
+            'docker/util/testdata/image_with_symlinked_layer.tar')
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_jobs_out.tar")
+        parallel_out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_jobs_parallel_out.tar")
+        strip_tar(img_tar, out_tar)
+        strip_tar(img_tar, parallel_out_tar, jobs=4)
+        self.assertTrue(filecmp.cmp(out_tar, parallel_out_tar, shallow=False))
+        strip_tar_streaming(img_tar, parallel_out_tar, jobs=4)
+        self.assertTrue(filecmp.cmp(out_tar, parallel_out_tar, shallow=False))
+
+    def test_already_stripped_layer(self):
+        layer = _tar_bytes([('a/' + 'b' * 200, b'foo'), ('c', b'')], 12345)
+        self.assertFalse(_is_stripped_layer(io.BytesIO(layer)))
+        stripped = io.BytesIO()
+        with tarfile.open(fileobj=io.BytesIO(layer), mode='r') as it:
+            with tarfile.open(fileobj=stripped, encoding='utf-8',
+                              mode='w') as ot:
+                _strip_layer_tar(it, ot)
+        self.assertTrue(_is_stripped_layer(io.BytesIO(stripped.getvalue())))
+        # Trailing data would not be kept.
+        self.assertFalse(
+            _is_stripped_layer(io.BytesIO(stripped.getvalue() + b'\0')))
+
+        img_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_already_stripped_layer.tar")
+        _image_tar(img_tar, [('l/layer.tar', stripped.getvalue())])
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_already_stripped_layer_out.tar")
+        for strip in [strip_tar, strip_tar_streaming]:
+            strip(img_tar, out_tar)
+            with tarfile.open(out_tar) as t:
+                manifest = json.load(t.extractfile('manifest.json'))
+                config = json.load(t.extractfile(manifest[0]['Config']))
+            self.assertEqual(
+                ['sha256:' + hashlib.sha256(stripped.getvalue()).hexdigest()],
+                config['rootfs']['diff_ids'])
+
+    def test_in_process_compression(self):
+        img_tar = os.path.join(
+            os.environ['TEST_SRCDIR'],
+            'io_bazel_rules_docker',
+            'docker/util/testdata/image_with_symlinked_layer.tar')
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_in_process_compression_out.tar")
+        for compression, threads in [('zlib', 0), ('pgzip', 1), ('pgzip', 4)]:
+            strip_tar(img_tar, out_tar, compressor=make_compressor(
+                compression, threads=threads))
+            with tarfile.open(out_tar) as t:
+                manifest = json.load(t.extractfile('manifest.json'))
+                config = json.load(t.extractfile(manifest[0]['Config']))
+                for layer, diff_id in zip(manifest[0]['Layers'],
+                                          config['rootfs']['diff_ids']):
+                    blob = t.extractfile(layer).read()
+                    self.assertEqual(
+                        layer, 'sha256:' + hashlib.sha256(blob).hexdigest())
+                    self.assertEqual(diff_id, 'sha256:' + hashlib.sha256(
+                        gzip.decompress(blob)).hexdigest())
+
+    def test_rewrite_headers(self):
+        img_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_rewrite_headers.tar")
+        _image_tar(img_tar, [('l/layer.tar', _tar_bytes(
+            [('a/' + 'b' * 200, b'foo'), ('c', b'bar')], 12345))])
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_rewrite_headers_out.tar")
+        rewritten_out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_rewrite_headers_rewritten_out.tar")
+        strip_tar(img_tar, out_tar)
+        for strip in [strip_tar, strip_tar_streaming]:
+            strip(img_tar, rewritten_out_tar, rewrite_headers=True)
+            self.assertTrue(
+                filecmp.cmp(out_tar, rewritten_out_tar, shallow=False))
+
+    def test_layer_cache(self):
+        img_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_layer_cache.tar")
+        _image_tar(img_tar, [
+            ('l/layer.tar', _tar_bytes([('a', b'foo'), ('b', b'bar')], 1))])
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_layer_cache_out.tar")
+        cached_out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_layer_cache_cached_out.tar")
+        cache_dir = os.path.join(os.environ["TEST_TMPDIR"], "layer_cache")
+        strip_tar(img_tar, out_tar)
+        for strip in [strip_tar, strip_tar_streaming]:
+            cache = LayerStripCache(cache_dir)
+            # Once to fill the cache, once from it.
+            for _ in range(2):
+                strip(img_tar, cached_out_tar, cache=cache)
+                self.assertTrue(
+                    filecmp.cmp(out_tar, cached_out_tar, shallow=False))
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+
+    def test_summary(self):
+        img_tar = os.path.join(os.environ["TEST_TMPDIR"], "test_summary.tar")
+        _image_tar(img_tar, [('l/layer.tar', _tar_bytes([('a', b'foo')], 1))])
+        out_tar = os.path.join(os.environ["TEST_TMPDIR"], "test_summary_out.tar")
+        summary_path = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_summary.json")
+
+        def digest(t, name):
+            data = t.extractfile(name).read()
+            return {'digest': 'sha256:%s' % hashlib.sha256(data).hexdigest(),
+                    'size': len(data)}
+
+        for strip in [strip_tar, strip_tar_streaming]:
+            strip(img_tar, out_tar, summary=summary_path)
+            with open(summary_path, 'r') as f:
+                summary = json.load(f)
+            with tarfile.open(out_tar, mode='r') as t:
+                manifest = json.load(t.extractfile('manifest.json'))
+                self.assertEqual(digest(t, 'manifest.json'),
+                                 summary['manifest'])
+                config = manifest[0]['Config']
+                self.assertEqual(digest(t, config),
+                                 summary['images'][0]['config'])
+                self.assertEqual(config, summary['images'][0]['config']['digest'])
+                layer = manifest[0]['Layers'][0]
+                diff_ids = json.load(t.extractfile(config))['rootfs']['diff_ids']
+                self.assertEqual([dict(digest(t, layer), diff_id=diff_ids[0])],
+                                 summary['images'][0]['layers'])
+                self.assertEqual(layer, summary['images'][0]['layers'][0]['digest'])
+
+    def test_oci_layout(self):
+        img_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_oci_layout.tar")
+        _image_tar(img_tar, [('l/layer.tar', _tar_bytes([('a', b'foo')], 1))],
+                   repo_tags=['bazel/image:tag'])
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_oci_layout_out.tar")
+        layout = os.path.join(os.environ["TEST_TMPDIR"], "test_oci_layout")
+        strip_tar(img_tar, out_tar)
+        strip_tar_streaming(img_tar, layout, oci_layout=True)
+
+        def blob(digest):
+            with open(os.path.join(layout, 'blobs', 'sha256',
+                                   digest.split(':')[1]), 'rb') as f:
+                data = f.read()
+            self.assertEqual(digest,
+                             'sha256:%s' % hashlib.sha256(data).hexdigest())
+            return data
+
+        with open(os.path.join(layout, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.assertEqual(1, len(index['manifests']))
+        self.assertEqual(
+            'tag',
+            index['manifests'][0]['annotations'][
+                'org.opencontainers.image.ref.name'])
+        image = json.loads(blob(index['manifests'][0]['digest']))
+        with tarfile.open(out_tar, mode='r') as t:
+            manifest = json.load(t.extractfile('manifest.json'))
+            self.assertEqual(manifest[0]['Config'], image['config']['digest'])
+            self.assertEqual(t.extractfile(manifest[0]['Config']).read(),
+                             blob(image['config']['digest']))
+            self.assertEqual(manifest[0]['Layers'],
+                             [l['digest'] for l in image['layers']])
+            for layer in manifest[0]['Layers']:
+                self.assertEqual(t.extractfile(layer).read(), blob(layer))
+        self.assertEqual(['blobs', 'index.json', 'oci-layout'],
+                         sorted(os.listdir(layout)))
+
+    def test_unique_layers(self):
+        files = {'a': (1, b'foo'), 'b': (2, b'foo'), 'c': (1, b'foo'),
+                 'd': (3, b'bar!'), 'e': (4, b'baz')}
+        opened = []
+        def open_layer(layer):
+            opened.append(layer)
+            return io.BytesIO(files[layer][1])
+        unique = _unique_layers(
+            sorted(files),
+            identity=lambda layer: files[layer][0],
+            size=lambda layer: len(files[layer][1]),
+            open_layer=open_layer)
+        self.assertEqual(
+            {'a': 'a', 'b': 'a', 'c': 'a', 'd': 'd', 'e': 'e'}, unique)
+        # Only layers of the same size and distinct identities are read.
+        self.assertEqual(['a', 'b', 'e'], sorted(opened))
+
+    def test_resolve_links(self):
+        members = {}
+        for name, type_, linkname in [
+                ('l/layer.tar', tarfile.REGTYPE, ''),
+                ('s/layer.tar', tarfile.SYMTYPE, '../l/layer.tar'),
+                ('h/layer.tar', tarfile.LNKTYPE, 's/layer.tar')]:
+            members[name] = tarfile.TarInfo(name)
+            members[name].type = type_
+            members[name].linkname = linkname
+        self.assertEqual('l/layer.tar', _resolve_links(members, 'h/layer.tar'))
+        self.assertEqual('l/layer.tar', _resolve_links(members, 'l/layer.tar'))
+
+    def test_resolve_links_loop(self):
+        members = {}
+        for name, linkname in [('a', 'b'), ('b', 'a')]:
+            members[name] = tarfile.TarInfo(name)
+            members[name].type = tarfile.SYMTYPE
+            members[name].linkname = linkname
+        with self.assertRaisesRegex(KeyError, 'Link loop at a'):
+            _resolve_links(members, 'a')
+
+    def test_resolve_links_missing_target(self):
+        members = {'dangling': tarfile.TarInfo('dangling')}
+        members['dangling'].type = tarfile.SYMTYPE
+        members['dangling'].linkname = 'missing'
+        with self.assertRaisesRegex(KeyError, 'missing member: missing'):
+            _resolve_links(members, 'dangling')
+
+    def test_duplicate_layers(self):
+        layer = _tar_bytes([('a', b'foo')], 12345)
+        img_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_duplicate_layers.tar")
+        _image_tar(img_tar, [('l1/layer.tar', layer), ('l2/layer.tar', layer)])
+        out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_duplicate_layers_out.tar")
+        streaming_out_tar = os.path.join(
+            os.environ["TEST_TMPDIR"], "test_duplicate_layers_streaming.tar")
+        strip_tar(img_tar, out_tar)
+        strip_tar_streaming(img_tar, streaming_out_tar)
+        self.assertTrue(filecmp.cmp(out_tar, streaming_out_tar, shallow=False))
+        with tarfile.open(out_tar) as t:
+            manifest = json.load(t.extractfile('manifest.json'))
+            layers = manifest[0]['Layers']
+            self.assertEqual(2, len(layers))
+            self.assertEqual(layers[0], layers[1])
+            self.assertEqual(
+                1, len([n for n in t.getnames() if n == layers[0]]))
+
 if __name__ == '__main__':
   unittest.main()
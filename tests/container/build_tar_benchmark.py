@@ -0,0 +1,121 @@
+# Copyright 2017 The Bazel Authors. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for the container build_tar tool.
+
+The `copy` benchmark compares the throughput of adding files to a layer through
+the kernel (zero-copy) with the one of copying them through Python buffers:
+
+  bazel run //tests/container:build_tar_benchmark -- --files=100000
+
+The `deep_tree` benchmark measures the rate of adding files at increasing
+depths. Existing parent directories cost nothing, so it only drops when names
+get longer than 100 characters and need PAX headers:
+
+  bazel run //tests/container:build_tar_benchmark -- --benchmark=deep_tree
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from container.archive import TarFileWriter
+
+
+def generate_files(directory, count, size):
+  """Writes `count` files of `size` bytes, spread in nested directories."""
+  paths = []
+  content = os.urandom(size)
+  for i in range(count):
+    d = os.path.join(directory, 'd%d' % (i % 100), 'e%d' % (i % 7))
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    p = os.path.join(d, 'f%d' % i)
+    with open(p, 'wb') as f:
+      f.write(content)
+    paths.append(p)
+  return paths
+
+
+def build_layer(output, paths, root, zero_copy, digests):
+  """Builds a layer of `paths` and returns the elapsed time in seconds."""
+  start = time.time()
+  with TarFileWriter(output,
+                     compute_digests=digests,
+                     zero_copy=zero_copy) as out:
+    for p in paths:
+      out.add_file(os.path.relpath(p, root), file_content=p)
+  return time.time() - start
+
+
+def benchmark_copy(args):
+  tmp = tempfile.mkdtemp()
+  try:
+    root = os.path.join(tmp, 'src')
+    paths = generate_files(root, args.files, args.size)
+    total = args.files * args.size / (1024.0 * 1024.0)
+    output = os.path.join(tmp, 'layer.tar')
+    for zero_copy in [False, True]:
+      elapsed = min(
+          build_layer(output, paths, root, zero_copy, args.digests)
+          for _ in range(args.runs))
+      print('%-10s %8.3f s %10.1f MiB/s %10.0f files/s' % (
+          'zero-copy' if zero_copy else 'buffered', elapsed, total / elapsed,
+          args.files / elapsed))
+  finally:
+    shutil.rmtree(tmp)
+
+
+def benchmark_deep_tree(args):
+  for depth in [1, 8, 32, 128]:
+    # 100 files per leaf directory, all sharing their first depth - 1 parents.
+    names = [
+        '/'.join(['d%d' % j for j in range(depth - 1)] +
+                 ['l%d' % (i // 100), 'f%d' % i]) for i in range(args.files)
+    ]
+    elapsed = None
+    for _ in range(args.runs):
+      start = time.time()
+      with TarFileWriter(os.devnull) as out:
+        for name in names:
+          out.add_file(name, content='x')
+      run = time.time() - start
+      elapsed = run if elapsed is None else min(elapsed, run)
+    print('depth %-5d %8.3f s %10.0f files/s' % (depth, elapsed,
+                                                 args.files / elapsed))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--benchmark', choices=['copy', 'deep_tree'],
+                      default='copy', help='The benchmark to run.')
+  parser.add_argument('--files', type=int, default=20000,
+                      help='Number of files to add to the layer.')
+  parser.add_argument('--size', type=int, default=64 * 1024,
+                      help='Size of each file, in bytes.')
+  parser.add_argument('--runs', type=int, default=3,
+                      help='Number of runs of each variant, the best is kept.')
+  parser.add_argument('--digests', action='store_true',
+                      help='Also compute the diff_id while writing.')
+  args = parser.parse_args()
+
+  if args.benchmark == 'deep_tree':
+    benchmark_deep_tree(args)
+  else:
+    benchmark_copy(args)
+
+
+if __name__ == '__main__':
+  main()
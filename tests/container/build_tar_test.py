@@ -13,12 +13,48 @@
 # limitations under the License.
 """Tests for container build_tar tool"""
 
+from container.archive import ParallelGzipWriter
+from container.archive import TarFileWriter
+from container.archive import rewrite_tar_mtimes
+from container import build_tar
 from container.build_tar import TarFile
+from container import layer_cache
+from container.layer_cache import LayerCache, compute_key
 import unittest
 import tempfile
 from os import path
 import tarfile
+import errno
 import glob
+import gzip
+import hashlib
+import io
+import os
+import random
+from unittest import mock
+
+def _write_ar(ar_name, members):
+  """Writes a System V ar archive of (name, bytes) members, as in a .deb."""
+  with open(ar_name, "wb") as ar:
+    ar.write(b"!<arch>\n")
+    for name, data in members:
+      ar.write(("%-16s%-12d%-6d%-6d%-8o%-10d" % (name + "/", 0, 0, 0, 0o644, len(data))).encode("utf-8"))
+      ar.write(b"\x60\x0a")
+      ar.write(data)
+      if len(data) % 2:
+        ar.write(b"\n")
+
+
+def _tar_bytes(mode, files):
+  """Returns a tarball of the (name, bytes) files, compressed as per `mode`."""
+  out = io.BytesIO()
+  with tarfile.open(fileobj=out, mode=mode) as tar:
+    for name, data in files:
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      tar.addfile(info, io.BytesIO(data))
+  return out.getvalue()
+
 
 class BuildTarTest(unittest.TestCase):
 
@@ -51,6 +87,85 @@ class BuildTarTest(unittest.TestCase):
       for source_file in glob.iglob("./tests/container/testdata/files/*"):
         self.assertIn('./{}/files/{}'.format(prefix, path.basename(source_file)), contained_names)
 
+  def testAddsXzCompressedTar(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      xz_tar_name = path.join(tmp, "input.tar.xz")
+      with tarfile.open(xz_tar_name, "w:xz", dereference=True) as xz_tar:
+        xz_tar.add("./tests/container/testdata/files", arcname="files")
+      output_file_name = path.join(tmp, "output.tar")
+      with TarFile(output_file_name, directory="/", compression=None, root_directory=".", default_mtime=None,
+                   enable_mtime_preservation=False, xz_path="", force_posixpath=False) as output_file:
+        output_file.add_tar(xz_tar_name)
+
+      with tarfile.open(output_file_name) as output_file:
+        contained_names = output_file.getnames()
+
+      for source_file in glob.iglob("./tests/container/testdata/files/*"):
+        self.assertIn('./files/' + path.basename(source_file), contained_names)
+
+  def testWritesXzCompressedTar(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      output_file_name = path.join(tmp, "output.tar.xz")
+      with TarFile(output_file_name, directory="/", compression="xz", root_directory=".", default_mtime=None,
+                   enable_mtime_preservation=False, xz_path="", force_posixpath=False) as output_file:
+        output_file.add_tar("./tests/container/testdata/expected.tar")
+
+      # No uncompressed intermediate file is left behind.
+      self.assertEqual(["output.tar.xz"], os.listdir(tmp))
+      with tarfile.open(output_file_name, "r:xz") as output_file:
+        contained_names = output_file.getnames()
+
+      for source_file in glob.iglob("./tests/container/testdata/files/*"):
+        self.assertIn('./files/' + path.basename(source_file), contained_names)
+
+  def testAddsDeb(self):
+    for compression in ["gz", "xz"]:
+      with tempfile.TemporaryDirectory() as tmp:
+        deb_name = path.join(tmp, "test.deb")
+        _write_ar(deb_name, [
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.gz", _tar_bytes("w:gz", [("./control", b"Package: test\n")])),
+            ("data.tar." + compression, _tar_bytes("w:" + compression, [("./usr/bin/test", b"#!/bin/sh\n")])),
+        ])
+        output_file_name = path.join(tmp, "output.tar")
+        with TarFile(output_file_name, directory="/", compression=None, root_directory="./", default_mtime=None,
+                     enable_mtime_preservation=False, xz_path="", force_posixpath=False) as output_file:
+          output_file.add_deb(deb_name)
+
+        with tarfile.open(output_file_name) as output_file:
+          self.assertIn('./var/lib/dpkg/status.d/test', output_file.getnames())
+          self.assertEqual(b"#!/bin/sh\n", output_file.extractfile('./usr/bin/test').read())
+
+  def testAddsDebsIndependentlyOfJobs(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      debs = []
+      for i, compression in enumerate(["gz", "xz", "", "bz2", "gz", "xz"]):
+        deb_name = path.join(tmp, "test%d.deb" % i)
+        data_name = "data.tar." + compression if compression else "data.tar"
+        _write_ar(deb_name, [
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.xz", _tar_bytes("w:xz", [("./control", b"Package: test%d\n" % i)])),
+            (data_name, _tar_bytes("w:" + compression, [("./usr/bin/test%d" % i, b"#!/bin/sh\n" * i),
+                                                          ("./usr/bin/common", b"%d" % i)])),
+        ])
+        debs.append(deb_name)
+      outputs = []
+      # Members are spilled to disk past the spool size.
+      for jobs, spool_size in [(1, TarFile.DEB_SPOOL_SIZE), (2, TarFile.DEB_SPOOL_SIZE), (8, TarFile.DEB_SPOOL_SIZE),
+                               (2, 100)]:
+        output_file_name = path.join(tmp, "output%d-%d.tar" % (jobs, spool_size))
+        with mock.patch.object(TarFile, "DEB_SPOOL_SIZE", spool_size):
+          with TarFile(output_file_name, directory="/", compression=None, root_directory="./", default_mtime=None,
+                       enable_mtime_preservation=False, xz_path="", force_posixpath=False) as output_file:
+            output_file.add_debs(debs, jobs)
+        with open(output_file_name, "rb") as f:
+          outputs.append(f.read())
+      self.assertEqual(1, len(set(outputs)))
+      with tarfile.open(output_file_name) as output_file:
+        # The first package wins for files present in several of them.
+        self.assertEqual(b"0", output_file.extractfile('./usr/bin/common').read())
+        self.assertIn('./var/lib/dpkg/status.d/test5', output_file.getnames())
+
   def testPackageNameParserValidMetadata(self):
     metadata = """
 Package: test
@@ -122,6 +237,286 @@ Version: 1.2.4
         self.assertIn('./var/lib/dpkg/status.d/test', contained_names)
         self.assertIn('./var/lib/dpkg/status.d/test.md5sums', contained_names)
 
+  def testEmitsCompressedLayerAndDigests(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      output_file_name = path.join(tmp, "output.tar")
+      compressed_file_name = path.join(tmp, "output.tar.gz")
+      diff_id_file_name = path.join(tmp, "output.tar.sha256")
+      blob_sum_file_name = path.join(tmp, "output.tar.gz.sha256")
+      with TarFile(output_file_name, directory="/", compression=None, root_directory="./", default_mtime=None,
+                   enable_mtime_preservation=False, xz_path="", force_posixpath=False,
+                   emit_compressed=compressed_file_name, emit_diff_id=diff_id_file_name,
+                   emit_blob_sum=blob_sum_file_name) as output_file:
+        output_file.add_tar("./tests/container/testdata/expected.tar")
+
+      with open(output_file_name, "rb") as f:
+        layer = f.read()
+      with open(compressed_file_name, "rb") as f:
+        compressed = f.read()
+      self.assertEqual(layer, gzip.decompress(compressed))
+      with open(diff_id_file_name) as f:
+        self.assertEqual(hashlib.sha256(layer).hexdigest(), f.read())
+      with open(blob_sum_file_name) as f:
+        self.assertEqual(hashlib.sha256(compressed).hexdigest(), f.read())
+
+  def testZeroCopyMatchesBufferedCopy(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      sizes = [0, 1, 511, 512, 513, 3 * 1024 * 1024 + 7]
+      for i, size in enumerate(sizes):
+        with open(path.join(tmp, "f%d" % i), "wb") as f:
+          f.write(bytes(random.Random(i).getrandbits(8) for _ in range(min(size, 4096))) * (size // 4096) +
+                  b'x' * (size % 4096))
+      outputs = {}
+      for zero_copy in [True, False]:
+        for digests in [True, False]:
+          name = path.join(tmp, "out-%s-%s.tar" % (zero_copy, digests))
+          with TarFileWriter(name, compressed_name=name + ".gz" if digests else None,
+                             compute_digests=digests, zero_copy=zero_copy) as out:
+            for i in range(len(sizes)):
+              out.add_file("f%d" % i, file_content=path.join(tmp, "f%d" % i))
+          with open(name, "rb") as f:
+            outputs[(zero_copy, digests)] = f.read()
+          if digests:
+            self.assertEqual(hashlib.sha256(outputs[(zero_copy, digests)]).hexdigest(), out.diff_id)
+            with open(name + ".gz", "rb") as f:
+              self.assertEqual(outputs[(zero_copy, digests)], gzip.decompress(f.read()))
+      self.assertEqual(1, len(set(outputs.values())))
+
+  def testZeroCopyFallsBackToBufferedCopy(self):
+    def unsupported(code):
+      def fail(*args):
+        raise OSError(code, os.strerror(code))
+      return fail
+    def no_offset(out_fd, in_fd, offset, count):
+      if offset is None:
+        raise TypeError("an integer is required")
+      raise OSError(errno.ENOTSOCK, os.strerror(errno.ENOTSOCK))
+    # Without copy_file_range: sendfile may not write to regular files, and
+    # isn't even tried outside of Linux, e.g. as macOS requires an offset.
+    for platform, sendfile in [("linux", unsupported(errno.ENOTSOCK)),
+                               ("darwin", no_offset)]:
+      with tempfile.TemporaryDirectory() as tmp:
+        content = b"0123456789" * 1000
+        src = path.join(tmp, "src")
+        with open(src, "wb") as f:
+          f.write(content)
+        name = path.join(tmp, "out.tar")
+        with mock.patch("os.copy_file_range", unsupported(errno.ENOSYS), create=True), \
+             mock.patch("os.sendfile", sendfile), mock.patch("sys.platform", platform):
+          with TarFileWriter(name, zero_copy=True) as out:
+            out.add_file("f", file_content=src)
+        with tarfile.open(name) as tar:
+          self.assertEqual(content, tar.extractfile("./f").read())
+
+  def testZeroCopyCompressesLargeFilesInSlices(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      # Several slices and compression blocks, not ending on a boundary.
+      content = random.Random(0).randbytes(1024) * (3 * 1024 + 5) + b"end"
+      self.assertGreater(len(content), ParallelGzipWriter.BLOCK_SIZE)
+      src = path.join(tmp, "src")
+      with open(src, "wb") as f:
+        f.write(content)
+      name = path.join(tmp, "out.tar")
+      with TarFileWriter(name, compressed_name=name + ".gz", compute_digests=True,
+                         compression_threads=2, zero_copy=True) as out:
+        out.add_file("f", file_content=src)
+      with open(name, "rb") as f:
+        layer = f.read()
+      with open(name + ".gz", "rb") as f:
+        compressed = f.read()
+      self.assertEqual(layer, gzip.decompress(compressed))
+      self.assertEqual(hashlib.sha256(layer).hexdigest(), out.diff_id)
+      self.assertEqual(hashlib.sha256(compressed).hexdigest(), out.blob_sum)
+      with tarfile.open(name) as tar:
+        self.assertEqual(content, tar.extractfile("./f").read())
+
+  def testLayerCache(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      cache = LayerCache(path.join(tmp, "cache"), max_size=3000)
+      src = path.join(tmp, "src")
+      with open(src, "wb") as f:
+        f.write(b"a" * 1000)
+      key = compute_key({"mtime": "portable"}, [src])
+      self.assertNotEqual(key, compute_key({"mtime": None}, [src]))
+      outputs = {"output": path.join(tmp, "layer.tar"), "emit_diff_id": path.join(tmp, "layer.sha256")}
+      self.assertFalse(cache.fetch(key, outputs))
+      self.assertFalse(path.exists(outputs["output"]))
+
+      with open(outputs["output"], "wb") as f:
+        f.write(b"l" * 2000)
+      with open(outputs["emit_diff_id"], "w") as f:
+        f.write("0" * 64)
+      cache.publish(key, outputs)
+      for p in outputs.values():
+        os.unlink(p)
+      self.assertTrue(cache.fetch(key, outputs))
+      with open(outputs["output"], "rb") as f:
+        self.assertEqual(b"l" * 2000, f.read())
+
+      # Changing an input changes the key.
+      with open(src, "wb") as f:
+        f.write(b"b" * 1000)
+      other_key = compute_key({"mtime": "portable"}, [src])
+      self.assertNotEqual(key, other_key)
+      # Publishing a second entry evicts the least recently used one.
+      os.utime(path.join(tmp, "cache", key), (0, 0))
+      cache.publish(other_key, outputs)
+      self.assertFalse(cache.fetch(key, outputs))
+      self.assertTrue(cache.fetch(other_key, outputs))
+
+      # Changing build_tar changes the key.
+      with mock.patch.object(layer_cache, "_TOOL_DIGEST", "0" * 64):
+        self.assertNotEqual(other_key, compute_key({"mtime": "portable"}, [src]))
+
+  def testLayerCacheFollowsSymlinkedDirectories(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      cache = LayerCache(path.join(tmp, "cache"), max_size=3000)
+      target = path.join(tmp, "target")
+      os.makedirs(target)
+      with open(path.join(target, "f"), "w") as f:
+        f.write("a")
+      src = path.join(tmp, "src")
+      os.makedirs(src)
+      os.symlink(target, path.join(src, "link"))
+      # A link back to an ancestor is not walked again.
+      os.symlink(src, path.join(target, "loop"))
+      key = compute_key({"mtime": "portable"}, [src])
+      outputs = {"output": path.join(tmp, "layer.tar")}
+      with open(outputs["output"], "wb") as f:
+        f.write(b"l" * 100)
+      cache.publish(key, outputs)
+      self.assertTrue(cache.fetch(key, outputs))
+
+      # build_tar follows the link, so a change behind it is a miss.
+      with open(path.join(target, "f"), "w") as f:
+        f.write("b")
+      other_key = compute_key({"mtime": "portable"}, [src])
+      self.assertNotEqual(key, other_key)
+      self.assertFalse(cache.fetch(other_key, outputs))
+
+  def testLayerCacheMergesOutputs(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      cache = LayerCache(path.join(tmp, "cache"))
+      outputs = {"output": path.join(tmp, "layer.tar"), "emit_compressed": path.join(tmp, "layer.tar.gz")}
+      for name, p in outputs.items():
+        with open(p, "w") as f:
+          f.write(name)
+      # An entry published without some of the outputs gets them added.
+      cache.publish("key", {"output": outputs["output"]})
+      self.assertFalse(cache.fetch("key", outputs))
+      for name, p in outputs.items():
+        with open(p, "w") as f:
+          f.write(name)
+      cache.publish("key", outputs)
+      self.assertTrue(cache.fetch("key", outputs))
+      for name, p in outputs.items():
+        with open(p) as f:
+          self.assertEqual(name, f.read())
+      self.assertEqual(["key"], os.listdir(path.join(tmp, "cache")))
+
+  def testParallelGzipIsIndependentOfThreadCount(self):
+    rand = random.Random(0)
+    # Several blocks of compressible data, not ending on a block boundary.
+    data = b''.join(
+        rand.choice([b'layer', b'tar', b'gzip', b'\0' * 7]) for _ in range(150000))
+    outputs = []
+    for threads in [1, 2, 8]:
+      out = io.BytesIO()
+      with ParallelGzipWriter(fileobj=out, compresslevel=9, mtime=0, threads=threads) as f:
+        for i in range(0, len(data), 10000):
+          f.write(data[i:i + 10000])
+      outputs.append(out.getvalue())
+    self.assertEqual(data, gzip.decompress(outputs[0]))
+    self.assertEqual(outputs[0], outputs[1])
+    self.assertEqual(outputs[0], outputs[2])
+
+  def testRewriteHeadersMatchesTarfile(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      src = io.BytesIO()
+      with tarfile.open(fileobj=src, mode="w") as tar:
+        for name, kind in [("./a/", tarfile.DIRTYPE), ("./a/" + "b" * 150, tarfile.REGTYPE),
+                           ("./a/c", tarfile.REGTYPE), ("./a/l", tarfile.SYMTYPE),
+                           ("d", tarfile.REGTYPE), ("./a/c", tarfile.REGTYPE)]:
+          info = tarfile.TarInfo(name)
+          info.type = kind
+          info.mtime = 12345
+          info.linkname = "c" if kind == tarfile.SYMTYPE else ""
+          info.size = 700 if kind == tarfile.REGTYPE else 0
+          tar.addfile(info, io.BytesIO(b"x" * info.size) if kind == tarfile.REGTYPE else None)
+      for ext, data in [("tar", src.getvalue()), ("tar.gz", gzip.compress(src.getvalue()))]:
+        input_name = path.join(tmp, "input." + ext)
+        with open(input_name, "wb") as f:
+          f.write(data)
+        outputs = []
+        for rewrite in [True, False]:
+          name = path.join(tmp, "out-%s.tar" % rewrite)
+          with TarFileWriter(name, preserve_tar_mtimes=False, default_mtime="portable",
+                             rewrite_headers=rewrite) as out:
+            out.add_tar(input_name)
+          with open(name, "rb") as f:
+            outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
+        with tarfile.open(fileobj=io.BytesIO(outputs[0])) as tar:
+          self.assertEqual(["./a", "./a/" + "b" * 150, "./a/c", "./a/l", "./d"], tar.getnames())
+          self.assertEqual({946684800}, set(m.mtime for m in tar))
+
+  def testBuildTarRewritesTarHeaders(self):
+    src = io.BytesIO()
+    with tarfile.open(fileobj=src, mode="w", format=tarfile.PAX_FORMAT) as tar:
+      for name, pax_headers in [("./a", {}), ("./" + "b" * 150, {"uname": "u" * 40, "comment": "kept"})]:
+        info = tarfile.TarInfo(name)
+        info.size = 3
+        info.mtime = 12345
+        info.uid = info.gid = 1000
+        info.uname = "user"
+        info.gname = "group"
+        info.pax_headers = pax_headers
+        tar.addfile(info, io.BytesIO(b"abc"))
+    with tempfile.TemporaryDirectory() as tmp:
+      input_name = path.join(tmp, "input.tar")
+      with open(input_name, "wb") as f:
+        f.write(src.getvalue())
+      output_name = path.join(tmp, "output.tar")
+      raw_tars = []
+      # build_tar may import its own copy of archive.
+      writer_class = build_tar.archive.TarFileWriter
+      add_raw_tar = writer_class._add_raw_tar
+      def record_raw_tar(writer, fileobj, numeric=False):
+        raw_tars.append(numeric)
+        return add_raw_tar(writer, fileobj, numeric)
+      with mock.patch.object(writer_class, "_add_raw_tar", record_raw_tar):
+        with TarFile(output_name, directory="/", compression=None, root_directory="./",
+                     default_mtime="portable", enable_mtime_preservation=False, xz_path="",
+                     force_posixpath=False, rewrite_tar_headers=True) as output:
+          output.add_tar(input_name)
+      self.assertEqual([True], raw_tars)
+      with tarfile.open(output_name) as tar:
+        members = tar.getmembers()
+        self.assertEqual(["./a", "./" + "b" * 150], [m.name for m in members])
+        for member in members:
+          self.assertEqual((1000, 1000, "", ""), (member.uid, member.gid, member.uname, member.gname))
+          self.assertEqual(946684800, member.mtime)
+          self.assertEqual(b"abc", tar.extractfile(member).read())
+        self.assertNotIn("uname", members[1].pax_headers)
+        self.assertEqual("kept", members[1].pax_headers["comment"])
+
+  def testRewriteTarMtimesPatchesPaxRecords(self):
+    src = io.BytesIO()
+    with tarfile.open(fileobj=src, mode="w", format=tarfile.PAX_FORMAT) as tar:
+      info = tarfile.TarInfo("f")
+      info.size = 3
+      info.pax_headers = {"mtime": "12345.5", "comment": "kept"}
+      tar.addfile(info, io.BytesIO(b"abc"))
+    src.seek(0)
+    out = io.BytesIO()
+    self.assertEqual(rewrite_tar_mtimes(src, out, 42), len(out.getvalue()))
+    self.assertEqual(0, len(out.getvalue()) % tarfile.RECORDSIZE)
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue())) as tar:
+      member = tar.next()
+      self.assertEqual(42, member.mtime)
+      self.assertEqual("kept", member.pax_headers["comment"])
+      self.assertEqual(b"abc", tar.extractfile(member).read())
+
 
 if __name__ == '__main__':
   unittest.main()
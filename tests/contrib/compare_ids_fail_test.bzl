@@ -63,6 +63,7 @@ compare_ids_test(
         ctx.file._compare_ids_test_bzl,
         ctx.file._compare_ids_test,
         ctx.file._extract_image_id,
+        ctx.file._image_tarball,
         ctx.file._BUILD,
     ])
 
@@ -78,6 +79,7 @@ compare_ids_test(
             "{BUILD_path}": ctx.file._BUILD.short_path,
             "{bzl_path}": ctx.file._compare_ids_test_bzl.short_path,
             "{extractor_path}": ctx.file._extract_image_id.short_path,
+            "{image_tarball_path}": ctx.file._image_tarball.short_path,
             "{name}": ctx.attr.name,
             "{reg_exps}": reg_exps,
             "{tars}": tars_string,
@@ -123,6 +125,10 @@ compare_ids_fail_test = rule(
             allow_single_file = True,
             default = "//contrib:extract_image_id.py",
         ),
+        "_image_tarball": attr.label(
+            allow_single_file = True,
+            default = "//contrib:image_tarball.py",
+        ),
     },
     test = True,
     implementation = _impl,
@@ -44,6 +44,10 @@ test -f $(basename {test_bin_path})
 ln -s ../{extractor_path}
 test -f $(basename {extractor_path})
 
+# Link image_tarball.py, which extract_image_id.py imports
+ln -s ../{image_tarball_path}
+test -f $(basename {image_tarball_path})
+
 # Link BUILD
 ln -s ../{BUILD_path}
 test -f $(basename {BUILD_path})